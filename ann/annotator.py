@@ -94,7 +94,14 @@ while True:
                 email = body['email']
                 user_status = body['user_status']
 
-            local_filename = get_job_file_path(job_id, '.vcf')
+            # Keep the extension so that compressed inputs (.vcf.gz,
+            # .vcf.bgz) and variant pileups (.pileup) are downloaded as
+            # they are and read by the annotator
+            extension = '.vcf'
+            for ext in ['.vcf.gz', '.vcf.bgz', '.pileup']:
+                if s3_key_input_file.endswith(ext):
+                    extension = ext
+            local_filename = get_job_file_path(job_id, extension)
             s3.download_file(s3_inputs_bucket, s3_key_input_file, local_filename)
 
             try:
@@ -10,11 +10,43 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import time
 import file_utils as fu
 import utils as u
+import engine
+import intervals
+import variants
+import transcripts
+import perfstats
+import backends
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Number of variants resolved by one dbSNP query; 0 queries one at a time
+DBSNP_BATCH_SIZE = 500
+
+# Number of variants resolved by one BigRefGene query; 0 queries the three
+# tables one variant at a time
+BIGREFGENE_BATCH_SIZE = 500
+
+# Answer range-overlap stages from an in-memory copy of their tables
+USE_INTERVAL_INDEX = True
+
+# Answer range-overlap stages by walking position-sorted input and
+# position-sorted reference intervals together
+USE_SWEEP_JOIN = True
+
+# Chromosomes with fewer records than this in a batch are looked up one
+# record at a time rather than by starting a sorted join through their
+# intervals
+SWEEP_MIN_RECORDS = 32
+
+# Reference snapshot written by snapshot.py; tables found in it are read
+# from the memory-mapped files instead of the database
+SNAPSHOT_DIR = os.environ['ANNTOOLS_SNAPSHOT_DIR'] \
+    if ('ANNTOOLS_SNAPSHOT_DIR' in os.environ) else None
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -107,89 +139,237 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Base class for the annotation stages run by the engine
+   lookup() queries the reference database for one record and must not
+   modify it; apply() merges the result of lookup() into the record fields
+   (a variants.Variant), adding to INFO through fields.info.
+   depends names the stages whose apply() output lookup() reads; the
+   engine may run a stage's lookups before the earlier stages not named
+   there have been applied, but always applies stages in order.
+   Counters reported in the .count.log are kept on the stage and written
+   by writeLog() once the whole file has been annotated; counters lists
+   them so that the counts of several runs can be added up.
+   lookup() results depend only on a record's chromosome, position and
+   alleles and on what cacheKey() says about the stage, so that they can
+   be kept in the variant cache (see varcache.py) for later jobs. Records
+   with the same locusKey() have the same lookup(); the engine memoizes
+   them in memo for the rest of the job. close() is called once the job is
+   done.
+"""
+class Stage(object):
+    name = ''
+    depends = ()
+    counters = ()
+
+    def __init__(self, format='vcf'):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.cursor = None
+        self.backend = None
+        self.stats = perfstats.newStats()
+        self.memo = None
+        self.streamConn = None
+
+    def open(self, cursor):
+        self.cursor = cursor
+        self.backend = backends.backend(cursor)
+
+    """Unbuffered cursor (see backends.streamCursor()) on a reference
+       database connection of the stage's own, taken from the shared pool
+       (see utils.db_pool()), for reading a table while the stage's cursor
+       runs other queries; only one can be in use at a time
+    """
+    def streamCursor(self):
+        if (self.streamConn is None):
+            self.streamConn = u.db_pool().acquire()
+        return perfstats.StatsCursor(backends.streamCursor(self.streamConn),
+            self.stats)
+
+    """Hand the stream connection back to the pool
+    """
+    def close(self):
+        if (self.streamConn is not None):
+            u.db_pool().release(self.streamConn)
+            self.streamConn = None
+
+    def lookup(self, fields):
+        return None
+
+    def lookupBatch(self, batch):
+        return [self.lookup(fields) for fields in batch]
+
+    def apply(self, fields, result):
+        pass
+
+    def cacheKey(self):
+        return self.name
+
+    """Locus of a record as the stages read it (see variants.Variant)
+    """
+    def locusKey(self, fields):
+        return fields.locus()
+
+    def writeLog(self, fh_log):
+        pass
+
+    def counts(self):
+        return dict([(c, getattr(self, c)) for c in self.counters])
+
+    def addCounts(self, counts):
+        for c in self.counters:
+            setattr(self, c, getattr(self, c) + counts[c])
+
+
+"""In-process source for a reference table: the table's snapshot if one
+   was exported, an interval index loaded from the database if indexed is
+   set, or None if the table has to be queried
+"""
+def referenceIndex(backend, table, chromcol='chrom', startcol='chromStart',
+    endcol='chromEnd', indexed=False):
 
-    inds = getFormatSpecificIndices(format=format)
+    if (SNAPSHOT_DIR is not None):
+        import snapshot
+        source = snapshot.openTable(SNAPSHOT_DIR, table)
+        if (source is not None):
+            return source
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    if indexed:
+        return intervals.loadIndex(backend, table, chromcol=chromcol,
+            startcol=startcol, endcol=endcol)
+    return None
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+"""Chromosome name without the "chr" prefix
+"""
+def chromNoPrefix(chr):
+    chr = chr.strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+"""Chromosome name with the "chr" prefix
+"""
+def chromWithPrefix(chr):
+    chr = chr.strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+class DbSnpStage(Stage):
+    name = 'dbSNP'
+    counters = ('var_count', 'linenum', 'chunks', 'chunk_secs')
+
+    def __init__(self, format='vcf', varclass='SNV', batch_size=None):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.batch_size = DBSNP_BATCH_SIZE if (batch_size is None) \
+            else batch_size
+        self.var_count = 0
+        self.linenum = 1
+        self.chunks = 0
+        self.chunk_secs = 0.0
+
+    def cacheKey(self):
+        return self.name + '/' + self.varclass
+
+    def lookup(self, fields):
+        chr = fields.chromBare
+        pos = fields.pos
+        ref = fields.cleanRef
+        compRef = getComplementary(ref)
+
+        keys = [(chr, int(pos), ref)]
+        if (compRef != ref):
+            keys.append((chr, int(pos), compRef))
+        rows = self.backend.pointLookup('dbSNP', ['CHR', 'POS', 'REF'], keys,
+            where=[('INFO', self.varclass)])
+        return [row[3:] for row in rows]
+
+    """Resolves the batch with one query per chunk of batch_size variants
+       and maps the rows back to the records. Comparisons are done in upper
+       case since MySQL string comparisons are case-insensitive.
+    """
+    def lookupBatch(self, batch):
+        if (self.batch_size < 1):
+            return Stage.lookupBatch(self, batch)
+
+        results = []
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            keys = []
+            params = set([])
+            for fields in chunk:
+                chr = fields.chromBare
+                pos = fields.pos
+                ref = fields.cleanRef
+                compRef = getComplementary(ref)
+                keys.append((chr.upper(), pos, ref.upper(), compRef.upper()))
+                params.add((chr, pos, ref))
+                params.add((chr, pos, compRef))
+
+            start = time.time()
+            found = {}
+            for row in self.backend.pointLookup('dbSNP', ['CHR', 'POS', 'REF'],
+                list(params), where=[('INFO', self.varclass)]):
+                key = (str(row[0]).upper(), int(row[1]))
+                found.setdefault(key, []).append(row)
+            self.chunk_secs = self.chunk_secs + (time.time() - start)
+            self.chunks = self.chunks + 1
+
+            for chr, pos, ref, compRef in keys:
+                results.append([row[3:] for row in found.get((chr, pos), [])
+                    if str(row[2]).upper() in (ref, compRef)])
+
+        return results
+
+    def apply(self, fields, rows):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if (fields.info.text() == '.'):
+                fields.info.set('DB' + maf_str)
+            else:
+                fields.info.append(';DB;VC=' + self.varclass + maf_str)
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+            fields[2] = str(';'.join(rsids))
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+        self.linenum = self.linenum + 1
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
-            linenum = linenum + 1
+        if (self.chunks > 0):
+            print(f"dbSNP lookups: {str(self.chunks)} queries of up to " + \
+                f"{str(self.batch_size)} variants, " + \
+                f"{(self.chunk_secs / self.chunks) * 1000:.1f} ms per query")
 
-        else:
-            fh_out.write(line + '\n')
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, DbSnpStage(format=format, varclass=varclass,
+        batch_size=batch_size),
+        tmpextin=tmpextin, tmpextout=tmpextout, logmode='w', sep=sep)
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,308 +377,306 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+class BigRefGeneStage(Stage):
+    name = 'BigRefGene'
+    tables = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']
+
+    def __init__(self, format='vcf', batch_size=None):
+        Stage.__init__(self, format=format)
+        self.batch_size = BIGREFGENE_BATCH_SIZE if (batch_size is None) \
+            else batch_size
+
+    def lookup(self, fields):
+        return self.lookupChunk([fields])[0]
+
+    """Fetches the candidates of all three tables for a chunk of
+       batch_size variants with one cascade lookup, each row tagged with
+       the table it came from and the variant position it matched, and
+       picks the first table with a match for every variant. Comparisons
+       are done in upper case since MySQL string comparisons are
+       case-insensitive.
+    """
+    def lookupBatch(self, batch):
+        if (self.batch_size < 1):
+            return Stage.lookupBatch(self, batch)
+
+        results = []
+        for i in range(0, len(batch), self.batch_size):
+            results.extend(self.lookupChunk(batch[i:i + self.batch_size]))
+        return results
+
+    def lookupChunk(self, chunk):
+        results = []
+        keys = []
+        points = set([])
+        for fields in chunk:
+            chr = fields.chromBare
+            pos = fields.pos
+            ref = fields.cleanRef
+            alt = fields.cleanAlt
+            alleles = [(ref.upper(), alt.upper()),
+                (getComplementary(ref).upper(),
+                getComplementary(alt).upper())]
+            keys.append((chr.upper(), pos, alleles))
+            points.add((chr, pos))
+
+        tiers = [(self.tables[0], backends.POINT),
+            (self.tables[1], backends.POINT),
+            (self.tables[2], backends.INTERVAL)]
+        found = [{}, {}, {}]
+        for row in self.backend.cascade(tiers, list(points),
+            select=('haplotypeReference', 'haplotypeAlternate')):
+            key = (str(row[1]).upper(), int(row[2]))
+            found[int(row[0])].setdefault(key, []).append(row)
+
+        for chr, pos, alleles in keys:
+            rows = [row for row in found[0].get((chr, pos), [])
+                if (str(row[3]).upper(), str(row[4]).upper()) in alleles]
+            if (len(rows) == 0):
+                rows = found[1].get((chr, pos), [])
+            if (len(rows) == 0):
+                rows = found[2].get((chr, pos), [])
+            results.append(tuple([row[5:] for row in rows]))
+
+        return results
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+            fields.info.append(';' + ';'.join(m))
+            fields.info.removePrefix('.;')
+
+
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    batch_size=None):
+    engine.annotateFile(vcf, BigRefGeneStage(format=format,
+        batch_size=batch_size),
+        tmpextin=tmpextin, tmpextout=tmpextout, logfile=False, sep=sep)
 
 
 """Get information about location in gene structures
+   lookup() returns one (collapsed gene names, exonic hits, promoter hits)
+   tuple per overlapping transcript; the collapsed names are empty when the
+   variant is in none of the transcript's regions of interest
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+class GenesStage(Stage):
+    name = 'refGene'
+    # positionType, written by BigRefGene, is only read in apply()
+    depends = ()
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+        self.index = None
+        self.cpg = None
+
+    def cacheKey(self):
+        return self.name + '/' + self.table + '/' + str(self.promoter_offset)
+
+    def open(self, cursor):
+        Stage.open(self, cursor)
+        self.index = referenceIndex(self.backend, self.table,
+            startcol='txStart', endcol='txEnd')
+        self.cpg = referenceIndex(self.backend, 'cpgIslandExt',
+            indexed=USE_INTERVAL_INDEX)
+        if (self.cpg is not None):
+            self.cpgColumns = self.cpg.columnIndices(['chrom', 'chromStart',
+                'chromEnd', 'name'])
+        self.cpgLast = None
+
+    """First CpG island containing pos, for the promoter check
+       Answered from the snapshot or the interval index when there is one.
+       Otherwise the table is queried, at most once per position even when
+       several transcripts have the position in their promoter window.
+    """
+    def cpgIsland(self, chr, pos):
+        if (self.cpg is not None):
+            return self.cpg.first(chr, pos, columns=self.cpgColumns)
+
+        if (self.cpgLast is not None) and (self.cpgLast[0] == (chr, pos)):
+            self.stats['cache_hits'] = self.stats['cache_hits'] + 1
+            return self.cpgLast[1]
+        self.stats['cache_misses'] = self.stats['cache_misses'] + 1
+
+        cpg = self.backend.overlap('cpgIslandExt', chr, pos,
+            select=['chrom', 'chromStart', 'chromEnd', 'name'], first=True)
+        self.cpgLast = ((chr, pos), cpg)
+        return cpg
+
+    """Transcripts within promoter_offset of the record's position
+    """
+    def candidates(self, fields):
+        promoter_offset = self.promoter_offset
+        chr = fields.chromPrefixed
+        pos = fields.pos
+
+        if (self.index is not None):
+            rows = self.index.overlapRange(chr, int(pos) -
+                int(promoter_offset), int(pos) + int(promoter_offset))
+        else:
+            rows = self.backend.overlap(self.table, chr, int(pos) -
+                int(promoter_offset), int(pos) + int(promoter_offset),
+                startcol='txStart', endcol='txEnd')
+        return (chr, int(pos), rows)
+
+    """(collapsed gene names, exonic hits, promoter hits) for a transcript
+       row, given where the position lies in it
+    """
+    def classify(self, chr, pos, row, t, located):
+        region_type, exons = located
+        region = ""
+        exonic = 0
+        promoter = 0
+
+        if (region_type == transcripts.NON_CODING) or \
+            (region_type == transcripts.CDS):
+            labels = []
+            for e in exons:
+                exnum = e + 1
+                if (t.strand == '-'):
+                    exnum = t.exonCount - e
+                if (region_type == transcripts.CDS):
+                    labels.append("exon=" + "ex" + str(exnum) + '/' + \
+                        str(t.exonCount))
+                    exonic = exonic + 1
+                else:
+                    labels.append("non_coding_exon=" + "ex" + \
+                        str(exnum) + '/' + str(t.exonCount))
+            if (len(labels) > 0):
+                region = ";".join(labels)
+
+        elif (region_type == transcripts.PROMOTER):
+            cpg = self.cpgIsland(chr, pos)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(cpg[3]).split())
+                promoter = 1
+
+        collapsed = ''
+        if (region != ''):
+            collapsed = collapseGeneNames(row=row,
+                indices=indicesKnownGenes, region=region, cnt=0)
+        return (collapsed, exonic, promoter)
+
+    def lookup(self, fields):
+        chr, pos, rows = self.candidates(fields)
+        genes = []
+        for row in rows:
+            t = transcripts.transcript(row, stats=self.stats)
+            located = t.locate([pos], int(self.promoter_offset))[0]
+            genes.append(self.classify(chr, pos, row, t, located))
+        return genes
+
+    """Finds the transcripts of every record first, then locates all the
+       batch's positions in each transcript at once
+    """
+    def lookupBatch(self, batch):
+        found = [self.candidates(fields) for fields in batch]
+        hits = {}
+        for i, (chr, pos, rows) in enumerate(found):
+            for j, row in enumerate(rows):
+                hits.setdefault(row, []).append((i, j))
+
+        located = [[None] * len(rows) for chr, pos, rows in found]
+        for row, refs in hits.items():
+            t = transcripts.transcript(row, stats=self.stats)
+            where = t.locate([found[i][1] for i, j in refs],
+                int(self.promoter_offset))
+            for (i, j), loc in zip(refs, where):
+                located[i][j] = (t, loc)
+
+        results = []
+        for (chr, pos, rows), locs in zip(found, located):
+            results.append([self.classify(chr, pos, row, t, loc)
+                for row, (t, loc) in zip(rows, locs)])
+        return results
+
+    def apply(self, fields, genes):
+        if (len(genes) > 0):
+            positionType = str(fields.info.get('positionType'))
             info = []
+            for collapsed, exonic, promoter in genes:
+                #count location
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                self.exonic_count = self.exonic_count + exonic
+                self.promoter_count = self.promoter_count + promoter
+                if (collapsed != ''):
+                    info.append(collapsed)
+
+            str_info = ";".join(info)
+            fields.info.append(';' + str_info)
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+        else:
+            fields.info.append(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-            linenum = linenum + 1
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-        else:
-            fh_out.write(line + '\n')
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    engine.annotateFile(vcf, GenesStage(format=format, table=table,
+        promoter_offset=promoter_offset), tmpextin=tmpextin,
+        tmpextout=tmpextout, sep=sep)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -526,8 +704,10 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    pool = u.db_pool()
+    conn = pool.acquire()
     cursor = conn.cursor()
+    backend = backends.backend(cursor)
     linenum = 1
 
     for line in fh:
@@ -545,12 +725,9 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             info_field = clean_mysql_chars(fields[7]).strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = backend.overlap(table, chr, int(pos) -
+                int(promoter_offset), int(pos) + int(promoter_offset),
+                startcol='txStart', endcol='txEnd')
             info = []
             if (len(rows) > 0):
                 cnt = 1
@@ -626,12 +803,9 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = backend.overlap('cpgIslandExt', chr, pos,
+                            select=['chrom', 'chromStart', 'chromEnd',
+                            'name'], first=True)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -640,12 +814,9 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = backend.overlap('cpgIslandExt', chr, pos,
+                            select=['chrom', 'chromStart', 'chromEnd',
+                            'name'], first=True)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -709,403 +880,428 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    cursor.close()
+    pool.release(conn)
+
+
+"""Base class for stages that report overlaps with a reference table
+   overlap() answers chromStart <= pos AND pos <= chromEnd. With sweep set,
+   records are joined with the table's intervals in position order until a
+   record is out of order; the intervals come from the table's snapshot if
+   there is one and are otherwise streamed from the database a chromosome
+   at a time, except for chromosomes with fewer than SWEEP_MIN_RECORDS
+   records in the batch, which are queried record by record. Without
+   sweep, and from the first record out of order on, the table's snapshot
+   or (with indexed set) an interval index is used, and the table is
+   queried for every record if there is neither. indexed and sweep default to
+   USE_INTERVAL_INDEX and USE_SWEEP_JOIN. Whichever is used, a record's
+   rows come by interval start and then the table's primary key (see
+   backends), which defines the output and the row firstOverlap() picks.
+"""
+class OverlapStage(Stage):
+    counters = ('var_count', 'line_count')
+    chromcol = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+
+    def __init__(self, format='vcf', table=None, indexed=None, sweep=None):
+        Stage.__init__(self, format=format)
+        if (table is not None):
+            self.table = table
+        self.name = self.table
+        self.indexed = USE_INTERVAL_INDEX if (indexed is None) else indexed
+        self.sweep = USE_SWEEP_JOIN if (sweep is None) else sweep
+        self.index = None
+        self.sweeper = None
+        self.stream = None
+        self.joined = None
+        self.direct = False
+        self.var_count = 0
+        self.line_count = 0
+
+    def open(self, cursor):
+        Stage.open(self, cursor)
+        self.index = None
+        self.sweeper = None
+        self.stream = None
+        self.joined = None
+        self.direct = False
+        if self.sweep:
+            source = referenceIndex(self.backend, self.table,
+                chromcol=self.chromcol, startcol=self.startName,
+                endcol=self.endName)
+            if (source is None):
+                source = intervals.TableCursor(self.backend, self.table,
+                    chromcol=self.chromcol, startcol=self.startName,
+                    endcol=self.endName, cursor=self.streamCursor)
+                self.stream = source
+            self.sweeper = intervals.SweepJoin(source)
+        else:
+            self.openIndex()
+
+    def openIndex(self):
+        self.index = referenceIndex(self.backend, self.table,
+            chromcol=self.chromcol, startcol=self.startName,
+            endcol=self.endName, indexed=self.indexed)
+
+    def close(self):
+        if (self.stream is not None):
+            self.stream.close()
+            self.stream = None
+        Stage.close(self)
+
+    """Queries the records of the chromosomes with fewer than
+       SWEEP_MIN_RECORDS records in the batch directly rather than streaming
+       their intervals, unless the join is already on their chromosome
+    """
+    def lookupBatch(self, batch):
+        if (self.sweeper is None) or (self.stream is None):
+            return Stage.lookupBatch(self, batch)
+
+        counts = {}
+        for fields in batch:
+            counts[fields.chromBare] = counts.get(fields.chromBare, 0) + 1
+        results = []
+        for fields in batch:
+            chrom = fields.chromBare
+            self.direct = (counts[chrom] < SWEEP_MIN_RECORDS) and \
+                (chrom != self.joined)
+            if not self.direct:
+                self.joined = chrom
+            results.append(self.lookup(fields))
+        self.direct = False
+        return results
+
+    """Give up on the sorted join once a record turns out to be out of
+       order; the records from then on are answered from the table's
+       snapshot or interval index (see openIndex())
+    """
+    def unsorted(self):
+        print(f"{self.table}: input is not sorted by position, " + \
+            "no longer using the sorted join")
+        self.sweeper = None
+        if (self.stream is not None):
+            self.stream.close()
+            self.stream = None
+        self.openIndex()
+
+    def overlap(self, chr, pos):
+        if (self.sweeper is not None) and not self.direct:
+            rows = self.sweeper.overlap(chr, int(pos))
+            if (rows is not None):
+                return rows
+            self.unsorted()
+
+        if (self.index is not None):
+            return self.index.overlap(chr, int(pos))
+
+        return self.backend.overlap(self.table, chr, int(pos),
+            chromcol=self.chromcol, startcol=self.startName,
+            endcol=self.endName)
+
+    def firstOverlap(self, chr, pos):
+        if (self.sweeper is not None) and not self.direct:
+            rows = self.sweeper.overlap(chr, int(pos))
+            if (rows is not None):
+                return rows[0] if (len(rows) > 0) else None
+            self.unsorted()
+
+        if (self.index is not None):
+            return self.index.first(chr, int(pos))
+
+        return self.backend.overlap(self.table, chr, int(pos),
+            chromcol=self.chromcol, startcol=self.startName,
+            endcol=self.endName, first=True)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class TfbsConsSitesStage(OverlapStage):
+    table = 'tfbsConsSites'
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def __init__(self, format='vcf', table=None, indexed=False, sweep=None):
+        OverlapStage.__init__(self, format=format, table=table,
+            indexed=indexed, sweep=sweep)
+        self.sources = {}
+        self.sweepers = {}
+
+    def open(self, cursor):
+        Stage.open(self, cursor)
+        self.sources = {}
+        self.sweepers = {}
+        self.stream = None
+        self.streamed = None
+
+    """One table per chromosome; rows as selected by the query below
+    """
+    def source(self, chrIndex):
+        if chrIndex not in self.sources:
+            index = referenceIndex(self.backend, 'tfbsConsSites' + chrIndex,
+                indexed=self.indexed)
+            columns = None
+            if (index is not None):
+                columns = index.columnIndices(['chrom', 'chromStart',
+                    'chromEnd', 'name'])
+            self.sources[chrIndex] = (index, columns)
+        return self.sources[chrIndex]
+
+    """Sorted join with one chromosome's table, read once per file
+       The table comes from the snapshot if it is there; otherwise its rows
+       are streamed from the database by start, as the per-variant query
+       only filters on the position. Streaming a table ends the join with
+       the one streamed before, whose records are looked up one at a time
+       from then on, and is not started for fewer than SWEEP_MIN_RECORDS
+       records. (None, None) if there is no join for the chromosome.
+    """
+    def tableSweep(self, chrIndex, count):
+        if chrIndex not in self.sweepers:
+            table = 'tfbsConsSites' + chrIndex
+            source = referenceIndex(self.backend, table)
+            columns = None
+            if (source is not None):
+                columns = source.columnIndices(['chrom', 'chromStart',
+                    'chromEnd', 'name'])
+            elif (count < SWEEP_MIN_RECORDS):
+                return (None, None)
+            else:
+                self.endStream()
+                source = intervals.TableCursor(self.backend, table,
+                    chromcol=None, select=['chrom', 'chromStart', 'chromEnd',
+                    'name'], cursor=self.streamCursor)
+                self.stream = source
+                self.streamed = chrIndex
+            self.sweepers[chrIndex] = (intervals.SweepJoin(source), columns)
+        return self.sweepers[chrIndex]
+
+    def endSweep(self, chrIndex):
+        self.sweepers[chrIndex] = (None, None)
+        if (self.streamed == chrIndex):
+            self.endStream()
+
+    def endStream(self):
+        if (self.stream is not None):
+            self.stream.close()
+            self.sweepers[self.streamed] = (None, None)
+            self.stream = None
+            self.streamed = None
+
+    def lookup(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        chrIndex = chr.replace('chr', '')
+
+        if (chrIndex not in self.allowed_chrom):
+            return ()
+        return self.lookupPosition(chr, chrIndex, pos)
+
+    """Groups the batch by chromosome and resolves each chromosome's
+       records in position order with a walk through its table
+    """
+    def lookupBatch(self, batch):
+        if not self.sweep:
+            return Stage.lookupBatch(self, batch)
+
+        results = [()] * len(batch)
+        chroms = {}
+        for i, fields in enumerate(batch):
+            chr = fields.chromPrefixed
+            chrIndex = chr.replace('chr', '')
+            if (chrIndex in self.allowed_chrom):
+                pos = fields.pos
+                chroms.setdefault(chrIndex, (chr, []))[1].append((pos, i))
+
+        for chrIndex, (chr, records) in chroms.items():
+            records.sort(key=lambda r: r[0])
+            sweeper, columns = self.tableSweep(chrIndex, len(records))
+            for pos, i in records:
+                rows = None
+                if (sweeper is not None):
+                    rows = sweeper.overlap(chr, pos, columns=columns)
+                    if (rows is None):
+                        print(f"tfbsConsSites{chrIndex}: input is not " + \
+                            "sorted by position, no longer using the " + \
+                            "sorted join")
+                        self.endSweep(chrIndex)
+                        sweeper = None
+                if (rows is None):
+                    rows = self.lookupPosition(chr, chrIndex, pos)
+                results[i] = rows
+
+        return results
+
+    def lookupPosition(self, chr, chrIndex, pos):
+        index, columns = self.source(chrIndex)
+        if (index is not None):
+            return index.overlap(chr, int(pos), columns=columns)
+
+        return self.backend.overlap('tfbsConsSites' + chrIndex, chr,
+            int(pos), chromcol=None, select=['chrom', 'chromStart',
+            'chromEnd', 'name'])
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            records = []
+            self.line_count = self.line_count + 1
+
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+
+            fields.info.add(';'.join(records))
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    engine.annotateFile(vcf, TfbsConsSitesStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    table = 'gadAll'
+    chromcol = 'chromosome'
+
+    def lookup(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chr = fields.chromBare
+        pos = fields.pos
+        return self.overlap(chr, pos)
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            records = []
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+            fields.info.add(';'.join(records))
+
+            # Annotated records have always been written out with a '\t '
+            # separator; keep the output identical
+            for i in range(1, len(fields)):
+                if (i != variants.INFO):
+                    fields[i] = ' ' + fields[i]
+            fields.info.prepend(' ')
+            if (len(fields) > variants.COLUMNS):
+                # The columns after INFO are kept as one string
+                fields[-1] = fields[-1].replace('\t', '\t ')
 
 
-"""Overlap with GadAll table
-"""
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    engine.annotateFile(vcf, GadAllStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    table = 'gwasCatalog'
+    startName = 'chromEnd'
+    endName = 'chromEnd'
+
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.overlap(chr, pos)
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            records = []
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            fields.info.add(';'.join(records))
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, GwasCatalogStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class HugoStage(OverlapStage):
+    table = 'hugo'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.overlap(chr, pos)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            records = []
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+            records_str = ','.join(records).replace(';', ',')
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+            fields.info.add(records_str)
 
-                    records_str = ','.join(records).replace(';', ',')
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, HugoStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class GenomicSuperDupsStage(OverlapStage):
+    table = 'genomicSuperDups'
+
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.firstOverlap(chr, pos)
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = row[7]
+            otherStart = row[8]
+            otherEnd = row[9]
+            fields.info.append(';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, GenomicSuperDupsStage(format=format,
+        table=table), tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1132,8 +1328,10 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    pool = u.db_pool()
+    conn = pool.acquire()
     cursor = conn.cursor()
+    backend = backends.backend(cursor)
     linenum = 1
 
     for line in fh:
@@ -1152,12 +1350,9 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
                 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = backend.overlap(table, chr, int(pos),
+                    startcol=startName, endcol=endName)
 
                 if (len(rows) > 0):
                     line_count = line_count + 1
@@ -1182,222 +1377,108 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    cursor.close()
+    pool.release(conn)
     fh.close()
     fh_out.close()
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class CytobandStage(OverlapStage):
+    table = 'cytoBand'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+    def __init__(self, format='vcf', table=None, indexed=None, sweep=None):
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+        if ((table or self.table) == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        OverlapStage.__init__(self, format=format, table=table,
+            indexed=indexed, sweep=sweep)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.overlap(chr, pos)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            overlapsWith = []
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+            fields.info.add(str(self.table) + '=' + str(cytoband))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, CytobandStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseStage(OverlapStage):
+    table = 'dgv_Cnv'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.firstOverlap(chr, pos)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            fields.info.add(str(self.table) + '=' + str(isOverlap))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, CnvDatabaseStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(OverlapStage):
+    table = 'targetScanS'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, fields):
+        chr = fields.chromPrefixed
+        pos = fields.pos
+        return self.firstOverlap(chr, pos)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            t = 'miRNAsites=' + t.strip()
+            fields.info.add(t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    engine.annotateFile(vcf, MiRNAStage(format=format, table=table),
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
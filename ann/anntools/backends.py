@@ -0,0 +1,510 @@
+# backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reference database backends
+#
+# The annotation stages look reference data up with three operations:
+# pointLookup() (rows whose key columns equal one of a set of keys),
+# overlap() (rows whose interval overlaps a position or range) and
+# cascade() (candidates from several tables at once, point matches in all
+# but the last and interval matches in the last). scan() reads whole
+# tables for the interval indexes, and stream() reads them a block at a
+# time for the sorted joins. Every operation returns its rows in a
+# defined order, with the table's primary key (rowid on SQLite) breaking
+# ties, so that a batched lookup and the per-variant one agree on the
+# order of the rows they both return. MySqlBackend runs them as SQL on
+# the annotator database; SqliteBackend runs them on a node-local SQLite
+# replica prepared with prepare(), answering overlaps from R*Tree indexes.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import sqlite3
+
+try:
+    import pymysql.cursors
+except ImportError:
+    pymysql = None
+
+# Backend used by backend(): 'mysql' or 'sqlite'
+REFERENCE_BACKEND = os.environ['ANNTOOLS_REFERENCE_BACKEND'] \
+    if ('ANNTOOLS_REFERENCE_BACKEND' in os.environ) else 'mysql'
+
+# SQLite replica used by utils.db_connect() with the sqlite backend
+REFERENCE_DB = os.environ['ANNTOOLS_REFERENCE_DB'] \
+    if ('ANNTOOLS_REFERENCE_DB' in os.environ) else None
+
+# Interval columns of the tables the stages query with overlap() or the
+# last tier of cascade(): (table, chromosome, start, end)
+RTREE_TABLES = [
+    ('chrom_pos_unequal', 'CHR', 'start', 'end'),
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd')] + \
+    [('tfbsConsSites' + c, 'chrom', 'chromStart', 'chromEnd') for c in
+    [str(i) for i in range(1, 23)] + ['X', 'Y']]
+
+# Key columns of the tables queried with pointLookup() or the first tiers
+# of cascade()
+POINT_TABLES = [
+    ('dbSNP', ['CHR', 'POS', 'REF']),
+    ('chrom_pos_equal_base', ['CHR', 'start']),
+    ('chrom_pos_equal_nobase', ['CHR', 'start'])]
+
+# Rows read from the server at a time by stream()
+STREAM_ROWS = 1000
+
+# Kinds of cascade() tiers
+POINT = 'point'
+INTERVAL = 'interval'
+
+# Columns ordering the rows of the MySQL tables already looked up, by table
+_rowOrders = {}
+
+
+"""Backend for the configured REFERENCE_BACKEND, running on cursor
+"""
+def backend(cursor):
+    if (REFERENCE_BACKEND == 'sqlite'):
+        return SqliteBackend(cursor)
+    if (REFERENCE_BACKEND != 'mysql'):
+        raise ValueError(f"Unknown reference backend {REFERENCE_BACKEND}")
+    return MySqlBackend(cursor)
+
+
+def placeholders(count, width=1):
+    row = '(' + ', '.join(['%s'] * width) + ')'
+    return ', '.join([row] * count)
+
+
+"""Reference lookups as SQL on the annotator MySQL database
+   Every operation is a single query. String comparisons are left to the
+   database, and so are case-insensitive.
+"""
+class MySqlBackend(object):
+    name = 'mysql'
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    """Columns of table that break ties between its rows: the primary key,
+       or every column if the table has none; rowid on SQLite
+    """
+    def rowOrder(self, table):
+        if (getattr(self.cursor, 'dialect', 'mysql') == 'sqlite'):
+            return ['rowid']
+        if table not in _rowOrders:
+            self.cursor.execute('select column_name from ' +
+                'information_schema.key_column_usage where table_schema = ' +
+                "database() and table_name = %s and constraint_name = " +
+                "'PRIMARY' order by ordinal_position;", (table,))
+            columns = [str(row[0]) for row in self.cursor.fetchall()]
+            if (len(columns) == 0):
+                self.cursor.execute('select column_name from ' +
+                    'information_schema.columns where table_schema = ' +
+                    'database() and table_name = %s order by ' +
+                    'ordinal_position;', (table,))
+                columns = [str(row[0]) for row in self.cursor.fetchall()]
+            _rowOrders[table] = columns
+        return _rowOrders[table]
+
+    """order by clause sorting on columns and then rowOrder(table), all
+       qualified with alias (default table)
+    """
+    def orderBy(self, table, columns=(), alias=None):
+        alias = alias or table
+        return ' order by ' + ', '.join([alias + '.' + c for c in
+            list(columns) + self.rowOrder(table)])
+
+    """Rows of table whose keycols equal one of keys, each preceded by its
+       keycols; where is a list of (column, value) pairs that must also
+       match. Rows are in primary key order, so the rows of any one key
+       come in the same order however many keys are looked up together.
+    """
+    def pointLookup(self, table, keycols, keys, where=()):
+        if (len(keys) == 0):
+            return []
+        conditions = [c + ' = %s' for c, value in where]
+        conditions.append('(' + ', '.join(keycols) + ') IN (' +
+            placeholders(len(keys), len(keycols)) + ')')
+        args = [value for c, value in where]
+        for key in keys:
+            args.extend(key)
+
+        sql = 'select ' + ', '.join(keycols) + ', ' + table + '.* from ' + \
+            table + ' where ' + ' AND '.join(conditions) + \
+            self.orderBy(table) + ';'
+        self.cursor.execute(sql, args)
+        return self.cursor.fetchall()
+
+    """Rows of table whose interval [startcol, endcol] overlaps [start, end]
+       (the position start if end is None) on chromosome chrom, by startcol
+       and then primary key; with chromcol None the table holds a single
+       chromosome. select limits the rows to the given columns; with first
+       set only the first row (or None) is returned.
+    """
+    def overlap(self, table, chrom, start, end=None, chromcol='chrom',
+        startcol='chromStart', endcol='chromEnd', select=None, first=False):
+
+        if (end is None):
+            end = start
+        sql = 'select ' + (', '.join(select) if select else '*') + \
+            ' from ' + table + ' where '
+        args = []
+        if (chromcol is not None):
+            sql = sql + chromcol + ' = %s AND '
+            args.append(str(chrom))
+        sql = sql + startcol + ' <= %s AND ' + endcol + ' >= %s' + \
+            self.orderBy(table, [startcol]) + ';'
+        args.extend([int(end), int(start)])
+
+        self.cursor.execute(sql, args)
+        if first:
+            return self.cursor.fetchone()
+        return self.cursor.fetchall()
+
+    """Candidates for a list of (chrom, pos) points from every table of
+       tiers, a list of (table, kind) pairs: POINT tables match on chromcol
+       and startcol, INTERVAL tables on startcol <= pos <= endcol. Rows are
+       (tier, chrom, pos, select columns, table.*), tier being the index of
+       the table in tiers and chrom and pos the point the row matched, so
+       that an interval containing several of the points comes once for
+       each; they are sorted by tier and then primary key. Picking the
+       first tier with a match is left to the caller.
+    """
+    def cascade(self, tiers, points, chromcol='CHR', startcol='start',
+        endcol='end', select=()):
+
+        if (len(points) == 0):
+            return []
+        width = max([len(self.rowOrder(table)) for table, kind in tiers])
+        selects = []
+        args = []
+        for tier, (table, kind) in enumerate(tiers):
+            sql, more = self.cascadeSelect(tier, table, kind, points,
+                chromcol, startcol, endcol, select, width)
+            selects.append(sql)
+            args.extend(more)
+
+        self.cursor.execute(' UNION ALL '.join(selects) + ';', args)
+        return sortCascade(self.cursor.fetchall(), width)
+
+    """One tier of cascade(), with the table's rowOrder() columns (padded
+       with nulls to width) after the point for sorting the rows
+       The points of an INTERVAL tier are joined as a derived table, so the
+       database looks every point up in the table's (chromcol, startcol)
+       index.
+    """
+    def cascadeSelect(self, tier, table, kind, points, chromcol, startcol,
+        endcol, select, width):
+        keys = ['t.' + c for c in self.rowOrder(table)]
+        columns = ', '.join(keys + ['null'] * (width - len(keys)) +
+            ['t.' + c for c in select] + ['t.*'])
+        args = []
+        for chrom, pos in points:
+            args.extend([chrom, pos])
+
+        if (kind == POINT):
+            return ('select ' + str(tier) + ', t.' + chromcol + ', t.' +
+                startcol + ', ' + columns + ' from ' + table + ' t where (t.' +
+                chromcol + ', t.' + startcol + ') IN (' +
+                placeholders(len(points), 2) + ')', args)
+        return ('select ' + str(tier) + ', p.chrom, p.pos, ' + columns +
+            ' from ' + table + ' t join (select %s as chrom, %s as pos' +
+            ' union all select %s, %s' * (len(points) - 1) + ') p on t.' +
+            chromcol + ' = p.chrom AND t.' + startcol + ' <= p.pos AND t.' +
+            endcol + ' >= p.pos', args)
+
+    """Column names and rows of columns of table, or of the rows of one
+       chromosome if chromcol is given, sorted on the columns of order and
+       then primary key
+    """
+    def scan(self, table, columns, chromcol=None, chrom=None, order=()):
+        self.scanOn(self.cursor, table, columns, chromcol, chrom, order)
+        names = [str(d[0]) for d in self.cursor.description]
+        return (names, self.cursor.fetchall())
+
+    """As scan(), but runs on cursor, an unbuffered cursor from
+       streamCursor(), and returns the rows as an iterator that reads them
+       from the server STREAM_ROWS at a time as it is advanced
+    """
+    def stream(self, cursor, table, columns, chromcol=None, chrom=None,
+        order=()):
+        self.scanOn(cursor, table, columns, chromcol, chrom, order)
+        names = [str(d[0]) for d in cursor.description]
+        return (names, fetchRows(cursor, STREAM_ROWS))
+
+    def scanOn(self, cursor, table, columns, chromcol, chrom, order):
+        sql = 'select ' + ', '.join(columns) + ' from ' + table
+        if (chromcol is None):
+            cursor.execute(sql + self.orderBy(table, order) + ';')
+        else:
+            cursor.execute(sql + ' where ' + chromcol + ' = %s' +
+                self.orderBy(table, order) + ';', (chrom,))
+
+
+"""Rows of cascade() by tier and primary key, without the key columns
+"""
+def sortCascade(rows, width):
+    rows = sorted(rows, key=lambda row: (row[0],) + tuple(row[3:3 + width]))
+    return [tuple(row[:3]) + tuple(row[3 + width:]) for row in rows]
+
+
+def fetchRows(cursor, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if (len(rows) == 0):
+            return
+        for row in rows:
+            yield row
+
+
+"""Cursor on conn that reads the rows of a query from the server as they
+   are fetched instead of all at once (pymysql's SSCursor); the
+   connection can run nothing else until the rows have been read or the
+   cursor is closed. SQLite cursors already step through their rows.
+"""
+def streamCursor(conn):
+    if isinstance(conn, SqliteConnection):
+        return conn.cursor()
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""Reference lookups on a SQLite replica of the annotator database
+   Tables listed in RTREE_TABLES get an R*Tree index over (chromosome
+   code, start, end) from prepare(); overlap() and the interval tier of
+   cascade() use it, returning rows in the same order as MySqlBackend. Everything else runs
+   as in MySqlBackend, on the point indexes prepare() creates.
+"""
+class SqliteBackend(MySqlBackend):
+    name = 'sqlite'
+
+    def __init__(self, cursor):
+        MySqlBackend.__init__(self, cursor)
+        self.rtrees = None
+        self.codes = None
+
+    def load(self):
+        self.rtrees = {}
+        self.codes = {}
+        self.cursor.execute("select name from sqlite_master where " +
+            "type = 'table' and name = 'reference_rtrees';")
+        if (self.cursor.fetchone() is None):
+            return
+        self.cursor.execute('select tbl, startcol, endcol, rtree ' +
+            'from reference_rtrees;')
+        for table, startcol, endcol, rtree in self.cursor.fetchall():
+            self.rtrees[(table, startcol, endcol)] = rtree
+        self.cursor.execute('select name, code from reference_chroms;')
+        self.codes = dict(self.cursor.fetchall())
+
+    def rtree(self, table, startcol, endcol):
+        if (self.rtrees is None):
+            self.load()
+        return self.rtrees.get((table, startcol, endcol))
+
+    """Looks every key up in the table's key index (see keyJoin())
+    """
+    def pointLookup(self, table, keycols, keys, where=()):
+        keys = list(dict.fromkeys([tuple(key) for key in keys]))
+        if (len(keys) == 0):
+            return []
+        sql, args = self.keyJoin(table, keycols, keys, where)
+        sql = 'select ' + ', '.join(['t.' + c for c in keycols]) + \
+            ', t.* ' + sql + self.orderBy(table, alias='t') + ';'
+        self.cursor.execute(sql, args)
+        return self.cursor.fetchall()
+
+    """From and where clauses (and their arguments) joining table t with
+       the distinct keys k as a values list: SQLite scans the whole table
+       for an IN list of row values, and the cross join makes it look
+       every key up instead of scanning the table for the keys
+    """
+    def keyJoin(self, table, keycols, keys, where=()):
+        conditions = ['t.' + c + ' = k.column' + str(i + 1)
+            for i, c in enumerate(keycols)]
+        conditions.extend(['t.' + c + ' = %s' for c, value in where])
+        args = []
+        for key in keys:
+            args.extend(key)
+        args.extend([value for c, value in where])
+        return ('from (values ' + placeholders(len(keys), len(keycols)) +
+            ') k cross join ' + table + ' t where ' +
+            ' AND '.join(conditions), args)
+
+    def overlap(self, table, chrom, start, end=None, chromcol='chrom',
+        startcol='chromStart', endcol='chromEnd', select=None, first=False):
+
+        rtree = self.rtree(table, startcol, endcol)
+        if (rtree is None):
+            return MySqlBackend.overlap(self, table, chrom, start, end=end,
+                chromcol=chromcol, startcol=startcol, endcol=endcol,
+                select=select, first=first)
+
+        if (end is None):
+            end = start
+        sql = 'select ' + (', '.join(['t.' + c for c in select]) if select
+            else 't.*') + ' from ' + rtree + ' r join ' + table + \
+            ' t on t.rowid = r.id where '
+        args = []
+        if (chromcol is not None):
+            code = self.codes.get(str(chrom).upper())
+            if (code is None):
+                return None if first else []
+            sql = sql + 'r.c0 <= %s AND r.c1 >= %s AND '
+            args.extend([code, code])
+        sql = sql + 'r.s <= %s AND r.e >= %s' + \
+            self.orderBy(table, [startcol], alias='t') + ';'
+        args.extend([int(end), int(start)])
+
+        self.cursor.execute(sql, args)
+        if first:
+            return self.cursor.fetchone()
+        return self.cursor.fetchall()
+
+    """Runs every tier as a query of its own, the point tiers as joins
+       with the key index (see keyJoin()) and the interval tiers as R*Tree
+       joins with the points
+    """
+    def cascade(self, tiers, points, chromcol='CHR', startcol='start',
+        endcol='end', select=()):
+
+        if (len(points) == 0):
+            return []
+        rows = []
+        for tier, (table, kind) in enumerate(tiers):
+            rtree = self.rtree(table, startcol, endcol)
+            if (kind == POINT):
+                sql, args = self.keyJoin(table, [chromcol, startcol],
+                    list(dict.fromkeys(points)))
+                sql = 'select ' + ', '.join([str(tier), 't.' + chromcol,
+                    't.' + startcol, 't.rowid'] + ['t.' + c for c in
+                    select]) + ', t.* ' + sql
+            elif (rtree is None):
+                sql, args = self.cascadeSelect(tier, table, kind, points,
+                    chromcol, startcol, endcol, select, 1)
+            else:
+                coded = [(self.codes[str(chrom).upper()], pos, chrom)
+                    for chrom, pos in points
+                    if (str(chrom).upper() in self.codes)]
+                if (len(coded) == 0):
+                    continue
+                sql = 'select ' + ', '.join([str(tier), 'p.column3',
+                    'p.column2', 't.rowid'] + ['t.' + c for c in select]) + \
+                    ', t.* from (values ' + placeholders(len(coded), 3) + \
+                    ') p join ' + rtree + ' r on r.c0 <= p.column1 AND ' + \
+                    'r.c1 >= p.column1 AND r.s <= p.column2 AND ' + \
+                    'r.e >= p.column2 join ' + table + ' t on t.rowid = r.id'
+                args = []
+                for code, pos, chrom in coded:
+                    args.extend([code, pos, chrom])
+            self.cursor.execute(sql + ';', args)
+            rows.extend(self.cursor.fetchall())
+        return sortCascade(rows, 1)
+
+
+"""DB-API cursor on a SQLite database taking the MySQL %s placeholders
+"""
+class SqliteCursor(object):
+    dialect = 'sqlite'
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, args=None):
+        if (args is None):
+            return self.cursor.execute(sql)
+        return self.cursor.execute(sql.replace('%s', '?'), args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Connection to a SQLite replica with the part of the pymysql interface
+   the annotator uses; it may be used from any thread
+"""
+class SqliteConnection(object):
+
+    def __init__(self, path, uri=False):
+        self.conn = sqlite3.connect(path, uri=uri, check_same_thread=False)
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def tableExists(conn, table):
+    return (conn.execute("select name from sqlite_master where " +
+        "type = 'table' and name = ?;", (table,)).fetchone() is not None)
+
+
+"""Add the R*Tree and point indexes SqliteBackend uses to the SQLite
+   replica conn (a sqlite3 connection); tables the replica does not have
+   are skipped. Rows whose interval ends before it starts can never match
+   and are left out of the R*Trees.
+"""
+def prepare(conn, verbose=False):
+    conn.execute('drop table if exists reference_rtrees;')
+    conn.execute('create table reference_rtrees (tbl text, chromcol text, ' +
+        'startcol text, endcol text, rtree text);')
+    conn.execute('create table if not exists reference_chroms ' +
+        '(code integer primary key, name text unique);')
+
+    for table, chromcol, startcol, endcol in RTREE_TABLES:
+        if not tableExists(conn, table):
+            continue
+        rtree = table + '_rtree'
+        conn.execute('insert or ignore into reference_chroms (name) ' +
+            'select distinct upper(' + chromcol + ') from ' + table +
+            ' where ' + chromcol + ' is not null;')
+        conn.execute('drop table if exists ' + rtree + ';')
+        conn.execute('create virtual table ' + rtree + ' using ' +
+            'rtree_i32(id, c0, c1, s, e);')
+        conn.execute('insert into ' + rtree + ' select t.rowid, c.code, ' +
+            'c.code, t.' + startcol + ', t.' + endcol + ' from ' + table +
+            ' t join reference_chroms c on c.name = upper(t.' + chromcol +
+            ') where t.' + startcol + ' <= t.' + endcol + ';')
+        conn.execute('insert into reference_rtrees values (?, ?, ?, ?, ?);',
+            (table, chromcol, startcol, endcol, rtree))
+        conn.execute('create index if not exists ' + table + '_chrom on ' +
+            table + ' (' + chromcol + ');')
+        if verbose:
+            print(f"{table}: R*Tree index {rtree}")
+
+    for table, keycols in POINT_TABLES:
+        if tableExists(conn, table):
+            conn.execute('create index if not exists ' + table + '_key on ' +
+                table + ' (' + ', '.join(keycols) + ');')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        conn = sqlite3.connect(sys.argv[1])
+        prepare(conn, verbose=True)
+        conn.close()
+    else:
+        print("Usage: python backends.py <sqlite replica>")
+
+### EOF
@@ -0,0 +1,35 @@
+# benchmark/__init__.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Offline AnnTools benchmarks: synthetic VCF files (vcfgen), a SQLite
+# stand-in for the annotator reference database (refdb) and a runner that
+# times the stages and the whole driver against stored baselines (runner)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+# The AnnTools modules import each other by their plain names
+ANNTOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ANNTOOLS_DIR not in sys.path:
+    sys.path.insert(0, ANNTOOLS_DIR)
+
+# hg19 chromosome lengths; the synthetic VCFs and reference tables both
+# place their positions on these
+CHROM_LENGTHS = [
+    ('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276),
+    ('5', 180915260), ('6', 171115067), ('7', 159138663), ('8', 146364022),
+    ('9', 141213431), ('10', 135534747), ('11', 135006516),
+    ('12', 133851895), ('13', 115169878), ('14', 107349540),
+    ('15', 102531392), ('16', 90354753), ('17', 81195210), ('18', 78077248),
+    ('19', 59128983), ('20', 63025520), ('21', 48129895), ('22', 51304566),
+    ('X', 155270560), ('Y', 59373566)]
+
+# Length of MT, also used for any chromosome not in CHROM_LENGTHS
+MT_LENGTH = 16569
+
+### EOF
@@ -0,0 +1,348 @@
+# refdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# SQLite stand-in for the annotator reference database
+#
+# The tables have the columns the annotation stages read, filled with
+# random intervals at a fraction (scale) of the size of the real tables.
+# Positions of a VCF file can be planted in dbSNP and the BigRefGene
+# tables so that a benchmark input finds about as many hits as a real
+# one. connector() returns a replacement for utils.db_connect. The
+# database is also prepared for the sqlite reference backend (see
+# backends.prepare()).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import random
+import argparse
+from benchmark import CHROM_LENGTHS
+import vcfio
+import backends
+
+# Shared in-memory database used when the path is ':memory:'; it lives as
+# long as a connection to it is open
+MEMORY_URI = 'file:anntools-benchmark?mode=memory&cache=shared'
+
+REFSEQ_COLUMNS = ['id', 'CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+BIGREFGENE_TABLES = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+    'chrom_pos_unequal']
+
+# Reference tables: columns, chromosome column and whether it has the
+# 'chr' prefix, rows in the real (hg19) table and mean interval length
+TABLES = [
+    ('dbSNP', ['CHR', 'POS', 'SRC', 'RSID', 'REF', 'ALT', 'QUAL', 'GMAF',
+        'INFO'], 'CHR', False, 150000000, 1),
+    ('chrom_pos_equal_base', REFSEQ_COLUMNS, 'CHR', False, 30000000, 1),
+    ('chrom_pos_equal_nobase', REFSEQ_COLUMNS, 'CHR', False, 10000000, 1),
+    ('chrom_pos_unequal', REFSEQ_COLUMNS, 'CHR', False, 5000000, 10),
+    ('refGene', ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd',
+        'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds',
+        'score', 'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames'],
+        'chrom', True, 70000, 60000),
+    ('cpgIslandExt', ['chrom', 'chromStart', 'chromEnd', 'name'],
+        'chrom', True, 28691, 750),
+    ('cytoBand', ['chrom', 'chromStart', 'chromEnd', 'name', 'gieStain'],
+        'chrom', True, 862, 0),
+    ('gadAll', ['id', 'chromosome', 'chromStart', 'geneSymbol', 'chromEnd'],
+        'chromosome', False, 170000, 30000),
+    ('gwasCatalog', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'pubMedID', 'author', 'pubDate', 'journal', 'title', 'trait'],
+        'chrom', True, 100000, 1),
+    ('targetScanS', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'score', 'strand'], 'chrom', True, 40000, 8),
+    ('hugo', ['id', 'chrom', 'chromStart', 'chromEnd', 'symbol', 'hname',
+        'locus'], 'chrom', True, 40000, 30000),
+    ('dgv_Cnv', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+        'chrom', True, 200000, 20000),
+    ('abParts_IG_T_CelReceptors', ['bin', 'chrom', 'chromStart',
+        'chromEnd', 'name'], 'chrom', True, 500, 100000),
+    ('mcCarroll_Cnv', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+        'chrom', True, 1300, 20000),
+    ('conrad_Cnv', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+        'chrom', True, 9000, 20000),
+    ('genomicSuperDups', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'score', 'strand', 'otherChrom', 'otherStart', 'otherEnd'],
+        'chrom', True, 51000, 20000)] + \
+    [('tfbsConsSites' + c, ['bin', 'chrom', 'chromStart', 'chromEnd',
+        'name', 'score'], 'chrom', True, 3800000, 15)
+        for c, length in CHROM_LENGTHS]
+
+# Columns holding positions, for the column types and the indexes
+INTEGER_COLUMNS = set(['POS', 'start', 'end', 'txStart', 'txEnd',
+    'cdsStart', 'cdsEnd', 'exonCount', 'chromStart', 'chromEnd',
+    'otherStart', 'otherEnd'])
+START_COLUMNS = ['POS', 'start', 'txStart', 'chromStart']
+
+GENOME_LENGTH = sum([length for c, length in CHROM_LENGTHS])
+
+BASES = 'ACGT'
+COMPLEMENT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+
+def connect(path):
+    if (path == ':memory:'):
+        return backends.SqliteConnection(MEMORY_URI, uri=True)
+    return backends.SqliteConnection(path)
+
+
+"""Replacement for utils.db_connect connecting to the stand-in at path
+"""
+def connector(path):
+    return lambda: connect(path)
+
+
+def tableRows(real, scale):
+    return max(1, int(round(real * scale)))
+
+
+def chromName(chrom, prefixed):
+    return ('chr' + chrom) if prefixed else chrom
+
+
+"""Random (chrom, start, end) intervals over the genome, spread by
+   chromosome length; chrom is the name without the 'chr' prefix
+"""
+def randomIntervals(rng, count, mean, chroms=CHROM_LENGTHS):
+    total = sum([length for c, length in chroms])
+    for i in range(count):
+        offset = rng.randrange(total)
+        for chrom, length in chroms:
+            if (offset < length):
+                break
+            offset = offset - length
+        size = max(0, int(rng.expovariate(1.0 / mean))) if (mean > 1) \
+            else mean
+        start = offset + 1
+        yield (chrom, start, min(length, start + size))
+
+
+def refseqRow(rng, id, chrom, start, end, ref, alt):
+    return [id, chrom, start, end, ref, alt, 'NM_' + str(id),
+        'GENE' + str(id % 977), rng.choice('+-'),
+        rng.choice(['CDS', 'intron', 'utr3', 'utr5', 'non_coding_exon',
+            'non_coding_intron']), rng.choice(['0', '1', '2']),
+        str(rng.randint(0, 9000)), str(rng.randint(0, 3000)), '0', 'ACG',
+        'T', 'ACA', 'T', rng.choice(['Y', 'N']),
+        rng.choice(['missense', 'silent', 'nonsense']), 'c.1A>G', 'p.T1T',
+        rng.choice(['true', 'false']), '', '0']
+
+
+def transcriptRow(rng, id, chrom, start, end):
+    exons = max(1, min(40, int(rng.expovariate(1.0 / 9))))
+    exons = min(exons, max(1, (end - start) // 2))
+    bounds = sorted(rng.sample(range(start, max(end, start + 2 * exons)),
+        2 * exons))
+    if (rng.random() < 0.2):
+        cdsStart = cdsEnd = end
+    else:
+        cdsStart = min(end, start + rng.randint(0, 2000))
+        cdsEnd = max(cdsStart, end - rng.randint(0, 2000))
+    return [0, 'NM_' + str(id), chromName(chrom, True), rng.choice('+-'),
+        start, end, cdsStart, cdsEnd, exons,
+        (','.join([str(b) for b in bounds[0::2]]) + ',').encode(),
+        (','.join([str(b) for b in bounds[1::2]]) + ',').encode(), 0,
+        'GENE' + str(id % 977), 'cmpl', 'cmpl', '']
+
+
+"""One random row of table, for the interval chrom:start-end
+"""
+def tableRow(rng, table, id, chrom, start, end):
+    ref = rng.choice(BASES)
+    if (table == 'dbSNP'):
+        return [chrom, start, 'dbSNP', 'rs' + str(id), ref,
+            rng.choice([b for b in BASES if (b != ref)]), '.',
+            rng.choice(['.', '0.01', '0.12', '0.3']), 'SNV']
+    if (table == 'chrom_pos_equal_base'):
+        return refseqRow(rng, id, chrom, start, start, ref,
+            rng.choice([b for b in BASES if (b != ref)]))
+    if table in BIGREFGENE_TABLES:
+        return refseqRow(rng, id, chrom, start, end, 'N', 'N')
+    if (table == 'refGene'):
+        return transcriptRow(rng, id, chrom, start, end)
+    if (table == 'cpgIslandExt'):
+        return [chromName(chrom, True), start, end,
+            'CpG: ' + str(rng.randint(10, 300))]
+    if (table == 'gadAll'):
+        return [id, chrom, start, 'GENE' + str(id % 977), end]
+    if (table == 'gwasCatalog'):
+        return [0, chromName(chrom, True), start - 1, start,
+            'rs' + str(id), str(rng.randint(10000000, 29999999)), 'Author',
+            '2010-01-01', 'Journal', 'Title', rng.choice(['Height',
+            'Body mass index', 'LDL cholesterol', 'Type 2 diabetes'])]
+    if (table == 'targetScanS'):
+        return [0, chromName(chrom, True), start, end,
+            'GENE' + str(id % 977) + ':miR-' + str(id % 300),
+            rng.randint(50, 100), rng.choice('+-')]
+    if (table == 'hugo'):
+        return [id, chromName(chrom, True), start, end,
+            'GENE' + str(id % 977), rng.choice(['kinase', 'receptor',
+            'zinc finger protein']), rng.choice(['gene with protein product',
+            'pseudogene', 'RNA, long non-coding'])]
+    if (table == 'genomicSuperDups'):
+        other = rng.choice(CHROM_LENGTHS)
+        otherStart = rng.randint(1, other[1] - (end - start) - 1)
+        return [0, chromName(chrom, True), start, end,
+            chromName(other[0], True) + ':' + str(otherStart),
+            round(rng.random(), 4), rng.choice('+-'),
+            chromName(other[0], True), otherStart,
+            otherStart + end - start]
+    if table.startswith('tfbsConsSites'):
+        return [0, chromName(chrom, True), start, end,
+            'V$TF' + str(id % 400), rng.randint(700, 1000)]
+    return [0, chromName(chrom, True), start, end, 'cnv' + str(id)]
+
+
+def createTable(conn, table, columns):
+    conn.execute('drop table if exists ' + table)
+    conn.execute('create table ' + table + ' (' + ', '.join([c +
+        (' integer' if c in INTEGER_COLUMNS else '') for c in columns]) + ')')
+
+
+def createIndex(conn, table, columns, chromcol):
+    start = [c for c in START_COLUMNS if c in columns][0]
+    conn.execute('create index ' + table + '_pos on ' + table + ' (' +
+        chromcol + ', ' + start + ')')
+
+
+def insertRows(conn, table, columns, rows):
+    sql = 'insert into ' + table + ' values (' + \
+        ', '.join(['?'] * len(columns)) + ')'
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if (len(chunk) >= 10000):
+            conn.executemany(sql, chunk)
+            chunk = []
+    conn.executemany(sql, chunk)
+
+
+"""cytoBand tiles every chromosome with bands of about equal length
+"""
+def cytoBands(count):
+    for chrom, length in CHROM_LENGTHS:
+        bands = max(1, int(round(count * length / GENOME_LENGTH)))
+        size = -(-length // bands)
+        for b in range(bands):
+            arm = 'p' if (b < bands // 2) else 'q'
+            yield ['chr' + chrom, b * size, min(length, (b + 1) * size),
+                arm + str(11 + b % 30) + '.' + str(1 + b % 3),
+                ['gneg', 'gpos25', 'gpos50', 'gpos75', 'gpos100'][b % 5]]
+
+
+def fillTable(conn, rng, table, columns, real, mean, scale):
+    if (table == 'cytoBand'):
+        insertRows(conn, table, columns, cytoBands(real))
+        return real
+
+    chroms = CHROM_LENGTHS
+    if table.startswith('tfbsConsSites'):
+        chrom = table[len('tfbsConsSites'):]
+        chroms = [(c, length) for c, length in CHROM_LENGTHS
+            if (c == chrom)]
+        real = real * chroms[0][1] // GENOME_LENGTH
+
+    count = tableRows(real, scale)
+    insertRows(conn, table, columns,
+        (tableRow(rng, table, i + 1, chrom, start, end) for i,
+        (chrom, start, end) in enumerate(randomIntervals(rng, count, mean,
+        chroms=chroms))))
+    return count
+
+
+"""Add dbSNP and BigRefGene rows at the positions of the records of vcf,
+   each with probability rate, so that it finds hits in those tables as a
+   real input would
+"""
+def plant(conn, vcf, rate=0.4, seed=0):
+    rng = random.Random(seed)
+    dbsnp = []
+    refseq = dict([(t, []) for t in BIGREFGENE_TABLES])
+    fh = vcfio.openInput(vcf)
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        chrom = fields[0][3:] if fields[0].startswith('chr') else fields[0]
+        pos = int(fields[1])
+        ref = fields[3].upper()
+        alt = fields[4].split(',')[0].upper()
+        id = 900000000 + len(dbsnp)
+        if (rng.random() < rate):
+            if (rng.random() < 0.2):
+                ref = ''.join([COMPLEMENT.get(b, b) for b in ref])
+            dbsnp.append([chrom, pos, 'dbSNP', 'rs' + str(id), ref, alt, '.',
+                rng.choice(['.', '0.01', '0.3']), 'SNV'])
+        x = rng.random()
+        if (x < rate * 0.6):
+            refseq['chrom_pos_equal_base'].append(refseqRow(rng, id, chrom,
+                pos, pos, ref, alt))
+        elif (x < rate):
+            refseq['chrom_pos_unequal'].append(refseqRow(rng, id, chrom,
+                pos - 5, pos + 5, 'N', 'N'))
+    fh.close()
+
+    columns = dict([(t[0], t[1]) for t in TABLES])
+    insertRows(conn, 'dbSNP', columns['dbSNP'], dbsnp)
+    for table, rows in refseq.items():
+        insertRows(conn, table, REFSEQ_COLUMNS, rows)
+    conn.commit()
+    return len(dbsnp) + sum([len(rows) for rows in refseq.values()])
+
+
+"""Build the stand-in at path (':memory:' for a shared in-memory database)
+   Every table gets scale times the rows of the real one (cytoBand is
+   always complete). Returns an open connection, which keeps an in-memory
+   database alive.
+"""
+def build(path, scale=0.001, seed=0, vcf=None, rate=0.4, verbose=True):
+    if (path != ':memory:') and os.path.exists(path):
+        os.unlink(path)
+    conn = connect(path).conn
+    rng = random.Random(seed)
+    for table, columns, chromcol, prefixed, real, mean in TABLES:
+        createTable(conn, table, columns)
+        count = fillTable(conn, rng, table, columns, real, mean, scale)
+        if verbose:
+            print(f"{table}: {str(count)} rows")
+    conn.commit()
+
+    if (vcf is not None):
+        count = plant(conn, vcf, rate=rate, seed=seed)
+        if verbose:
+            print(f"Planted {str(count)} rows at the positions of {vcf}")
+
+    for table, columns, chromcol, prefixed, real, mean in TABLES:
+        createIndex(conn, table, columns, chromcol)
+    backends.prepare(conn)
+    return conn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build a SQLite stand-in for the reference database')
+    parser.add_argument('path')
+    parser.add_argument('--scale', type=float, default=0.001,
+        help='fraction of the rows of the real tables (default: 0.001)')
+    parser.add_argument('--vcf', default=None,
+        help='plant dbSNP and BigRefGene rows at the positions of this file')
+    parser.add_argument('--rate', type=float, default=0.4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    build(args.path, scale=args.scale, seed=args.seed, vcf=args.vcf,
+        rate=args.rate).close()
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,239 @@
+# runner.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Times every annotation stage and the whole driver against the reference
+# database stand-in and compares the throughput with stored baselines
+#
+# Usage, from the anntools directory:
+#   python -m benchmark.runner --variants 20000 --scale 0.001
+#   python -m benchmark.runner --variants 20000 --scale 0.001 --save
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from benchmark import vcfgen, refdb
+import utils as u
+import engine
+import driver
+import backends
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'baselines.json')
+
+# Throughput below (1 - TOLERANCE) times the baseline is a regression
+TOLERANCE = 0.2
+
+
+"""Run target(*args) in a forked process of its own, so that every
+   measurement starts with cold caches and has a peak RSS of its own;
+   returns (wall seconds, peak RSS in MB, result)
+"""
+def measure(target, *args):
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(processes=1) as pool:
+        return pool.apply(measured, (target,) + args)
+
+
+def measured(target, *args):
+    started = time.perf_counter()
+    result = target(*args)
+    secs = time.perf_counter() - started
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return (secs, rss, result)
+
+
+"""Annotate vcf with stage i of driver.stages() alone, on one thread
+"""
+def runStage(vcf, outfile, i):
+    stage = driver.stages(format='vcf')[i]
+    return engine.annotate(vcf, outfile, [stage], threads=1)
+
+
+"""Annotate a copy of vcf with driver.run(); returns its stats report
+"""
+def runDriver(vcf, directory, processes):
+    infile = os.path.join(directory, 'driver.vcf')
+    shutil.copy(vcf, infile)
+    driver.run(infile, 'vcf', processes=processes)
+    with open(driver.outputNames(infile)[2]) as fh:
+        return json.load(fh)
+
+
+def entry(secs, rss, records, stats=None):
+    out = {'secs': round(secs, 4), 'records': records,
+        'variants_per_sec': round(records / secs, 1) if (secs > 0) else None,
+        'peak_rss_mb': round(rss, 1)}
+    if (stats is not None):
+        out['queries'] = stats['queries']
+        out['rows'] = stats['rows']
+    return out
+
+
+"""Time every stage on its own and then the whole driver over vcf, with
+   the reference database at db queried through backend
+"""
+def benchmark(vcf, db, processes=1, stages=True, backend='mysql'):
+    u.db_connect = refdb.connector(db)
+    backends.REFERENCE_BACKEND = backend
+    directory = tempfile.mkdtemp(prefix='benchmark.')
+    results = {'stages': {}}
+    try:
+        if stages:
+            names = [stage.name for stage in driver.stages(format='vcf')]
+            for i, name in enumerate(names):
+                secs, rss, report = measure(runStage, vcf,
+                    os.path.join(directory, 'stage' + str(i) + '.vcf'), i)
+                results['stages'][name] = entry(secs, rss,
+                    report['records'], stats=report['stages'][0])
+                print(f"{name}: {results['stages'][name]['secs']} s")
+
+        secs, rss, report = measure(runDriver, vcf, directory, processes)
+        results['driver'] = entry(secs, rss, report['records'])
+        results['driver']['stages'] = dict([(s['name'], s['wall_secs'])
+            for s in report['stages']])
+        print(f"driver.run: {results['driver']['secs']} s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+"""Compare results with a baseline; returns the lines of the comparison
+   and the names of the measurements slower than the baseline by more
+   than tolerance
+"""
+def compare(results, baseline, tolerance=TOLERANCE):
+    lines = []
+    regressions = []
+    current = [(name, results['stages'][name])
+        for name in results['stages']] + [('driver.run', results['driver'])]
+    known = dict(baseline.get('stages', {}))
+    if ('driver' in baseline):
+        known['driver.run'] = baseline['driver']
+
+    for name, now in current:
+        then = known.get(name)
+        if (then is None) or not then.get('variants_per_sec') or \
+            not now.get('variants_per_sec'):
+            lines.append(f"{name:28} {now['variants_per_sec']:>12} v/s" +
+                "   (no baseline)")
+            continue
+        ratio = now['variants_per_sec'] / then['variants_per_sec']
+        flag = ''
+        if (ratio < 1 - tolerance):
+            flag = '  REGRESSION'
+            regressions.append(name)
+        lines.append(f"{name:28} {now['variants_per_sec']:>12} v/s" +
+            f"   baseline {then['variants_per_sec']:>12} v/s" +
+            f"   x{ratio:.2f}{flag}")
+    return lines, regressions
+
+
+def loadBaselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def saveBaseline(path, name, results):
+    baselines = loadBaselines(path)
+    baselines[name] = results
+    with open(path, 'w') as fh:
+        json.dump(baselines, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark AnnTools ' +
+        'against a SQLite stand-in for the reference database')
+    parser.add_argument('--vcf', default=None,
+        help='input file (default: a synthetic one, see the options below)')
+    parser.add_argument('--variants', type=int, default=20000)
+    parser.add_argument('--chroms', default=None)
+    parser.add_argument('--unsorted', action='store_true')
+    parser.add_argument('--samples', type=int, default=0)
+    parser.add_argument('--db', default=None,
+        help='existing stand-in to use (default: build one)')
+    parser.add_argument('--scale', type=float, default=0.001)
+    parser.add_argument('--rate', type=float, default=0.4,
+        help='fraction of records planted in dbSNP and BigRefGene')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--backend', default='mysql',
+        choices=['mysql', 'sqlite'],
+        help='reference backend: the MySQL queries or the SQLite R*Trees')
+    parser.add_argument('--no-stages', action='store_true',
+        help='only time driver.run')
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--name', default=None,
+        help='baseline to compare with or save (default: from the options)')
+    parser.add_argument('--save', action='store_true',
+        help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--output', default=None,
+        help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    name = args.name
+    if (name is None):
+        name = os.path.basename(args.vcf) if args.vcf else \
+            'synthetic-' + str(args.variants) + \
+            ('-unsorted' if args.unsorted else '') + \
+            ('-samples' + str(args.samples) if args.samples else '')
+        name = name + '-scale' + str(args.scale) + \
+            '-p' + str(args.processes) + '-' + args.backend
+
+    directory = tempfile.mkdtemp(prefix='benchmark.')
+    try:
+        vcf = args.vcf
+        if (vcf is None):
+            vcf = os.path.join(directory, 'input.vcf')
+            vcfgen.generate(vcf, args.variants, chroms=args.chroms,
+                ordered=not args.unsorted, samples=args.samples,
+                seed=args.seed)
+        db = args.db
+        if (db is None):
+            db = os.path.join(directory, 'reference.db')
+            refdb.build(db, scale=args.scale, seed=args.seed, vcf=vcf,
+                rate=args.rate, verbose=False).close()
+
+        results = benchmark(vcf, db, processes=args.processes,
+            stages=not args.no_stages, backend=args.backend)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    baseline = loadBaselines(args.baselines).get(name)
+    print(f"\n{name}")
+    if (baseline is None):
+        print(f"No baseline for {name} in {args.baselines}")
+        baseline = {}
+    lines, regressions = compare(results, baseline,
+        tolerance=args.tolerance)
+    print('\n'.join(lines))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+            fh.write('\n')
+    if args.save:
+        saveBaseline(args.baselines, name, results)
+        print(f"Saved as the {name} baseline")
+    elif (len(regressions) > 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
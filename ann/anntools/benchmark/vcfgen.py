@@ -0,0 +1,148 @@
+# vcfgen.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Synthetic VCF files for benchmarking
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+import argparse
+import collections
+from benchmark import CHROM_LENGTHS, MT_LENGTH
+import vcfio
+
+BASES = 'ACGT'
+
+HEADER = [
+    '##fileformat=VCFv4.1',
+    '##source=anntools-benchmark',
+    '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in ' +
+        'genotypes">',
+    '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of ' +
+        'alleles in called genotypes">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">']
+
+
+"""Chromosome weights from a spec such as '1:3,2:1,X:0.5'; chromosomes
+   not named get no variants. None weights every chromosome by its length.
+"""
+def chromWeights(spec=None):
+    if not spec:
+        return [(c, float(length)) for c, length in CHROM_LENGTHS]
+    weights = []
+    for item in spec.split(','):
+        chrom, weight = item.split(':') if (':' in item) else (item, 1)
+        weights.append((chrom.strip(), float(weight)))
+    return weights
+
+
+def genotype(rng, alts):
+    a = rng.randint(0, alts)
+    b = rng.randint(0, alts)
+    return str(min(a, b)) + '/' + str(max(a, b)) + ':' + \
+        str(rng.randint(2, 80))
+
+
+"""One synthetic record (as a list of fields) at chrom:pos
+   Mostly SNVs, with some short insertions, deletions and multi-allelic
+   sites, as in the sample files.
+"""
+def record(rng, chrom, pos, samples):
+    ref = rng.choice(BASES)
+    kind = rng.random()
+    if (kind < 0.08):
+        alt = ref + ''.join([rng.choice(BASES)
+            for i in range(rng.randint(1, 4))])
+    elif (kind < 0.16):
+        ref = ref + ''.join([rng.choice(BASES)
+            for i in range(rng.randint(1, 4))])
+        alt = ref[0]
+    else:
+        alt = rng.choice([b for b in BASES if (b != ref)])
+        if (kind > 0.97):
+            alt = alt + ',' + rng.choice([b for b in BASES
+                if (b != ref) and (b != alt)])
+
+    alts = alt.count(',') + 1
+    an = 2 * max(samples, 1)
+    ac = ','.join([str(rng.randint(1, an)) for i in range(alts)])
+    info = 'AC=' + ac + ';AN=' + str(an) + ';DP=' + str(rng.randint(10, 400))
+    fields = [chrom, str(pos), '.', ref, alt,
+        '%.2f' % (rng.random() * 1000), 'PASS', info]
+    if (samples > 0):
+        fields.append('GT:DP')
+        fields.extend([genotype(rng, alts) for i in range(samples)])
+    return fields
+
+
+"""Write a synthetic VCF file with variants records
+   Records are spread over the chromosomes by chroms (see chromWeights()).
+   With ordered set they are in chromosome and position order, as callers
+   write them; otherwise they are shuffled. samples adds that many
+   genotype columns. Names ending in .gz are written bgzip compressed.
+   Returns the number of records written.
+"""
+def generate(path, variants, chroms=None, ordered=True, samples=0, seed=0):
+    rng = random.Random(seed)
+    weights = chromWeights(chroms)
+    lengths = dict(CHROM_LENGTHS)
+    order = [c for c, w in weights]
+    picks = collections.Counter(rng.choices(order,
+        weights=[w for c, w in weights], k=variants))
+
+    positions = []
+    for chrom in order:
+        count = picks[chrom]
+        length = lengths.get(chrom, MT_LENGTH)
+        chosen = set()
+        while (len(chosen) < min(count, length)):
+            chosen.add(rng.randint(1, length))
+        positions.extend([(chrom, pos) for pos in sorted(chosen)])
+    if not ordered:
+        rng.shuffle(positions)
+
+    header = list(HEADER)
+    header.extend(['##contig=<ID=' + c + ',length=' +
+        str(lengths.get(c, MT_LENGTH)) + '>' for c in order])
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+    if (samples > 0):
+        columns.append('FORMAT')
+        columns.extend(['S' + str(i + 1) for i in range(samples)])
+    header.append('\t'.join(columns))
+
+    with vcfio.openOutput(path) as fh:
+        fh.write('\n'.join(header) + '\n')
+        lines = []
+        for chrom, pos in positions:
+            lines.append('\t'.join(record(rng, chrom, pos, samples)) + '\n')
+            if (len(lines) >= 10000):
+                fh.writeRecords(lines)
+                lines = []
+        fh.writeRecords(lines)
+    return len(positions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic VCF file')
+    parser.add_argument('path')
+    parser.add_argument('--variants', type=int, default=100000)
+    parser.add_argument('--chroms', default=None,
+        help="chromosome weights, e.g. '1:3,2:1,X:0.5' (default: by length)")
+    parser.add_argument('--unsorted', action='store_true')
+    parser.add_argument('--samples', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    count = generate(args.path, args.variants, chroms=args.chroms,
+        ordered=not args.unsorted, samples=args.samples, seed=args.seed)
+    print(f"Wrote {str(count)} records to {args.path}")
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -14,108 +14,104 @@ import sys
 import os
 import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import engine
+import vcfio
+
+# Worker processes per job; with more than one the input is sharded by
+# chromosome and the shards are annotated in parallel. Every process opens
+# up to ANNTOOLS_STAGE_THREADS (default 4) reference DB connections for its
+# stage threads plus one for each of the 11 stages that stream a table
+# (see engine.annotate()), so a job holds up to 15 connections per process
+PROCESSES = int(os.environ['ANNTOOLS_PROCESSES']) \
+    if ('ANNTOOLS_PROCESSES' in os.environ) else 1
+
+# Write the annotated file bgzip compressed, as .annot.vcf.gz
+COMPRESS_OUTPUT = fu.str2bool(os.environ['ANNTOOLS_COMPRESS_OUTPUT']) \
+    if ('ANNTOOLS_COMPRESS_OUTPUT' in os.environ) else False
+
+# Write a coordinate index next to the annotated file (.tbi when it is
+# compressed, .idx otherwise)
+INDEX_OUTPUT = fu.str2bool(os.environ['ANNTOOLS_INDEX_OUTPUT']) \
+    if ('ANNTOOLS_INDEX_OUTPUT' in os.environ) else True
+
+"""Annotation stages, in the order their results are added to INFO
+"""
+def stages(format='vcf'):
+    return [
+        ann.DbSnpStage(format=format),
+        ann.BigRefGeneStage(format=format),
+        ann.GenesStage(format=format, table='refGene', promoter_offset=500),
+        ann.CytobandStage(format=format, table='cytoBand'),
+        ann.GadAllStage(format=format, table='gadAll'),
+        ann.GwasCatalogStage(format=format, table='gwasCatalog'),
+        ann.MiRNAStage(format=format, table='targetScanS'),
+        ann.HugoStage(format=format, table='hugo'),
+        ann.CnvDatabaseStage(format=format, table='dgv_Cnv'),
+        ann.CnvDatabaseStage(format=format, table='abParts_IG_T_CelReceptors'),
+        ann.CnvDatabaseStage(format=format, table='mcCarroll_Cnv'),
+        ann.CnvDatabaseStage(format=format, table='conrad_Cnv'),
+        ann.GenomicSuperDupsStage(format=format, table='genomicSuperDups'),
+        ann.TfbsConsSitesStage(format=format, table='tfbsConsSites')]
+
+
+"""Names of the annotated file, the count log and the performance stats
+   for infile
+   job.vcf, job.vcf.gz, job.vcf.bgz and job.pileup all give job.annot.vcf
+   (with .gz appended when compress is set), job.vcf.count.log and
+   job.vcf.stats.json.
+"""
+def outputNames(infile, compress=False):
+    base, ext = vcfio.splitExtension(infile)
+    if (ext == ''):
+        finalout = infile + '.annot'
+        logfile = infile + '.count.log'
+        statsfile = infile + '.stats.json'
+    else:
+        finalout = base + '.annot.vcf'
+        logfile = base + '.vcf.count.log'
+        statsfile = base + '.vcf.stats.json'
+    if compress:
+        finalout = finalout + '.gz'
+    return (finalout, logfile, statsfile)
+
+
+"""Format of infile by its extension: 'pileup' for variant pileups,
+   'vcf' otherwise
+"""
+def inputFormat(infile):
+    if (vcfio.splitExtension(infile)[1] == vcfio.PILEUP_EXTENSION):
+        return 'pileup'
+    return 'vcf'
+
+
+"""Annotate infile; returns the name of the annotated file
+   format is the format of infile, 'vcf' or 'pileup'. A variant pileup is
+   converted to VCF records as it is read (see pileup2vcf.py) and
+   annotated like a VCF file; its VCF is not written to disk.
+"""
+def run(infile, format, processes=None, compress=None, index=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
-
-### EOF
\ No newline at end of file
+    if (processes is None):
+        processes = PROCESSES
+    if (compress is None):
+        compress = COMPRESS_OUTPUT
+    if (index is None):
+        index = INDEX_OUTPUT
+    finalout, logfile, statsfile = outputNames(infile, compress=compress)
+    if (processes > 1):
+        report = engine.annotateParallel(infile, finalout, stages,
+            processes, format='vcf', logfile=logfile, index=index,
+            statsfile=statsfile, informat=format)
+    else:
+        report = engine.annotate(infile, finalout, stages(format='vcf'),
+            logfile=logfile, index=index, statsfile=statsfile,
+            informat=format)
+
+    for stage in report['stages']:
+        print(f"{stage['name']} - done.")
+
+    return finalout
+
+### EOF
@@ -0,0 +1,622 @@
+# engine.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Single-pass annotation engine: every record is read once, passed through
+# all annotation stages in memory and written once
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import collections
+import array
+import shutil
+import tempfile
+import multiprocessing
+import concurrent.futures
+import utils as u
+import vcfio
+import perfstats
+import varcache
+import variants
+import pileup2vcf
+
+BATCH_SIZE = 1000
+
+# Threads (and reference DB connections) used to run the lookups of
+# independent stages concurrently; 1 runs the stages one after another
+STAGE_THREADS = int(os.environ['ANNTOOLS_STAGE_THREADS']) \
+    if ('ANNTOOLS_STAGE_THREADS' in os.environ) else 4
+
+# Lookups every stage keeps for loci seen earlier in the job, so that loci
+# repeated in the input are only looked up once; 0 turns the memo off
+LOCUS_MEMO_SIZE = int(os.environ['ANNTOOLS_LOCUS_MEMO_SIZE']) \
+    if ('ANNTOOLS_LOCUS_MEMO_SIZE' in os.environ) else 50000
+
+# Node-local variant cache shared by all jobs (see varcache.py); None
+# queries the reference database for every record
+VARIANT_CACHE = os.environ['ANNTOOLS_VARIANT_CACHE'] \
+    if ('ANNTOOLS_VARIANT_CACHE' in os.environ) else None
+
+
+"""Newline-aligned chunks of infile as vcfio.VcfChunks; a variant pileup
+   is converted by up to processes processes as it is read
+"""
+def readChunks(infile, informat='vcf', processes=1):
+    if (informat == 'pileup'):
+        return pileup2vcf.vcf_chunks(infile, processes=processes)
+    return vcfio.readChunks(infile)
+
+
+"""Drop whitespace at the ends of a record the way the file-based
+   pipeline did, where every stage stripped the line written by the
+   previous one before splitting it again, and parse the record again
+"""
+def restrip(fields, sep='\t'):
+    if fields.blankEnds():
+        fields[:] = sep.join(fields.render()).strip().split(sep,
+            variants.COLUMNS)
+        fields.parse(fields.inds)
+
+
+"""Run every stage over a batch of records, in stage order
+   With a variant cache, the lookups it has for the batch's records are
+   used and only the other records are looked up; their lookups are
+   stored in the cache once the batch is done.
+"""
+def annotateBatch(batch, stages, sep='\t', scheduler=None, cache=None):
+    cached = None
+    fresh = [{} for stage in stages]
+    if (cache is not None):
+        with perfstats.StageTimer(cache.stats, 'secs'):
+            cached = cache.fetch(batch, [s.cacheKey() for s in stages])
+
+    if (scheduler is not None):
+        scheduler.run(batch, sep=sep, cached=cached, fresh=fresh)
+    else:
+        first = True
+        for k, stage in enumerate(stages):
+            if not first:
+                for fields in batch:
+                    restrip(fields, sep=sep)
+            first = False
+
+            applyBatch(stage, batch, lookupBatch(stage, batch,
+                cached[k] if (cached is not None) else None, fresh[k]))
+
+    if (cache is not None):
+        hits = set([])
+        for found in cached:
+            hits.update(found)
+        with perfstats.StageTimer(cache.stats, 'secs'):
+            cache.store(batch, [s.cacheKey() for s in stages], fresh,
+                hits=hits)
+
+
+"""A stage's lookups for a batch, timed into its stats
+   cached maps the indices of the records found in the variant cache to
+   their lookups. Of the other records, those whose locus is in the
+   stage's memo or repeats an earlier one of the batch are answered from
+   there, and only the rest are looked up. All of them are added to fresh
+   for the variant cache.
+"""
+def lookupBatch(stage, batch, cached=None, fresh=None):
+    with perfstats.StageTimer(stage.stats, 'lookup_secs'):
+        memo = stage.memo
+        if (cached is None) and (memo is None):
+            return stage.lookupBatch(batch)
+
+        results = [None] * len(batch)
+        cacheHits = 0
+        memoHits = 0
+        loci = {}
+        for i, fields in enumerate(batch):
+            if (cached is not None) and (i in cached):
+                results[i] = cached[i]
+                cacheHits = cacheHits + 1
+                continue
+            key = i
+            if (memo is not None):
+                key = stage.locusKey(fields)
+                if (key in memo):
+                    results[i] = memo.get(key)
+                    memoHits = memoHits + 1
+                    if (fresh is not None):
+                        fresh[i] = results[i]
+                    continue
+            if (key in loci):
+                loci[key].append(i)
+                memoHits = memoHits + 1
+            else:
+                loci[key] = [i]
+
+        if (len(loci) == len(batch)):
+            results = stage.lookupBatch(batch)
+            looked = results
+        elif (len(loci) > 0):
+            looked = stage.lookupBatch([batch[indices[0]]
+                for indices in loci.values()])
+        else:
+            looked = []
+        for (key, indices), result in zip(loci.items(), looked):
+            for i in indices:
+                results[i] = result
+                if (fresh is not None):
+                    fresh[i] = result
+            if (memo is not None):
+                memo.put(key, result)
+
+        stats = stage.stats
+        stats['locus_memo_hits'] = stats['locus_memo_hits'] + memoHits
+        if (cached is not None):
+            stats['variant_cache_hits'] = stats['variant_cache_hits'] + \
+                cacheHits
+            stats['variant_cache_misses'] = stats['variant_cache_misses'] + \
+                len(batch) - cacheHits
+        return results
+
+
+"""Lookups of the last size loci a stage has seen, least recently used
+   ones dropped first
+"""
+class LocusMemo(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, result):
+        self.entries[key] = result
+        if (len(self.entries) > self.size):
+            self.entries.popitem(last=False)
+
+
+def infoSize(batch):
+    return sum([fields.info.size() for fields in batch
+        if (fields.info is not None)])
+
+
+def applyBatch(stage, batch, results):
+    stats = stage.stats
+    with perfstats.StageTimer(stats, 'apply_secs'):
+        before = infoSize(batch)
+        for fields, result in zip(batch, results):
+            stage.apply(fields, result)
+        stats['info_bytes'] = stats['info_bytes'] + infoSize(batch) - before
+    stats['records'] = stats['records'] + len(batch)
+
+
+"""Open a stage on cursor, counting its queries and rows into its stats,
+   with a memo of LOCUS_MEMO_SIZE loci
+"""
+def openStage(stage, cursor):
+    stage.open(perfstats.StatsCursor(cursor, stage.stats))
+    stage.memo = LocusMemo(LOCUS_MEMO_SIZE) if (LOCUS_MEMO_SIZE > 0) \
+        else None
+
+
+"""Runs the lookups of the stages of a batch concurrently
+   A stage's lookup() may only read fields written by the apply() of the
+   stages named in its depends; all other stages' lookups see the records
+   as read. Lookups are started as soon as the stages they depend on have
+   been applied, on one thread per cursor, and every stage keeps the cursor
+   it was opened with. Results are applied in stage order, so records end
+   up the same as with annotateBatch().
+"""
+class StageScheduler(object):
+
+    def __init__(self, stages, cursors):
+        self.stages = stages
+        self.cursors = cursors
+        self.group = [i % len(cursors) for i in range(len(stages))]
+        self.depends = []
+        for i, stage in enumerate(stages):
+            depends = []
+            for name in stage.depends:
+                found = [j for j in range(i) if (stages[j].name == name)]
+                if (len(found) == 0):
+                    raise ValueError(f"Stage {stage.name} depends on " + \
+                        f"{name}, which does not run before it")
+                depends.extend(found)
+            self.depends.append(depends)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(cursors))
+
+    def open(self):
+        for stage, group in zip(self.stages, self.group):
+            openStage(stage, self.cursors[group])
+
+    def lookup(self, batch, indices, cached, fresh):
+        return [(i, lookupBatch(self.stages[i], batch,
+            cached[i] if (cached is not None) else None, fresh[i]))
+            for i in indices]
+
+    def run(self, batch, sep='\t', cached=None, fresh=None):
+        if (fresh is None):
+            fresh = [{} for stage in self.stages]
+        count = len(self.stages)
+        results = [None] * count
+        started = [False] * count
+        applied = 0
+
+        while (applied < count):
+            groups = {}
+            for i in range(count):
+                if not started[i] and \
+                    all([(d < applied) for d in self.depends[i]]):
+                    started[i] = True
+                    groups.setdefault(self.group[i], []).append(i)
+
+            futures = [self.executor.submit(self.lookup, batch, indices,
+                cached, fresh) for indices in groups.values()]
+            for future in futures:
+                for i, result in future.result():
+                    results[i] = result
+
+            while (applied < count) and started[applied]:
+                if (applied > 0):
+                    for fields in batch:
+                        restrip(fields, sep=sep)
+                applyBatch(self.stages[applied], batch, results[applied])
+                results[applied] = None
+                applied = applied + 1
+
+    def close(self):
+        self.executor.shutdown()
+
+
+"""Annotate infile with all stages and write the result to outfile
+   Header lines (starting with '#') are copied through unchanged. The count
+   log is written by the stages, in stage order, when all records are done.
+   The input is read in chunks (see readChunks()), whose runs of records
+   are split into columns by vcfio.VcfChunk.columns(). infile may be gzip
+   or bgzip compressed, or a variant pileup with informat 'pileup', which
+   is converted to VCF records as it is read and annotated with stages for
+   VCF. outfile is written in BGZF format if its name ends in .gz or .bgz.
+   With index set, a coordinate index of outfile is written next to it
+   (see vcfio.VcfWriter). With more than one thread, independent stages
+   are looked up concurrently by a StageScheduler. Records are looked up
+   in the variant cache at cachefile (default VARIANT_CACHE), if there is
+   one, before any stage queries the reference database.
+   Returns the job's performance report (see perfstats.report()), which is
+   also written to statsfile if one is given.
+"""
+def annotate(infile, outfile, stages, logfile=None, logmode='w',
+    batch_size=BATCH_SIZE, sep='\t', threads=None, index=False,
+    statsfile=None, cachefile=None, informat='vcf'):
+
+    started = time.perf_counter()
+    cpu = time.process_time()
+    if (threads is None):
+        threads = STAGE_THREADS
+    threads = max(1, min(threads, len(stages)))
+
+    # One connection per stage thread, plus one for each stage that may
+    # stream a table on a connection of its own (see Stage.streamCursor())
+    pool = u.db_pool()
+    pool.reserve(threads + len(stages))
+    conns = [pool.acquire() for i in range(threads)]
+    cursors = [conn.cursor() for conn in conns]
+    scheduler = None
+    if (threads > 1):
+        scheduler = StageScheduler(stages, cursors)
+        scheduler.open()
+    else:
+        for stage in stages:
+            openStage(stage, cursors[0])
+
+    if (cachefile is None):
+        cachefile = VARIANT_CACHE
+    cache = None
+    if cachefile and (len(stages) > 0):
+        cache = varcache.VariantCache(cachefile, inds=stages[0].inds)
+
+    fh_out = vcfio.openOutput(outfile, index=index)
+    inds = stages[0].inds if (len(stages) > 0) else (0, 1, 3, 4)
+    # The CHROM of a run is that of the locus when the locus starts in the
+    # first column, as it does in VCF
+    located = (inds[0] == 0)
+    names = {}
+    batch = []
+    records = 0
+    batches = 0
+
+    for chunk in readChunks(infile, informat=informat):
+        chunk.split(sep=sep)
+        for first, stop, chrom in chunk.runs:
+            if (chrom is None):
+                if (len(batch) > 0):
+                    annotateBatch(batch, stages, sep=sep,
+                        scheduler=scheduler, cache=cache)
+                    writeBatch(fh_out, batch, sep=sep)
+                    records = records + len(batch)
+                    batches = batches + 1
+                    batch = []
+                for i in range(first, stop):
+                    fh_out.write(chunk.text(i).strip() + '\n')
+                continue
+
+            if located and (chrom not in names):
+                names[chrom] = variants.chromNames(chrom)
+            while (first < stop):
+                count = min(stop - first, batch_size - len(batch))
+                for cols in chunk.columns(first, first + count,
+                    count=variants.COLUMNS):
+                    batch.append(variants.parseColumns(cols, inds,
+                        names=names[chrom] if located else None))
+                first = first + count
+                if (len(batch) >= batch_size):
+                    annotateBatch(batch, stages, sep=sep,
+                        scheduler=scheduler, cache=cache)
+                    writeBatch(fh_out, batch, sep=sep)
+                    records = records + len(batch)
+                    batches = batches + 1
+                    batch = []
+
+    if (len(batch) > 0):
+        annotateBatch(batch, stages, sep=sep, scheduler=scheduler,
+            cache=cache)
+        writeBatch(fh_out, batch, sep=sep)
+        records = records + len(batch)
+        batches = batches + 1
+
+    fh_out.close()
+    if (scheduler is not None):
+        scheduler.close()
+    if (cache is not None):
+        cache.close()
+    for stage in stages:
+        stage.close()
+    for cursor, conn in zip(cursors, conns):
+        cursor.close()
+        pool.release(conn)
+
+    if logfile:
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+    stats = pool.stats()
+    print(f"Reference DB connections: {str(stats['created'])} new, " + \
+        f"{str(stats['reused'])} reused")
+
+    report = perfstats.report(infile, outfile, stages, {
+        'records': records, 'batches': batches, 'processes': 1,
+        'stage_threads': threads,
+        'wall_secs': time.perf_counter() - started,
+        'cpu_secs': time.process_time() - cpu,
+        'connections': {'created': stats['created'],
+            'reused': stats['reused']},
+        'variant_cache': cacheReport(cache)})
+    if statsfile:
+        perfstats.write(statsfile, report)
+    return report
+
+
+"""Job totals of a variant cache; None without one
+"""
+def cacheReport(cache):
+    if (cache is None):
+        return None
+    return {'path': cache.path, 'version': cache.version,
+        'secs': cache.stats['secs'], 'evicted': cache.evicted,
+        'failed': cache.failed}
+
+
+def writeBatch(fh_out, batch, sep='\t'):
+    fh_out.writeRecords([sep.join(fields.render()) + '\n'
+        for fields in batch], sep=sep)
+
+
+"""Run a single stage the way the original per-stage functions did:
+   read vcf + tmpextin, write vcf + tmpextout and append to the count log
+"""
+def annotateFile(vcf, stage, tmpextin='', tmpextout='.1', logfile=None,
+    logmode='a', sep='\t'):
+
+    if (logfile is None):
+        logfile = vcf + '.count.log'
+    annotate(vcf + tmpextin, vcf + tmpextout, [stage], logfile=logfile,
+        logmode=logmode, sep=sep)
+
+
+"""Split the records of infile into at most shards files in directory
+   Records are grouped by chromosome; a chromosome with more than its share
+   of the records is cut into runs of consecutive records, which are
+   position ranges when the file is sorted. The groups are then spread over
+   the shards, largest first, each to the shard with the fewest records.
+   Every shard keeps its records in file order. The input is read in
+   chunks (see readChunks()) and runs of records on the same chromosome
+   are copied to the shards as they are, to be stripped when the shards
+   are read. A variant pileup is converted in both passes over it.
+   Returns the shard files, the header lines and, for every line of
+   infile, the shard its record went to (-1 for header lines).
+"""
+def shardInput(infile, directory, shards, sep='\t', informat='vcf'):
+    counts = {}
+    total = 0
+    for chunk in readChunks(infile, informat=informat, processes=shards):
+        chunk.split(sep=sep)
+        for first, stop, chrom in chunk.runs:
+            if (chrom is not None):
+                counts[chrom] = counts.get(chrom, 0) + stop - first
+                total = total + stop - first
+
+    share = max(1, -(-total // shards))
+    groups = []
+    for chrom, count in counts.items():
+        pieces = -(-count // share)
+        size = -(-count // pieces)
+        counts[chrom] = size
+        for i in range(pieces):
+            groups.append(((chrom, i), min(size, count - i * size)))
+
+    loads = [0] * min(shards, len(groups))
+    assigned = {}
+    for key, count in sorted(groups, key=lambda g: -g[1]):
+        shard = loads.index(min(loads))
+        assigned[key] = shard
+        loads[shard] = loads[shard] + count
+
+    files = [os.path.join(directory, 'shard' + str(i) + '.vcf')
+        for i in range(len(loads))]
+    outs = [open(f, 'wb') for f in files]
+    headers = []
+    plan = array.array('i')
+    seen = {}
+
+    for chunk in readChunks(infile, informat=informat, processes=shards):
+        chunk.split(sep=sep)
+        for first, stop, chrom in chunk.runs:
+            if (chrom is None):
+                headers.extend([chunk.text(i).strip()
+                    for i in range(first, stop)])
+                plan.extend([-1] * (stop - first))
+                continue
+            # Records from first to stop, cut where a group ends
+            while (first < stop):
+                n = seen.get(chrom, 0)
+                count = min(stop - first, counts[chrom] - n % counts[chrom])
+                shard = assigned[(chrom, n // counts[chrom])]
+                outs[shard].write(chunk.lines(first, first + count))
+                outs[shard].write(b'\n')
+                plan.extend([shard] * count)
+                seen[chrom] = n + count
+                first = first + count
+    for out in outs:
+        out.close()
+
+    return files, headers, plan
+
+
+"""Put the annotated shards back together in the order of the input
+"""
+def mergeShards(outfile, files, headers, plan, sep='\t', index=False,
+    batch_size=BATCH_SIZE):
+    shards = [open(f) for f in files]
+    fh_out = vcfio.openOutput(outfile, index=index)
+    lines = []
+    h = 0
+    for shard in plan:
+        if (shard < 0):
+            fh_out.writeRecords(lines, sep=sep)
+            lines = []
+            fh_out.write(headers[h] + '\n')
+            h = h + 1
+        else:
+            lines.append(shards[shard].readline())
+            if (len(lines) >= batch_size):
+                fh_out.writeRecords(lines, sep=sep)
+                lines = []
+    fh_out.writeRecords(lines, sep=sep)
+    fh_out.close()
+    for fh in shards:
+        fh.close()
+
+
+"""Annotate one shard in a worker process; returns the stage counters,
+   the stage stats and the shard's performance report
+"""
+def annotateShard(args):
+    infile, outfile, factory, format, batch_size, sep, cachefile = args
+    stages = factory(format=format)
+    report = annotate(infile, outfile, stages, logfile=None,
+        batch_size=batch_size, sep=sep, cachefile=cachefile)
+    return ([stage.counts() for stage in stages],
+        [stage.stats for stage in stages], report)
+
+
+"""Annotate infile like annotate(), using up to processes worker processes
+   The input is sharded with shardInput(); every shard is annotated with
+   the stages returned by factory(format=format) in a process of its own
+   and the outputs are merged back into the input order. Counters are
+   added up over the shards, so the output and the count log are the
+   same as those of a single annotate() run. Workers are forked, so they
+   share the parent's string hashing and reference snapshots. Stage stats
+   and CPU time are added up the same way into the job's performance
+   report, which is returned like that of annotate() and written to
+   statsfile if one is given. The workers share the variant cache at
+   cachefile. A variant pileup (informat 'pileup') is converted to VCF
+   while it is sharded.
+   Every worker has a connection pool of its own (see annotate()), so a
+   job holds up to processes times that many reference DB connections.
+"""
+def annotateParallel(infile, outfile, factory, processes, format='vcf',
+    logfile=None, logmode='w', batch_size=BATCH_SIZE, sep='\t',
+    index=False, statsfile=None, cachefile=None, informat='vcf'):
+
+    started = time.perf_counter()
+    cpu = time.process_time()
+    stages = factory(format=format)
+    directory = tempfile.mkdtemp(prefix='shards.',
+        dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        files, headers, plan = shardInput(infile, directory, processes,
+            sep=sep, informat=informat)
+        jobs = [(f, f + '.annot', factory, format, batch_size, sep,
+            cachefile) for f in files]
+        if (len(jobs) > 0):
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(processes=len(jobs)) as workers:
+                results = workers.map(annotateShard, jobs, chunksize=1)
+        else:
+            results = []
+        mergeShards(outfile, [job[1] for job in jobs], headers, plan,
+            sep=sep, index=index, batch_size=batch_size)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    initial = [stage.counts() for stage in stages]
+    job = {'records': 0, 'batches': 0, 'processes': len(jobs),
+        'stage_threads': 0, 'cpu_secs': 0.0,
+        'connections': {'created': 0, 'reused': 0}, 'variant_cache': None}
+    for counts, stats, report in results:
+        for stage, start, shard in zip(stages, initial, counts):
+            stage.addCounts(dict([(c, shard[c] - start[c]) for c in shard]))
+        for stage, shard in zip(stages, stats):
+            perfstats.addStats(stage.stats, shard)
+        for c in ('records', 'batches', 'cpu_secs'):
+            job[c] = job[c] + report[c]
+        for c in ('created', 'reused'):
+            job['connections'][c] = job['connections'][c] + \
+                report['connections'][c]
+        job['stage_threads'] = max(job['stage_threads'],
+            report['stage_threads'])
+        shard = report['variant_cache']
+        if (shard is not None):
+            if (job['variant_cache'] is None):
+                job['variant_cache'] = dict(shard)
+            else:
+                cache = job['variant_cache']
+                cache['secs'] = cache['secs'] + shard['secs']
+                cache['evicted'] = cache['evicted'] + shard['evicted']
+                cache['failed'] = cache['failed'] or shard['failed']
+
+    if logfile:
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+    print(f"Annotated {str(len(plan) - len(headers))} records in " + \
+        f"{str(len(jobs))} shards")
+
+    job['wall_secs'] = time.perf_counter() - started
+    job['cpu_secs'] = job['cpu_secs'] + time.process_time() - cpu
+    report = perfstats.report(infile, outfile, stages, job)
+    if statsfile:
+        perfstats.write(statsfile, report)
+    return report
+
+### EOF
@@ -0,0 +1,233 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index and sorted (sweep-line) join for the reference
+# tables that are only ever queried with chromStart <= pos AND pos <= chromEnd
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+import bisect
+
+# Indexes already loaded by this process, keyed by table and columns
+_indexes = {}
+
+
+"""Point-in-interval index over one reference table
+   Intervals are kept per chromosome, sorted by start, together with the
+   running maximum of their ends. All intervals that can contain pos lie
+   between the first one whose running maximum end reaches pos and the last
+   one starting at or before pos. Overlapping rows are returned in the order
+   they were added; loadIndex() adds them by start and then primary key,
+   the order backends.overlap() returns them in.
+"""
+class IntervalIndex(object):
+
+    def __init__(self, columns=None):
+        self.columns = columns or []
+        self.pending = {}
+        self.chroms = {}
+        self.count = 0
+
+    def add(self, chrom, start, end, row):
+        self.pending.setdefault(str(chrom).upper(), []).append(
+            (int(start), self.count, int(end), row))
+        self.count = self.count + 1
+
+    def build(self):
+        for chrom, intervals in self.pending.items():
+            intervals.sort(key=lambda i: (i[0], i[1]))
+            starts = [i[0] for i in intervals]
+            order = [i[1] for i in intervals]
+            ends = [i[2] for i in intervals]
+            rows = [i[3] for i in intervals]
+            maxends = []
+            maxend = None
+            for end in ends:
+                if (maxend is None) or (end > maxend):
+                    maxend = end
+                maxends.append(maxend)
+            self.chroms[chrom] = (starts, maxends, ends, order, rows)
+        self.pending = {}
+        return self
+
+    """Rows whose interval shares at least one position with [lo, hi]
+    """
+    def overlapRange(self, chrom, lo, hi, columns=None):
+        intervals = self.chroms.get(str(chrom).upper())
+        if (intervals is None):
+            return []
+
+        starts, maxends, ends, order, rows = intervals
+        end = bisect.bisect_right(starts, hi)
+        start = bisect.bisect_left(maxends, lo, 0, end)
+        hits = [i for i in range(start, end) if ends[i] >= lo]
+        if (len(hits) > 1):
+            hits.sort(key=lambda i: order[i])
+        if (columns is None):
+            return [rows[i] for i in hits]
+        return [tuple([rows[i][c] for c in columns]) for i in hits]
+
+    def overlap(self, chrom, pos, columns=None):
+        return self.overlapRange(chrom, pos, pos, columns=columns)
+
+    def first(self, chrom, pos, columns=None):
+        rows = self.overlap(chrom, pos, columns=columns)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def columnIndices(self, names):
+        lower = [c.lower() for c in self.columns]
+        return [lower.index(n.lower()) for n in names]
+
+    """(start, end, order, ref) of every interval on chrom, by start
+    """
+    def iterChrom(self, chrom):
+        intervals = self.chroms.get(str(chrom).upper())
+        if (intervals is None):
+            return iter([])
+        starts, maxends, ends, order, rows = intervals
+        return zip(starts, ends, order, rows)
+
+    def rowAt(self, ref, columns=None):
+        if (columns is None):
+            return ref
+        return tuple([ref[c] for c in columns])
+
+
+"""Streams the intervals of a reference table from the database (through
+   a backends backend), one chromosome at a time, by start and then
+   primary key
+   With cursor set, each chromosome is read through a new unbuffered
+   cursor from cursor(), block by block as the join advances, so that only
+   the intervals not yet passed are held in memory; the previous
+   chromosome's cursor is closed first, so the cursors may share one
+   connection. Without it a chromosome's rows are fetched completely
+   through the backend's cursor. With chromcol set to None the table holds
+   a single chromosome and all of its rows are returned; select limits the
+   rows to the given columns.
+"""
+class TableCursor(object):
+
+    def __init__(self, backend, table, chromcol='chrom', startcol='chromStart',
+        endcol='chromEnd', select=None, cursor=None):
+        self.backend = backend
+        self.table = table
+        self.chromcol = chromcol
+        self.startcol = startcol
+        self.endcol = endcol
+        self.select = select
+        self.newCursor = cursor
+        self.cursor = None
+        self.columns = None
+
+    def iterChrom(self, chrom):
+        self.close()
+        columns = [self.startcol, self.endcol] + \
+            (self.select or [self.table + '.*'])
+        if (self.newCursor is None):
+            names, rows = self.backend.scan(self.table, columns,
+                chromcol=self.chromcol, chrom=chrom, order=[self.startcol])
+        else:
+            self.cursor = self.newCursor()
+            names, rows = self.backend.stream(self.cursor, self.table,
+                columns, chromcol=self.chromcol, chrom=chrom,
+                order=[self.startcol])
+        if (self.columns is None):
+            self.columns = names[2:]
+        return self.intervals(rows)
+
+    def intervals(self, rows):
+        for order, row in enumerate(rows):
+            if (row[0] is not None) and (row[1] is not None):
+                yield (int(row[0]), int(row[1]), order, tuple(row[2:]))
+
+    def rowAt(self, ref, columns=None):
+        if (columns is None):
+            return ref
+        return tuple([ref[c] for c in columns])
+
+    """Close the cursor of the chromosome being read, if there is one
+    """
+    def close(self):
+        if (self.cursor is not None):
+            self.cursor.close()
+            self.cursor = None
+
+
+"""Point-in-interval join of position-sorted records with the intervals of
+   a source (IntervalIndex, TableCursor or snapshot table)
+   Intervals are read in start order as the positions advance and are kept
+   in a heap by end until no later position can fall inside them, so every
+   interval is read once per chromosome. overlap() returns None as soon as
+   the records turn out not to be sorted: a position lower than the one
+   before it, or a chromosome that was already left. Overlapping rows are
+   returned in the source's order.
+"""
+class SweepJoin(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.chrom = None
+        self.seen = set([])
+        self.intervals = iter([])
+        self.next = None
+        self.active = []
+        self.pos = None
+
+    def overlap(self, chrom, pos, columns=None):
+        key = str(chrom).upper()
+        if (key != self.chrom):
+            if key in self.seen:
+                return None
+            self.seen.add(key)
+            self.chrom = key
+            self.intervals = iter(self.source.iterChrom(chrom))
+            self.next = next(self.intervals, None)
+            self.active = []
+        elif (pos < self.pos):
+            return None
+        self.pos = pos
+
+        while (self.next is not None) and (self.next[0] <= pos):
+            start, end, order, ref = self.next
+            if (end >= pos):
+                heapq.heappush(self.active, (end, order, ref))
+            self.next = next(self.intervals, None)
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        hits = self.active
+        if (len(hits) > 1):
+            hits = sorted(hits, key=lambda i: i[1])
+        return [self.source.rowAt(i[2], columns) for i in hits]
+
+
+"""Load a whole reference table into an IntervalIndex
+   Each table is read from the database once per process, by start and
+   then primary key; rows are the same tuples a "select *" on the table
+   returns.
+"""
+def loadIndex(backend, table, chromcol='chrom', startcol='chromStart',
+    endcol='chromEnd'):
+
+    key = (table, chromcol, startcol, endcol)
+    if key in _indexes:
+        return _indexes[key]
+
+    names, rows = backend.scan(table, [chromcol, startcol, endcol,
+        table + '.*'], order=[startcol])
+    index = IntervalIndex(columns=names[3:])
+    for row in rows:
+        if (row[0] is None) or (row[1] is None) or (row[2] is None):
+            continue
+        index.add(row[0], row[1], row[2], tuple(row[3:]))
+
+    _indexes[key] = index.build()
+    return _indexes[key]
+
+### EOF
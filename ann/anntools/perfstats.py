@@ -0,0 +1,167 @@
+# perfstats.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage performance counters of an annotation job, written as JSON
+# next to the count log
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import json
+
+# Counters kept by every stage; all of them add up over batches and shards.
+# fetched_bytes is the size of the rows read from the reference database
+# (see rowBytes()) and info_bytes the size of the INFO text the stage added
+STAGE_COUNTERS = ('records', 'lookup_secs', 'apply_secs', 'cpu_secs',
+    'queries', 'rows', 'fetched_bytes', 'info_bytes', 'cache_hits',
+    'cache_misses', 'variant_cache_hits', 'variant_cache_misses',
+    'locus_memo_hits')
+
+
+def newStats():
+    return dict([(c, 0) for c in STAGE_COUNTERS])
+
+
+def addStats(stats, more):
+    for c in STAGE_COUNTERS:
+        stats[c] = stats[c] + more[c]
+
+
+"""Size of a row as fetched: the length of its strings and bytes, 8 for
+   every other value and nothing for NULLs
+"""
+def rowBytes(row):
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size = size + len(value)
+        elif (value is not None):
+            size = size + 8
+    return size
+
+
+"""Cursor that counts the queries run through it, and the rows they return
+   and their size, into a stage's stats; everything else is passed to the
+   wrapped cursor
+"""
+class StatsCursor(object):
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, sql, args=None):
+        self.stats['queries'] = self.stats['queries'] + 1
+        return self.cursor.execute(sql, args)
+
+    def count(self, rows):
+        self.stats['rows'] = self.stats['rows'] + len(rows)
+        self.stats['fetched_bytes'] = self.stats['fetched_bytes'] + \
+            sum([rowBytes(row) for row in rows])
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if (row is not None):
+            self.count([row])
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(size) if (size is not None) \
+            else self.cursor.fetchmany()
+        self.count(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.count(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.count([row])
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Wall and CPU time of a stage's lookups or applies; CPU time is that of
+   the calling thread, so lookups running on other threads do not count
+"""
+class StageTimer(object):
+
+    def __init__(self, stats, counter):
+        self.stats = stats
+        self.counter = counter
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        stats = self.stats
+        stats[self.counter] = stats[self.counter] + \
+            time.perf_counter() - self.start
+        stats['cpu_secs'] = stats['cpu_secs'] + time.thread_time() - self.cpu
+
+
+def hitRate(hits, misses):
+    if (hits + misses == 0):
+        return None
+    return round(hits / (hits + misses), 4)
+
+
+def fileSize(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+"""Report of a job: totals for the whole job followed by the counters of
+   every stage, in stage order. The variant cache hit rate of the job is
+   that of all stages' lookups together.
+"""
+def report(infile, outfile, stages, job):
+    out = dict(job)
+    out['input'] = os.path.basename(infile)
+    out['output'] = os.path.basename(outfile)
+    out['bytes_read'] = fileSize(infile)
+    out['bytes_written'] = fileSize(outfile)
+    out['stages'] = []
+    for stage in stages:
+        stats = stage.stats
+        entry = {'name': stage.name}
+        entry['wall_secs'] = round(stats['lookup_secs'] +
+            stats['apply_secs'], 6)
+        for c in STAGE_COUNTERS:
+            value = stats[c]
+            entry[c] = round(value, 6) if isinstance(value, float) else value
+        entry['cache_hit_rate'] = hitRate(stats['cache_hits'],
+            stats['cache_misses'])
+        entry['variant_cache_hit_rate'] = hitRate(
+            stats['variant_cache_hits'], stats['variant_cache_misses'])
+        out['stages'].append(entry)
+    for c in ('wall_secs', 'cpu_secs'):
+        out[c] = round(out[c], 6)
+
+    cache = out.get('variant_cache')
+    if (cache is not None):
+        cache = dict(cache)
+        cache['hits'] = sum([e['variant_cache_hits'] for e in out['stages']])
+        cache['misses'] = sum([e['variant_cache_misses']
+            for e in out['stages']])
+        cache['hit_rate'] = hitRate(cache['hits'], cache['misses'])
+        cache['secs'] = round(cache['secs'], 6)
+        out['variant_cache'] = cache
+    return out
+
+
+def write(path, report):
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2)
+        fh.write('\n')
+
+### EOF
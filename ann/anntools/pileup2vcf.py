@@ -11,29 +11,29 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
+import time
 import datetime
+import multiprocessing
 import file_utils as fu
+import vcfio
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED = frozenset(ACCEPTED_CHR)
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
-def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
+# Processes converting a pileup at once
+PROCESSES = int(os.environ['ANNTOOLS_PROCESSES']) \
+    if ('ANNTOOLS_PROCESSES' in os.environ) else 1
 
-    for l in lst:
-        l = str(l)
+# Bytes of the pileup converted at a time, by one process
+RANGE_BYTES = 32 * 1024 * 1024
 
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
 
-    return (int(depth) - (match_sum + ast))
+def count_alt(depth, bases):
+    return (int(depth) - (bases.count('.') + bases.count(',') +
+        bases.count('*')))
 
 
 def vcfheader(pileup):
@@ -58,44 +58,137 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    alt_x = HETERO.get(alt)
+    if (alt_x is None):
         return alt
+    elif (ref == alt_x[0]):
+        return alt_x[1]
     else:
-        alt_x = HETERO[alt]
-        if (str(ref) == str(alt_x)[0]):
-            return str(alt_x)[1]
-        else:
-            return str(alt_x)[0]
+        return alt_x[0]
 
 
 def varpileup_line2vcf_line(pileupfields):
     """ Converts Variant Pileup format to VCF format """
 
-    t = '\t'
-    chr = str(pileupfields[0])
-    pos = str(pileupfields[1])
-    ref = str(pileupfields[2])
-    alt = str(pileupfields[3])
-    consqual = str(pileupfields[4])
-    snpqual = str(pileupfields[5])
-    mapqual = str(pileupfields[6])
-    depth = str(pileupfields[7])
-    alt_count = str(count_alt(depth, pileupfields[8]))
+    chr, pos, ref, alt, consqual, snpqual, mapqual, depth, bases = \
+        pileupfields[0:9]
+    alt_count = str(count_alt(depth, bases))
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if (alt in HETERO):
         GT = '0/1'
-        alt = hetero2homo(ref,alt)
+        alt = hetero2homo(ref, alt)
+
+    return '\t'.join([chr, pos, '.', ref, alt, mapqual, 'PASS', '.',
+        'GT:GQ:DP:AD', GT + ':' + consqual + ':' + depth + ':' + alt_count])
+
+
+"""VCF lines of the pileup lines that are variants (ALT other than REF)
+   on chromosomes 1 - 22, X, Y and MT
+"""
+def pileup_lines2vcf(lines, chr_col=0, ref_col=2, alt_col=3, sep='\t'):
+    out = []
+    # The columns after the read bases are not used
+    limit = max(chr_col, ref_col, alt_col, 8) + 1
+    for line in lines:
+        line = line.strip()
+        if (len(line) == 0):
+            continue
+        fields = line.split(sep, limit)
+        if ((fields[alt_col] != fields[ref_col]) and \
+            (fields[chr_col].strip() in ACCEPTED)):
+            out.append(varpileup_line2vcf_line(fields))
+    return out
+
+
+"""Newline-aligned (start, stop) byte ranges of about size bytes (default
+   RANGE_BYTES) of path
+"""
+def byte_ranges(path, size=None):
+    if (size is None):
+        size = RANGE_BYTES
+    ranges = []
+    end = os.path.getsize(path)
+    with open(path, 'rb') as fh:
+        start = 0
+        while (start < end):
+            fh.seek(min(start + size, end))
+            fh.readline()
+            stop = min(fh.tell(), end)
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+
+"""Convert bytes start to stop of a pileup; returns the number of pileup
+   lines, the number of VCF lines and the VCF lines as one string
+"""
+def convert_range(job):
+    pileup, start, stop, chr_col, ref_col, alt_col, sep = job
+    with open(pileup, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(stop - start)
+    lines = data.decode('utf-8').split('\n')
+    if (len(lines[-1]) == 0):
+        lines.pop()
+    out = pileup_lines2vcf(lines, chr_col=chr_col, ref_col=ref_col,
+        alt_col=alt_col, sep=sep)
+    return (len(lines), len(out), ''.join([line + '\n' for line in out]))
+
+
+"""(pileup lines, VCF lines, VCF lines as one string) for every range of
+   RANGE_BYTES of a pileup, in the order of the pileup; the ranges are
+   converted by up to processes processes at once
+"""
+def convert_ranges(pileup, chr_col=0, ref_col=2, alt_col=3, sep='\t',
+    processes=None):
+
+    if (processes is None):
+        processes = PROCESSES
+    jobs = [(pileup, start, stop, chr_col, ref_col, alt_col, sep)
+        for start, stop in byte_ranges(pileup)]
+    if (processes > 1) and (len(jobs) > 1):
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=min(processes, len(jobs))) as workers:
+            for converted in workers.imap(convert_range, jobs):
+                yield converted
+    else:
+        for job in jobs:
+            yield convert_range(job)
+
 
-    return chr + t + pos + t + '.' + t + ref + t + alt + t + mapqual + \
-        t + 'PASS' + t + '.' + t + 'GT:GQ:DP:AD' + t + GT + ':' + \
-        consqual + ':' + depth + ':' + alt_count
+"""Lines of the VCF of a pileup, header first, converted as they are read
+   (see convert_ranges()); for reading a pileup without writing its VCF
+"""
+def vcf_lines(pileup, sep='\t', processes=None):
+    for line in vcfheader(pileup).split('\n'):
+        yield line
+    for n, m, text in convert_ranges(pileup, sep=sep, processes=processes):
+        for line in text.split('\n')[:-1]:
+            yield line
 
 
+"""The VCF of a pileup as vcfio.VcfChunks: the header, then the VCF lines
+   of every range of the pileup
+"""
+def vcf_chunks(pileup, sep='\t', processes=None):
+    header = (vcfheader(pileup) + '\n').encode('utf-8')
+    yield vcfio.VcfChunk(header, 0, len(header))
+    for n, m, text in convert_ranges(pileup, sep=sep, processes=processes):
+        if (m > 0):
+            data = text.encode('utf-8')
+            yield vcfio.VcfChunk(data, 0, len(data))
+
+
+"""Convert a variant pileup to VCF
+   The VCF lines of every range of the pileup are written at once, in the
+   order of the pileup (see convert_ranges()). Returns the number of
+   pileup lines, VCF records, seconds taken and pileup lines per second.
+"""
 def filter_pileup(pileup, outfile=None, chr_col=0, 
-    ref_col=2, alt_col=3, sep='\t'):
-    
-    fh = open(pileup, "r")
+    ref_col=2, alt_col=3, sep='\t', processes=None):
+
+    started = time.perf_counter()
     if (outfile is None):
         outfile = pileup + '.vcf'
 
@@ -103,18 +196,21 @@ def filter_pileup(pileup, outfile=None, chr_col=0,
     fh_out = open(outfile, "w")
     fh_out.write(vcfheader(pileup) + '\n')
 
+    lines = 0
+    records = 0
+    for n, m, text in convert_ranges(pileup, chr_col=chr_col,
+        ref_col=ref_col, alt_col=alt_col, sep=sep, processes=processes):
+        fh_out.write(text)
+        lines = lines + n
+        records = records + m
+    fh_out.close()
 
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
-
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
-
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    secs = time.perf_counter() - started
+    rate = lines / secs if (secs > 0) else 0.0
+    print(f"Converted {str(lines)} pileup lines to {str(records)} VCF " + \
+        f"records in {secs:.2f} s ({rate:.0f} lines/s)")
+    return {'lines': lines, 'records': records, 'secs': round(secs, 4),
+        'lines_per_sec': round(rate, 1)}
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
@@ -141,8 +237,9 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 ref = str(fields[ref_col])
                 alt = str(fields[alt_col])
 
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                if ((alt != ref) and (chr.strip() in ACCEPTED)):
                     fh_out.write(str(line) + '\n')
+    fh.close()
+    fh_out.close()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -32,8 +32,8 @@ if __name__ == '__main__':
 	# Call the AnnTools pipeline
 	if len(sys.argv) > 1:
 		with Timer():
-			driver.run(sys.argv[1], 'vcf')
+			driver.run(sys.argv[1], driver.inputFormat(sys.argv[1]))
 	else:
-		print("A valid .vcf file must be provided as input to this program.")
+		print("A valid .vcf or .pileup file must be provided as input to this program.")
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,315 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Columnar, memory-mapped snapshot of the annotator reference tables
+#
+# Export: python snapshot.py <snapshot_dir> [table ...]
+#
+# Every table is written to <snapshot_dir>/<table>/ as one set of NumPy
+# .npy files per chromosome, sorted by interval start: the intervals in
+# <chrom>.start/.end/.maxend/.order.npy and the table's columns in
+# <chrom>.col_<column>.npy. String columns are stored as int32 ids into a
+# per-table string pool (pool.bin, with offsets in pool.offsets.npy).
+# meta.json describes the columns and chromosomes. Annotator processes open the files with mmap, so processes
+# on the same host share one copy of the data in the page cache.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import json
+import mmap
+import decimal
+import numpy as np
+
+import file_utils as fu
+import utils as u
+import backends
+
+# Table name, chromosome column, interval start and end columns
+TABLES = [
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd')] + \
+    [('tfbsConsSites' + c, 'chrom', 'chromStart', 'chromEnd') for c in
+        [str(i) for i in range(1, 23)] + ['X', 'Y']]
+
+# Tables already opened by this process, keyed by directory and table
+_tables = {}
+
+
+"""Column kind of a list of database values
+"""
+def columnKind(values):
+    kinds = set([])
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, bool):
+            kinds.add('str')
+        elif isinstance(v, int):
+            kinds.add('int')
+        elif isinstance(v, float):
+            kinds.add('float')
+        elif isinstance(v, decimal.Decimal):
+            kinds.add('decimal')
+        elif isinstance(v, (bytes, bytearray)):
+            kinds.add('bytes')
+        else:
+            kinds.add('str')
+
+    if (len(kinds) == 1):
+        return kinds.pop()
+    elif (kinds == set(['int', 'float'])):
+        return 'float'
+    return 'str'
+
+
+"""Interns strings and byte strings into one pool
+"""
+class StringPool(object):
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def add(self, value):
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+    def save(self, directory):
+        offsets = [0]
+        with open(os.path.join(directory, 'pool.bin'), 'wb') as fh:
+            for value in self.values:
+                fh.write(value)
+                offsets.append(offsets[-1] + len(value))
+        np.save(os.path.join(directory, 'pool.offsets.npy'),
+            np.array(offsets, dtype=np.int64))
+
+
+"""Dump one table to directory/table
+   Rows are read by start and then primary key, so that overlapping rows
+   come out of the snapshot in the order backends.overlap() returns them.
+"""
+def exportTable(cursor, directory, table, chromcol, startcol, endcol):
+    sql = 'select ' + chromcol + ', ' + startcol + ', ' + endcol + ', ' + \
+        table + '.* from ' + table + \
+        backends.MySqlBackend(cursor).orderBy(table, [startcol]) + ';'
+    cursor.execute(sql)
+    columns = [str(d[0]) for d in cursor.description[3:]]
+    rows = [row for row in cursor.fetchall() if (row[0] is not None) and
+        (row[1] is not None) and (row[2] is not None)]
+
+    kinds = [columnKind([row[3 + c] for row in rows])
+        for c in range(len(columns))]
+
+    chroms = {}
+    for order, row in enumerate(rows):
+        chroms.setdefault(str(row[0]).upper(), []).append((int(row[1]),
+            order, int(row[2]), row[3:]))
+
+    tabledir = os.path.join(directory, table)
+    fu.mkdirp(tabledir)
+    pool = StringPool()
+    meta = {'table': table, 'chromcol': chromcol, 'startcol': startcol,
+        'endcol': endcol, 'columns': columns, 'kinds': kinds, 'chroms': {}}
+
+    for key, intervals in chroms.items():
+        intervals.sort(key=lambda i: (i[0], i[1]))
+        stem = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        meta['chroms'][key] = {'stem': stem, 'count': len(intervals)}
+        base = os.path.join(tabledir, stem)
+
+        ends = np.array([i[2] for i in intervals], dtype=np.int64)
+        np.save(base + '.start.npy',
+            np.array([i[0] for i in intervals], dtype=np.int64))
+        np.save(base + '.end.npy', ends)
+        np.save(base + '.maxend.npy', np.maximum.accumulate(ends))
+        np.save(base + '.order.npy',
+            np.array([i[1] for i in intervals], dtype=np.int64))
+
+        for c, column in enumerate(columns):
+            values = [i[3][c] for i in intervals]
+            kind = kinds[c]
+            nulls = np.array([v is None for v in values], dtype=np.bool_)
+            if nulls.any():
+                np.save(base + '.col_' + column + '.null.npy', nulls)
+
+            if (kind == 'int'):
+                data = np.array([v or 0 for v in values], dtype=np.int64)
+            elif (kind == 'float'):
+                data = np.array([v or 0.0 for v in values], dtype=np.float64)
+            elif (kind == 'bytes'):
+                data = np.array([pool.add(bytes(v or b''))
+                    for v in values], dtype=np.int32)
+            else:
+                data = np.array([pool.add(str('' if v is None else v).encode(
+                    'utf-8')) for v in values], dtype=np.int32)
+            np.save(base + '.col_' + column + '.npy', data)
+
+    pool.save(tabledir)
+    with open(os.path.join(tabledir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+
+    return len(rows)
+
+
+"""Dump the reference tables from the annotator database
+"""
+def export(directory, tables=None):
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    for table, chromcol, startcol, endcol in TABLES:
+        if (tables is None) or (table in tables):
+            count = exportTable(cursor, directory, table, chromcol,
+                startcol, endcol)
+            print(f"{table}: {str(count)} rows")
+    conn.close()
+
+
+"""Read-only, memory-mapped view of one exported table
+   Answers the same queries as intervals.IntervalIndex; rows are built on
+   demand from the column files and match what "select *" returns.
+"""
+class SnapshotTable(object):
+
+    def __init__(self, directory, table):
+        self.directory = os.path.join(directory, table)
+        with open(os.path.join(self.directory, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.columns = self.meta['columns']
+        self.kinds = self.meta['kinds']
+        self.chroms = {}
+
+        fh = open(os.path.join(self.directory, 'pool.bin'), 'rb')
+        if (os.path.getsize(fh.name) > 0):
+            self.pool = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.pool = b''
+        fh.close()
+        self.offsets = self.load('pool.offsets.npy')
+
+    def load(self, name):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def chrom(self, chrom):
+        key = str(chrom).upper()
+        if key not in self.chroms:
+            info = self.meta['chroms'].get(key)
+            if (info is None):
+                self.chroms[key] = None
+            else:
+                stem = info['stem']
+                self.chroms[key] = {
+                    'start': self.load(stem + '.start.npy'),
+                    'end': self.load(stem + '.end.npy'),
+                    'maxend': self.load(stem + '.maxend.npy'),
+                    'order': self.load(stem + '.order.npy'),
+                    'columns': [(self.load(stem + '.col_' + c + '.npy'),
+                        self.load(stem + '.col_' + c + '.null.npy'))
+                        for c in self.columns]}
+        return self.chroms[key]
+
+    def value(self, kind, data, nulls, i):
+        if (nulls is not None) and nulls[i]:
+            return None
+        if (kind == 'int'):
+            return int(data[i])
+        elif (kind == 'float'):
+            return float(data[i])
+
+        sid = int(data[i])
+        raw = self.pool[int(self.offsets[sid]):int(self.offsets[sid + 1])]
+        if (kind == 'bytes'):
+            return bytes(raw)
+        text = bytes(raw).decode('utf-8')
+        if (kind == 'decimal'):
+            return decimal.Decimal(text)
+        return text
+
+    def row(self, chrom, i, columns=None):
+        if (columns is None):
+            columns = range(len(self.columns))
+        return tuple([self.value(self.kinds[c], chrom['columns'][c][0],
+            chrom['columns'][c][1], i) for c in columns])
+
+    def overlapRange(self, chrom, lo, hi, columns=None):
+        c = self.chrom(chrom)
+        if (c is None):
+            return []
+
+        end = int(np.searchsorted(c['start'], hi, side='right'))
+        start = int(np.searchsorted(c['maxend'][:end], lo, side='left'))
+        hits = start + np.nonzero(c['end'][start:end] >= lo)[0]
+        if (len(hits) > 1):
+            hits = hits[np.argsort(c['order'][hits], kind='stable')]
+        return [self.row(c, int(i), columns) for i in hits]
+
+    def overlap(self, chrom, pos, columns=None):
+        return self.overlapRange(chrom, pos, pos, columns=columns)
+
+    def first(self, chrom, pos, columns=None):
+        rows = self.overlap(chrom, pos, columns=columns)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def columnIndices(self, names):
+        lower = [c.lower() for c in self.columns]
+        return [lower.index(n.lower()) for n in names]
+
+    """(start, end, order, ref) of every interval on chrom, by start
+       Rows are only built, with rowAt(), for the intervals that are used.
+    """
+    def iterChrom(self, chrom, chunk=65536):
+        c = self.chrom(chrom)
+        if (c is None):
+            return
+        for lo in range(0, len(c['start']), chunk):
+            starts = c['start'][lo:lo + chunk].tolist()
+            ends = c['end'][lo:lo + chunk].tolist()
+            orders = c['order'][lo:lo + chunk].tolist()
+            for i in range(len(starts)):
+                yield (starts[i], ends[i], orders[i], (c, lo + i))
+
+    def rowAt(self, ref, columns=None):
+        return self.row(ref[0], ref[1], columns)
+
+
+"""Open an exported table, or return None if it is not in the snapshot
+"""
+def openTable(directory, table):
+    key = (directory, table)
+    if key not in _tables:
+        if os.path.exists(os.path.join(directory, table, 'meta.json')):
+            _tables[key] = SnapshotTable(directory, table)
+        else:
+            _tables[key] = None
+    return _tables[key]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        export(sys.argv[1], tables=(sys.argv[2:] or None))
+    else:
+        print("A snapshot directory must be provided as input to this program.")
+
+### EOF
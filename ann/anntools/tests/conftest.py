@@ -0,0 +1,197 @@
+# tests/conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Shared fixtures for the AnnTools tests; run with "python -m pytest" from
+# the anntools directory
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import pytest
+
+# The AnnTools modules import each other by their plain names
+ANNTOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ANNTOOLS_DIR not in sys.path:
+    sys.path.insert(0, ANNTOOLS_DIR)
+
+import backends
+import driver
+from benchmark import refdb
+from benchmark import CHROM_LENGTHS
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Input of the driver tests; sample.annot.vcf and sample.vcf.count.log in
+# DATA_DIR are what the original pipeline made of it on the stand-in
+SAMPLE_VCF = os.path.join(DATA_DIR, 'sample.vcf')
+
+# Scale of the stand-in the driver tests run on (see refdb.build())
+STANDIN_SCALE = 0.0005
+
+# Tables found by interval overlap; planted() adds rows to these around
+# the positions of the input
+OVERLAP_TABLES = [t for t in refdb.TABLES if (t[0] != 'dbSNP') and
+    (t[0] not in refdb.BIGREFGENE_TABLES) and (t[0] != 'cytoBand')]
+
+# Runs driver.run in a process of its own: argv is the anntools directory,
+# the stand-in, the input and the options of runDriver() as JSON
+DRIVER_SCRIPT = '''
+import sys
+import json
+sys.path.insert(0, sys.argv[1])
+import utils
+from benchmark import refdb
+db, infile, options = sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+utils.db_connect = refdb.connector(db)
+for name, value in options['settings'].items():
+    module, attr = name.rsplit('.', 1)
+    setattr(__import__(module), attr, value)
+if options['snapshot']:
+    import annotate
+    import snapshot
+    snapshot.export(options['snapshot'])
+    annotate.SNAPSHOT_DIR = options['snapshot']
+import driver
+driver.run(infile, options['format'], processes=options['processes'],
+    compress=options['compress'], index=options['index'])
+'''
+
+
+"""Connection to the stand-in at path whose queries without an order by
+   return their rows in reverse, so that no result can depend on the
+   order the database happens to scan a table in
+"""
+def unordered(path):
+    conn = backends.SqliteConnection(path)
+    conn.conn.execute('pragma reverse_unordered_selects = 1;')
+    return conn
+
+
+"""SQLite stand-in holding only the given tables, each a (table, rows)
+   pair with the columns refdb gives it, prepared for both backends
+"""
+@pytest.fixture
+def tableDb(tmp_path):
+    def make(*tables):
+        path = str(tmp_path / 'tables.db')
+        conn = sqlite3.connect(path)
+        columns = dict([(t[0], t[1]) for t in refdb.TABLES])
+        for table, rows in tables:
+            refdb.createTable(conn, table, columns[table])
+            refdb.insertRows(conn, table, columns[table], rows)
+            refdb.createIndex(conn, table, columns[table],
+                [t[2] for t in refdb.TABLES if (t[0] == table)][0])
+        backends.prepare(conn)
+        conn.close()
+        return unordered(path)
+    return make
+
+
+"""Add rows to the overlap tables at the positions of the records of
+   vcf, each with probability rate, some of them twice with the same start
+   so that overlapping rows tie
+"""
+def planted(conn, vcf, rate=0.3, seed=0):
+    rng = random.Random(seed)
+    chroms = set([c for c, length in CHROM_LENGTHS])
+    rows = dict([(t[0], []) for t in OVERLAP_TABLES])
+    id = 800000000
+    fh = open(vcf)
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        chrom, pos = fields[0], int(fields[1])
+        for table, columns, chromcol, prefixed, real, mean in OVERLAP_TABLES:
+            if table.startswith('tfbsConsSites') and \
+                (table != 'tfbsConsSites' + chrom):
+                continue
+            if (table == 'genomicSuperDups') and (chrom not in chroms):
+                continue
+            if (rng.random() >= rate):
+                continue
+            size = rng.randint(0, min(mean, 5000)) if (mean > 1) else 0
+            start = pos - rng.randint(0, size)
+            for n in range(2 if (rng.random() < 0.2) else 1):
+                id = id + 1
+                rows[table].append(refdb.tableRow(rng, table, id, chrom,
+                    start, start + size + n))
+    fh.close()
+
+    for table, columns, chromcol, prefixed, real, mean in OVERLAP_TABLES:
+        refdb.insertRows(conn, table, columns, rows[table])
+    conn.commit()
+    return conn
+
+
+"""Store the rows of every table by start, so that the original stages'
+   queries, which have no order by, return overlapping rows in the order
+   backends defines for them (by start, then primary key) whichever index
+   SQLite scans; the stand-in has to be prepared again
+"""
+def clustered(conn):
+    for table, columns, chromcol, prefixed, real, mean in refdb.TABLES:
+        start = [c for c in refdb.START_COLUMNS if c in columns][0]
+        conn.execute('create temporary table clustered as select * from ' +
+            table + ' order by ' + start + ', rowid;')
+        conn.execute('delete from ' + table + ';')
+        conn.execute('insert into ' + table + ' select * from clustered ' +
+            'order by rowid;')
+        conn.execute('drop table clustered;')
+    conn.commit()
+    return conn
+
+
+"""Indexed SQLite stand-in for the reference database, with hits for the
+   records of SAMPLE_VCF in every table, built once per test session
+"""
+@pytest.fixture(scope='session')
+def standIn(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('standin') / 'reference.db')
+    conn = refdb.build(path, scale=STANDIN_SCALE, seed=0, vcf=SAMPLE_VCF,
+        verbose=False)
+    backends.prepare(clustered(planted(conn, SAMPLE_VCF)))
+    conn.close()
+    return path
+
+
+"""Runs driver.run on a copy of infile in a directory of its own, in a new
+   process with a fixed string hash seed (the order of some annotations
+   depends on it) and the reference database replaced by the stand-in;
+   settings maps "module.NAME" to the values to set before the run and env
+   holds environment variables to add. Returns the names of the outputs
+   (see driver.outputNames()).
+"""
+@pytest.fixture
+def runDriver(tmp_path, standIn):
+    runs = []
+
+    def run(infile=SAMPLE_VCF, format='vcf', processes=1, compress=False,
+        index=True, settings={}, env={}, snapshot=False):
+        directory = tmp_path / ('run' + str(len(runs)))
+        directory.mkdir()
+        runs.append(directory)
+        target = str(directory / os.path.basename(infile))
+        shutil.copy(infile, target)
+        options = {'format': format, 'processes': processes,
+            'compress': compress, 'index': index, 'settings': settings,
+            'snapshot': str(directory / 'snapshot') if snapshot else None}
+        environ = dict(os.environ)
+        environ.update(env)
+        environ['PYTHONHASHSEED'] = '0'
+        subprocess.run([sys.executable, '-c', DRIVER_SCRIPT, ANNTOOLS_DIR,
+            standIn, target, json.dumps(options)], env=environ, check=True,
+            cwd=str(directory), stdout=subprocess.DEVNULL)
+        return driver.outputNames(target, compress=compress)
+    return run
+
+### EOF
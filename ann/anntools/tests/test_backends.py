@@ -0,0 +1,120 @@
+# tests/test_backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Row order of the reference backends on an indexed database
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+import annotate
+import backends
+import intervals
+import variants
+from benchmark import refdb
+
+
+def dbSnpRow(rsid, ref, pos=100):
+    return ['1', pos, 'dbSNP', rsid, ref, 'G', '.', '.', 'SNV']
+
+
+def parse(line):
+    return variants.parseVariant(line, annotate.getFormatSpecificIndices())
+
+
+"""Both the per-variant and the batched lookup return the rows of a locus
+   in rowid order, whatever order the database reads them in
+"""
+def test_dbsnp_ties_follow_row_order(tableDb):
+    conn = tableDb(('dbSNP', [dbSnpRow('rs2', 'T'), dbSnpRow('rs1', 'A'),
+        dbSnpRow('rs3', 'A', pos=200)]))
+    batch = [parse('chr1\t100\t.\tA\tG\t.\t.\t.'),
+        parse('1\t200\t.\tT\tG\t.\t.\t.')]
+
+    for name in ['mysql', 'sqlite']:
+        stage = annotate.DbSnpStage(batch_size=0)
+        cursor = conn.cursor()
+        stage.backend = backends.SqliteBackend(cursor) if \
+            (name == 'sqlite') else backends.MySqlBackend(cursor)
+        single = [[row[3] for row in stage.lookup(fields)]
+            for fields in batch]
+        stage.batch_size = 500
+        batched = [[row[3] for row in rows]
+            for rows in stage.lookupBatch(batch)]
+        assert single == [['rs2', 'rs1'], ['rs3']]
+        assert batched == single
+
+
+def gadAllRow(id, start, end):
+    return [id, '1', start, 'GENE' + str(id), end]
+
+
+"""Rows overlapping a position come by start and then rowid from the
+   query, both R*Tree queries, the interval index and the sorted join
+"""
+def test_overlap_ties_follow_start_and_row_order(tableDb):
+    conn = tableDb(('gadAll', [gadAllRow(724, 50, 500),
+        gadAllRow(42, 10, 300), gadAllRow(7, 50, 400),
+        gadAllRow(9, 400, 600)]))
+    expected = [[42, 724, 7], [724, 9]]
+
+    intervals._indexes.clear()
+    for name in ['mysql', 'sqlite']:
+        cursor = conn.cursor()
+        backend = backends.SqliteBackend(cursor) if (name == 'sqlite') \
+            else backends.MySqlBackend(cursor)
+        queried = [[row[0] for row in backend.overlap('gadAll', '1', pos,
+            chromcol='chromosome')] for pos in [100, 450]]
+        assert queried == expected
+        assert backend.overlap('gadAll', '1', 100, chromcol='chromosome',
+            first=True)[0] == 42
+
+        index = intervals.loadIndex(backend, 'gadAll',
+            chromcol='chromosome')
+        assert [[row[0] for row in index.overlap('1', pos)]
+            for pos in [100, 450]] == expected
+        intervals._indexes.clear()
+
+        sweeper = intervals.SweepJoin(intervals.TableCursor(backend,
+            'gadAll', chromcol='chromosome'))
+        assert [[row[0] for row in sweeper.overlap('1', pos)]
+            for pos in [100, 450]] == expected
+
+
+def refseqRow(id, start, end, ref='A', alt='G'):
+    return refdb.refseqRow(random.Random(id), id, '1', start, end, ref, alt)
+
+
+"""The cascade picks the first table with a match for every variant, the
+   same in a batch as one variant at a time; an interval holding several
+   of the batch's positions is found for each of them
+"""
+def test_bigrefgene_cascade(tableDb):
+    conn = tableDb(('chrom_pos_equal_base', [refseqRow(1, 100, 100),
+        refseqRow(2, 100, 100, 'C', 'T')]),
+        ('chrom_pos_equal_nobase', [refseqRow(3, 100, 100),
+        refseqRow(4, 200, 200)]),
+        ('chrom_pos_unequal', [refseqRow(5, 298, 310),
+        refseqRow(6, 295, 305), refseqRow(7, 500, 600),
+        refseqRow(8, 90, 110)]))
+    batch = [parse('1\t' + str(pos) + '\t.\t' + ref + '\tG\t.\t.\t.')
+        for pos, ref in [(100, 'A'), (100, 'T'), (200, 'A'), (300, 'A'),
+        (302, 'A'), (550, 'A'), (700, 'A')]]
+    expected = [[1], [3], [4], [5, 6], [5, 6], [7], []]
+
+    for name in ['mysql', 'sqlite']:
+        stage = annotate.BigRefGeneStage(batch_size=0)
+        cursor = conn.cursor()
+        stage.backend = backends.SqliteBackend(cursor) if \
+            (name == 'sqlite') else backends.MySqlBackend(cursor)
+        single = [[row[0] for row in rows]
+            for rows in stage.lookupBatch(batch)]
+        stage.batch_size = 500
+        batched = [[row[0] for row in rows]
+            for rows in stage.lookupBatch(batch)]
+        assert single == expected
+        assert batched == expected
+
+### EOF
@@ -0,0 +1,231 @@
+# tests/test_driver.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Whole driver.run on the indexed SQLite stand-in against the output the
+# original pipeline made of the same input (tests/data/sample.*)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import gzip
+import json
+import random
+import pytest
+import vcfio
+import pileup2vcf
+from conftest import DATA_DIR, SAMPLE_VCF
+
+# Stages answered by OverlapStage.overlap() and firstOverlap()
+OVERLAP_STAGES = ['cytoBand', 'gadAll', 'gwasCatalog', 'targetScanS', 'hugo',
+    'dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+    'genomicSuperDups']
+
+
+def read(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt') as fh:
+            return fh.read()
+    with open(path) as fh:
+        return fh.read()
+
+
+def expected():
+    return (read(os.path.join(DATA_DIR, 'sample.annot.vcf')),
+        read(os.path.join(DATA_DIR, 'sample.vcf.count.log')))
+
+
+def assertBaseline(outputs):
+    finalout, logfile, statsfile = outputs
+    annotated, counts = expected()
+    assert read(finalout) == annotated
+    assert read(logfile) == counts
+    assert os.path.exists(statsfile)
+
+
+def infoSize(text):
+    return sum([len(line.split('\t')[7]) for line in text.split('\n')[:-1]
+        if not line.startswith('#')])
+
+
+"""The INFO bytes the stages added make up the growth of INFO, and stages
+   that fetched rows fetched bytes
+"""
+def test_default(runDriver):
+    finalout, logfile, statsfile = runDriver()
+    assertBaseline((finalout, logfile, statsfile))
+    stats = json.load(open(statsfile))
+    assert sum([s['info_bytes'] for s in stats['stages']]) == \
+        infoSize(read(finalout)) - infoSize(read(SAMPLE_VCF))
+    for entry in stats['stages']:
+        assert (entry['fetched_bytes'] > 0) == (entry['rows'] > 0)
+
+
+def test_compressed_output(runDriver):
+    outputs = runDriver(compress=True)
+    assert outputs[0].endswith('.gz')
+    assertBaseline(outputs)
+
+
+"""A coordinate index is written next to the output unless turned off
+"""
+@pytest.mark.parametrize('compress', [False, True])
+def test_output_index(runDriver, compress):
+    finalout = runDriver(compress=compress)[0]
+    assert os.path.exists(vcfio.indexName(finalout))
+    finalout = runDriver(compress=compress, index=False)[0]
+    assert not os.path.exists(vcfio.indexName(finalout))
+
+
+"""dbSNP queried one variant at a time, as the original stage did
+"""
+def test_dbsnp_per_variant(runDriver):
+    assertBaseline(runDriver(settings={'annotate.DBSNP_BATCH_SIZE': 0}))
+
+
+"""BigRefGene queried one variant at a time, as the original stage did
+"""
+def test_bigrefgene_per_variant(runDriver):
+    assertBaseline(runDriver(settings={'annotate.BIGREFGENE_BATCH_SIZE': 0}))
+
+
+"""Without the sorted join the overlap stages are answered from interval
+   indexes, each loaded with a single query; without either every record
+   is queried
+"""
+@pytest.mark.parametrize('indexed', [True, False])
+def test_interval_index(runDriver, indexed):
+    finalout, logfile, statsfile = runDriver(settings={
+        'annotate.USE_SWEEP_JOIN': False,
+        'annotate.USE_INTERVAL_INDEX': indexed})
+    assertBaseline((finalout, logfile, statsfile))
+    stats = json.load(open(statsfile))
+    queries = dict([(s['name'], s['queries']) for s in stats['stages']])
+    for name in OVERLAP_STAGES:
+        assert queries[name] == (1 if indexed else stats['records'])
+
+
+"""Every chromosome goes through the sorted join, or none does
+"""
+@pytest.mark.parametrize('records', [0, 10 ** 9])
+def test_sweep_threshold(runDriver, records):
+    assertBaseline(runDriver(settings={'annotate.SWEEP_MIN_RECORDS':
+        records}))
+
+
+"""Three processes annotate shards of the input; their stats are added up
+   into one report
+"""
+def test_processes(runDriver):
+    finalout, logfile, statsfile = runDriver(processes=3)
+    assertBaseline((finalout, logfile, statsfile))
+    stats = json.load(open(statsfile))
+    assert stats['processes'] == 3
+    assert stats['records'] == len([line for line in
+        read(SAMPLE_VCF).split('\n')[:-1] if not line.startswith('#')])
+
+
+"""The stand-in queried through the SQLite backend rather than as MySQL
+"""
+def test_sqlite_backend(runDriver, standIn):
+    assertBaseline(runDriver(env={'ANNTOOLS_REFERENCE_BACKEND': 'sqlite',
+        'ANNTOOLS_REFERENCE_DB': standIn}))
+
+
+"""The second run, in two processes, finds every lookup in the cache
+"""
+def test_variant_cache(runDriver, tmp_path):
+    env = {'ANNTOOLS_VARIANT_CACHE': str(tmp_path / 'cache.db')}
+    assertBaseline(runDriver(env=env))
+    finalout, logfile, statsfile = runDriver(env=env, processes=2)
+    assertBaseline((finalout, logfile, statsfile))
+    cache = json.load(open(statsfile))['variant_cache']
+    assert (cache['misses'] == 0) and (cache['hits'] > 0)
+
+
+"""Stages looked up one after another rather than concurrently
+"""
+def test_one_stage_thread(runDriver):
+    assertBaseline(runDriver(env={'ANNTOOLS_STAGE_THREADS': '1'}))
+
+
+def shuffled(directory):
+    lines = read(SAMPLE_VCF).split('\n')[:-1]
+    header = [line for line in lines if line.startswith('#')]
+    records = [line for line in lines if not line.startswith('#')]
+    order = list(range(len(records)))
+    random.Random(0).shuffle(order)
+    path = str(directory / 'sample.vcf')
+    with open(path, 'w') as fh:
+        fh.write('\n'.join(header + [records[i] for i in order]) + '\n')
+    return (path, order)
+
+
+"""Shuffled records annotate to the same records, written in the order
+   they were read; once the sorted join finds them out of order the
+   overlap stages answer them from the interval index, loaded with one
+   query per process, rather than querying every record
+"""
+@pytest.mark.parametrize('processes', [1, 3])
+def test_shuffled_input(runDriver, tmp_path, processes):
+    infile, order = shuffled(tmp_path)
+    annotated, counts = expected()
+    lines = annotated.split('\n')[:-1]
+    baseline = [line for line in lines if not line.startswith('#')]
+    finalout, logfile, statsfile = runDriver(infile=infile,
+        processes=processes)
+    lines = read(finalout).split('\n')[:-1]
+    assert [line for line in lines if line.startswith('#')] == \
+        [line for line in annotated.split('\n') if line.startswith('#')]
+    assert [line for line in lines if not line.startswith('#')] == \
+        [baseline[i] for i in order]
+    assert read(logfile) == counts
+
+    stats = json.load(open(statsfile))
+    queries = dict([(s['name'], s['queries']) for s in stats['stages']])
+    for name in OVERLAP_STAGES:
+        assert queries[name] < 20 * processes
+
+
+"""With a snapshot every table it holds is read from it, sorted input or
+   not, and only dbSNP and BigRefGene are queried
+"""
+def test_snapshot(runDriver, tmp_path):
+    assertBaseline(runDriver(snapshot=True))
+    infile, order = shuffled(tmp_path)
+    finalout, logfile, statsfile = runDriver(infile=infile, snapshot=True)
+    assert read(logfile) == expected()[1]
+    stats = json.load(open(statsfile))
+    for entry in stats['stages']:
+        if entry['name'] not in ['dbSNP', 'BigRefGene']:
+            assert entry['queries'] == 0
+
+
+"""A pileup annotates like the VCF pileup2vcf converts it to, in one
+   process and in several
+"""
+def test_pileup_input(runDriver, tmp_path):
+    rng = random.Random(0)
+    pileup = str(tmp_path / 'sample.pileup')
+    with open(pileup, 'w') as fh:
+        for line in read(SAMPLE_VCF).split('\n')[:-1]:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            alt = rng.choice([fields[4], fields[4], fields[3], 'R', 'Y'])
+            chrom = rng.choice([fields[0]] * 9 + ['GL000192.1'])
+            fh.write('\t'.join([chrom, fields[1], fields[3], alt, '60', '60',
+                '40', '12', '..,,AaA.a,,', 'IIIIIIIIIII']) + '\n')
+    vcf = str(tmp_path / 'converted.vcf')
+    pileup2vcf.filter_pileup(pileup, outfile=vcf)
+
+    converted = runDriver(infile=vcf)
+    for processes in [1, 3]:
+        outputs = runDriver(infile=pileup, format='pileup',
+            processes=processes)
+        assert read(outputs[0]) == read(converted[0])
+        assert read(outputs[1]) == read(converted[1])
+
+### EOF
@@ -0,0 +1,210 @@
+# tests/test_intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Interval index, sorted join and streamed table reads against a
+# brute-force overlap
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+import annotate
+import backends
+import intervals
+import perfstats
+import utils
+import variants
+
+
+def randomRows(seed, count=300):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        chrom = rng.choice(['chr1', 'chr2'])
+        start = rng.randint(0, 5000)
+        rows.append([i, chrom, start, start + rng.randint(0, 400),
+            'cnv' + str(i)])
+    return rows
+
+
+def bruteForce(rows, chrom, pos):
+    hits = [(row[2], r, row) for r, row in enumerate(rows)
+        if (row[1] == chrom) and (row[2] <= pos) and (pos <= row[3])]
+    return [tuple(row) for start, r, row in sorted(hits)]
+
+
+def test_index_and_join_match_brute_force():
+    rows = randomRows(1)
+    index = intervals.IntervalIndex(columns=['bin', 'chrom', 'chromStart',
+        'chromEnd', 'name'])
+    for row in sorted(rows, key=lambda r: r[2]):
+        index.add(row[1], row[2], row[3], tuple(row))
+    index.build()
+    sweeper = intervals.SweepJoin(index)
+
+    for chrom in ['chr1', 'chr2']:
+        for pos in range(0, 5600, 7):
+            expected = bruteForce(rows, chrom, pos)
+            assert index.overlap(chrom, pos) == expected
+            assert sweeper.overlap(chrom, pos) == expected
+    assert sweeper.overlap('chr1', 10) is None
+
+
+"""A streamed chromosome is read a block at a time as the join advances
+"""
+def test_table_cursor_streams(tableDb, monkeypatch):
+    rows = randomRows(2)
+    conn = tableDb(('dgv_Cnv', rows))
+    monkeypatch.setattr(backends, 'STREAM_ROWS', 10)
+    stats = perfstats.newStats()
+    backend = backends.MySqlBackend(conn.cursor())
+    source = intervals.TableCursor(backend, 'dgv_Cnv',
+        cursor=lambda: perfstats.StatsCursor(backends.streamCursor(conn),
+        stats))
+    sweeper = intervals.SweepJoin(source)
+
+    assert sweeper.overlap('chr1', 0) == bruteForce(rows, 'chr1', 0)
+    assert stats['rows'] <= 20
+    for pos in range(0, 5600, 11):
+        assert sweeper.overlap('chr1', pos) == bruteForce(rows, 'chr1', pos)
+    for pos in range(0, 5600, 13):
+        assert sweeper.overlap('chr2', pos) == bruteForce(rows, 'chr2', pos)
+    assert stats['queries'] == 2
+    assert stats['rows'] == len(rows)
+    source.close()
+
+
+class OverlapRows(annotate.OverlapStage):
+    table = 'dgv_Cnv'
+
+    def lookup(self, fields):
+        return self.overlap(fields.chromPrefixed, fields.pos)
+
+
+"""Chromosomes with few records in a batch are queried record by record
+   and only the others are streamed, on a connection from the pool that
+   goes back to it when the stage is closed; both give the same rows
+"""
+def test_overlap_stage_streams_only_busy_chromosomes(tableDb, monkeypatch):
+    rows = randomRows(3)
+    conn = tableDb(('dgv_Cnv', rows))
+    monkeypatch.setattr(utils, '_pool',
+        utils.ConnectionPool(connect=lambda: conn))
+    monkeypatch.setattr(annotate, 'SWEEP_MIN_RECORDS', 5)
+    inds = annotate.getFormatSpecificIndices()
+    batch = [variants.parseVariant('chr1\t' + str(pos) + '\t.\tA\tG', inds)
+        for pos in range(100, 5000, 300)] + \
+        [variants.parseVariant('chr2\t' + str(pos) + '\t.\tA\tG', inds)
+        for pos in [200, 4000]]
+
+    stage = OverlapRows(sweep=True)
+    stage.open(perfstats.StatsCursor(conn.cursor(), stage.stats))
+    results = stage.lookupBatch(batch)
+    assert results == [bruteForce(rows, f.chromPrefixed, f.pos)
+        for f in batch]
+    assert stage.joined == '1'
+    assert stage.stats['queries'] == 3
+    assert utils.db_pool().stats()['open'] == 1
+    stage.close()
+    assert utils.db_pool().stats()['idle'] == 1
+
+
+"""Without the sorted join a stage answers every record, in any order,
+   from the interval index
+"""
+def test_overlap_stage_uses_index(tableDb, monkeypatch):
+    rows = randomRows(5)
+    conn = tableDb(('dgv_Cnv', rows))
+    monkeypatch.setattr(intervals, '_indexes', {})
+    inds = annotate.getFormatSpecificIndices()
+    batch = [variants.parseVariant(chrom + '\t' + str(pos) + '\t.\tA\tG',
+        inds) for chrom in ['chr2', 'chr1'] for pos in range(5000, 0, -89)]
+
+    stage = OverlapRows(sweep=False, indexed=True)
+    stage.open(perfstats.StatsCursor(conn.cursor(), stage.stats))
+    assert isinstance(stage.index, intervals.IntervalIndex)
+    assert stage.lookupBatch(batch) == [bruteForce(rows, f.chromPrefixed,
+        f.pos) for f in batch]
+    assert stage.firstOverlap('chr1', 2500) == \
+        (bruteForce(rows, 'chr1', 2500) + [None])[0]
+    assert stage.stats['queries'] == 1
+    stage.close()
+
+
+"""Once a record is out of order the stage stops the join and answers the
+   records from the interval index, loaded with one query
+"""
+def test_overlap_stage_falls_back_to_index(tableDb, monkeypatch):
+    rows = randomRows(4)
+    conn = tableDb(('dgv_Cnv', rows))
+    monkeypatch.setattr(utils, '_pool',
+        utils.ConnectionPool(connect=lambda: conn))
+    monkeypatch.setattr(intervals, '_indexes', {})
+    monkeypatch.setattr(annotate, 'SWEEP_MIN_RECORDS', 1)
+    inds = annotate.getFormatSpecificIndices()
+    batch = [variants.parseVariant('chr1\t' + str(pos) + '\t.\tA\tG', inds)
+        for pos in [300, 900, 200] + list(range(5000, 0, -97))]
+
+    stage = OverlapRows(sweep=True, indexed=True)
+    stage.open(perfstats.StatsCursor(conn.cursor(), stage.stats))
+    results = stage.lookupBatch(batch)
+    assert results == [bruteForce(rows, f.chromPrefixed, f.pos)
+        for f in batch]
+    assert (stage.sweeper is None) and (stage.stream is None)
+    assert isinstance(stage.index, intervals.IntervalIndex)
+    assert stage.stats['queries'] == 2
+    assert stage.firstOverlap('chr1', 2500) == \
+        (bruteForce(rows, 'chr1', 2500) + [None])[0]
+    assert stage.stats['queries'] == 2
+
+    first = OverlapRows(sweep=True, indexed=True)
+    first.open(perfstats.StatsCursor(conn.cursor(), first.stats))
+    for pos in [3000, 1000]:
+        assert first.firstOverlap('chr1', pos) == \
+            (bruteForce(rows, 'chr1', pos) + [None])[0]
+    assert first.index is stage.index
+    first.close()
+    stage.close()
+
+
+"""tfbsConsSites streams one chromosome's table at a time; moving on to
+   another ends the join with the one before
+"""
+def test_tfbs_streams_one_table_at_a_time(tableDb, monkeypatch):
+    tables = {}
+    for c in ['1', '2']:
+        tables[c] = [[0, 'chr' + c] + row[2:] + [500]
+            for row in randomRows(int(c))]
+    conn = tableDb(('tfbsConsSites1', tables['1']),
+        ('tfbsConsSites2', tables['2']))
+    monkeypatch.setattr(utils, '_pool',
+        utils.ConnectionPool(connect=lambda: conn))
+    monkeypatch.setattr(annotate, 'SWEEP_MIN_RECORDS', 3)
+    inds = annotate.getFormatSpecificIndices()
+
+    def batch(chrom, positions):
+        return [variants.parseVariant('chr' + chrom + '\t' + str(pos) +
+            '\t.\tA\tG', inds) for pos in positions]
+
+    def expected(batch, chrom):
+        return [[row[1:5] for row in bruteForce(tables[chrom],
+            f.chromPrefixed, f.pos)] for f in batch]
+
+    stage = annotate.TfbsConsSitesStage(sweep=True)
+    stage.open(conn.cursor())
+    first = batch('1', range(100, 5000, 400))
+    few = batch('2', [50, 70])
+    assert stage.lookupBatch(first + few) == expected(first, '1') + \
+        expected(few, '2')
+    assert stage.streamed == '1'
+    assert '2' not in stage.sweepers
+
+    second = batch('2', range(100, 5000, 500))
+    assert stage.lookupBatch(second) == expected(second, '2')
+    assert stage.streamed == '2'
+    assert stage.sweepers['1'] == (None, None)
+    stage.close()
+
+### EOF
@@ -0,0 +1,79 @@
+# tests/test_pileup2vcf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Variant pileup to VCF conversion, in one process and in several
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+import pileup2vcf
+
+
+def test_count_alt():
+    assert pileup2vcf.count_alt('10', '..,,*AaGg') == 5
+    assert pileup2vcf.count_alt('3', '...') == 0
+
+
+def test_hetero2homo():
+    assert pileup2vcf.hetero2homo('A', 'R') == 'G'
+    assert pileup2vcf.hetero2homo('G', 'R') == 'A'
+    assert pileup2vcf.hetero2homo('C', 'R') == 'A'
+    assert pileup2vcf.hetero2homo('A', 'T') == 'T'
+
+
+def test_varpileup_line2vcf_line():
+    assert pileup2vcf.varpileup_line2vcf_line(['1', '100', 'A', 'G', '50',
+        '60', '40', '8', '..AAaa,,']) == \
+        '1\t100\t.\tA\tG\t40\tPASS\t.\tGT:GQ:DP:AD\t1/1:50:8:4'
+    assert pileup2vcf.varpileup_line2vcf_line(['X', '7', 'A', 'R', '50',
+        '60', '40', '8', '..AAaa,,']) == \
+        'X\t7\t.\tA\tG\t40\tPASS\t.\tGT:GQ:DP:AD\t0/1:50:8:4'
+
+
+"""Only variants (ALT other than REF) on the accepted chromosomes are kept
+"""
+def test_pileup_lines2vcf():
+    lines = ['1\t100\tA\tG\t50\t60\t40\t8\t..AAaa,,\tIIIIIIII',
+        '1\t101\tA\tA\t50\t60\t40\t8\t........\tIIIIIIII',
+        'GL000192.1\t5\tC\tT\t50\t60\t40\t2\ttt\tII',
+        '', 'MT\t9\tC\tY\t50\t60\t40\t2\t.t\tII']
+    assert pileup2vcf.pileup_lines2vcf(lines) == [
+        '1\t100\t.\tA\tG\t40\tPASS\t.\tGT:GQ:DP:AD\t1/1:50:8:4',
+        'MT\t9\t.\tC\tT\t40\tPASS\t.\tGT:GQ:DP:AD\t0/1:50:2:1']
+
+
+"""Ranges converted by several processes come back in the order of the
+   pileup, as one process converts them
+"""
+def test_convert_ranges(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    path = str(tmp_path / 'in.pileup')
+    with open(path, 'w') as fh:
+        for i in range(5000):
+            ref = rng.choice('ACGT')
+            fh.write('\t'.join([rng.choice(['1', '2', 'X', 'Un']),
+                str(i + 1), ref, rng.choice([ref, ref, 'A', 'C', 'M', 'K']),
+                '50', '60', '40', '6', '..,AcG', 'IIIIII']) + '\n')
+    monkeypatch.setattr(pileup2vcf, 'RANGE_BYTES', 10000)
+
+    single = list(pileup2vcf.convert_ranges(path, processes=1))
+    assert len(single) > 10
+    assert sum([n for n, m, text in single]) == 5000
+    assert list(pileup2vcf.convert_ranges(path, processes=3)) == single
+
+    converted = ''.join([text for n, m, text in single])
+    with open(path) as fh:
+        assert converted.split('\n')[:-1] == \
+            pileup2vcf.pileup_lines2vcf(fh.readlines())
+
+    out = str(tmp_path / 'out.vcf')
+    counts = pileup2vcf.filter_pileup(path, outfile=out, processes=3)
+    assert (counts['lines'], counts['records']) == (5000,
+        sum([m for n, m, text in single]))
+    with open(out) as fh:
+        assert fh.read() == pileup2vcf.vcfheader(path) + '\n' + converted
+
+### EOF
@@ -0,0 +1,103 @@
+# tests/test_secret_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Secrets Manager cache the reference database credentials come through
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import threading
+import pytest
+# utils puts the util directory shared with the other GAS components,
+# where secret_cache lives, on the path
+import utils
+import secret_cache
+from botocore.exceptions import ClientError
+
+
+class FakeSecrets(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def get_secret_value(self, SecretId=None):
+        with self.lock:
+            self.calls = self.calls + 1
+        time.sleep(0.05)
+        if (self.error is not None):
+            raise self.error
+        return {'SecretString': json.dumps({'id': SecretId,
+            'call': self.calls})}
+
+
+def secretCache(ttl=3600, **kwargs):
+    cache = secret_cache.SecretCache('us-east-1', ttl=ttl, **kwargs)
+    cache.client = FakeSecrets()
+    return cache
+
+
+def test_secret_is_fetched_once_per_ttl():
+    cache = secretCache()
+    assert cache.get('rds') == {'id': 'rds', 'call': 1}
+    assert cache.get('rds') == {'id': 'rds', 'call': 1}
+    assert (cache.fetches, cache.hits) == (1, 1)
+
+    cache.ttl = 0
+    assert cache.get('rds') == {'id': 'rds', 'call': 2}
+
+
+"""Threads that need an expired secret at the same time share one fetch
+"""
+def test_secret_is_fetched_once_by_concurrent_threads():
+    cache = secretCache()
+    got = []
+    threads = [threading.Thread(target=lambda: got.append(cache.get('rds')))
+        for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert got == [{'id': 'rds', 'call': 1}] * 8
+    assert cache.client.calls == 1
+
+
+def test_stale_secret_is_used_when_refresh_fails():
+    cache = secretCache(ttl=0)
+    error = ClientError({'Error': {'Code': 'ThrottlingException',
+        'Message': 'Rate exceeded'}}, 'GetSecretValue')
+    cache.client.error = error
+    with pytest.raises(ClientError):
+        cache.get('rds')
+
+    cache.client.error = None
+    assert cache.get('rds') == {'id': 'rds', 'call': 2}
+    cache.client.error = error
+    assert cache.get('rds') == {'id': 'rds', 'call': 2}
+    assert cache.stale == 1
+
+
+def test_secret_cache_file(tmp_path):
+    if (secret_cache.Fernet is None):
+        pytest.skip('cryptography is not installed')
+    key = secret_cache.Fernet.generate_key()
+    path = str(tmp_path / 'secrets')
+    cache = secretCache(cache_file=path, cache_key=key)
+    assert cache.get('rds') == {'id': 'rds', 'call': 1}
+    assert b'rds' not in open(path, 'rb').read()
+
+    restarted = secretCache(cache_file=path, cache_key=key)
+    assert restarted.get('rds') == {'id': 'rds', 'call': 1}
+    assert restarted.client.calls == 0
+
+    other = secretCache(cache_file=path,
+        cache_key=secret_cache.Fernet.generate_key())
+    assert other.get('rds') == {'id': 'rds', 'call': 1}
+    assert other.client.calls == 1
+
+### EOF
@@ -0,0 +1,106 @@
+# tests/test_utils.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reference database connection pool shared by the annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import threading
+import utils
+
+
+class FakeConnection(object):
+
+    def __init__(self, id):
+        self.id = id
+        self.alive = True
+        self.closed = False
+
+    def ping(self, reconnect=True):
+        if not self.alive:
+            raise OSError('gone away')
+
+    def close(self):
+        self.closed = True
+
+
+def fakeConnect():
+    made = []
+
+    def connect():
+        made.append(FakeConnection(len(made)))
+        return made[-1]
+    return (made, connect)
+
+
+def test_pool_reuses_connections():
+    made, connect = fakeConnect()
+    pool = utils.ConnectionPool(connect=connect, max_size=2)
+    first = pool.acquire()
+    second = pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert pool.acquire() is second
+    assert pool.acquire() is first
+    assert len(made) == 2
+    assert pool.stats() == {'created': 2, 'reused': 2, 'discarded': 0,
+        'evicted': 0, 'open': 2, 'idle': 0}
+
+
+"""acquire() waits for a connection to be released once max_size are open
+"""
+def test_pool_waits_when_exhausted():
+    made, connect = fakeConnect()
+    pool = utils.ConnectionPool(connect=connect, max_size=1)
+    conn = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive() and (got == [])
+    pool.release(conn)
+    waiter.join(5)
+    assert got == [conn]
+    assert len(made) == 1
+
+
+"""reserve() raises max_size and wakes a waiting acquire()
+"""
+def test_pool_reserve_wakes_waiters():
+    made, connect = fakeConnect()
+    pool = utils.ConnectionPool(connect=connect, max_size=1)
+    pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    pool.reserve(2)
+    waiter.join(5)
+    assert got == [made[1]]
+    pool.reserve(1)
+    assert pool.max_size == 2
+
+
+def test_pool_replaces_dead_and_idle_connections():
+    made, connect = fakeConnect()
+    pool = utils.ConnectionPool(connect=connect, max_size=2, max_idle=60,
+        ping_after=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.alive = False
+    fresh = pool.acquire()
+    assert (fresh is not conn) and conn.closed
+    assert pool.stats()['discarded'] == 1
+
+    pool.release(fresh)
+    pool.idle = [(c, last_used - 120) for c, last_used in pool.idle]
+    assert pool.acquire() is made[2]
+    assert fresh.closed
+    assert pool.stats() == {'created': 3, 'reused': 0, 'discarded': 1,
+        'evicted': 1, 'open': 1, 'idle': 0}
+
+### EOF
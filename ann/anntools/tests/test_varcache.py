@@ -0,0 +1,77 @@
+# tests/test_varcache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Node-local variant cache: lookups stored by one job are found by the
+# next one with the same reference version
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import varcache
+
+STAGES = ['dbSNP/SNV', 'cytoBand']
+
+
+def batch():
+    return [['1', '100', '.', 'A', 'G'], ['1', '200', '.', 'C', 'T'],
+        ['2', '100', '.', 'A', 'G'], ['1', '100', '.', 'A', 'G']]
+
+
+def test_stored_lookups_are_found(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = varcache.VariantCache(path)
+    assert cache.fetch(batch(), STAGES) == [{}, {}]
+    cache.store(batch(), STAGES, [{0: (('rs1',),), 2: ()},
+        {0: ('p36',), 1: ('p35',), 2: ('q11',)}])
+    cache.close()
+
+    cache = varcache.VariantCache(path)
+    found = cache.fetch(batch(), STAGES)
+    assert found == [{0: (('rs1',),), 2: (), 3: (('rs1',),)},
+        {0: ('p36',), 1: ('p35',), 2: ('q11',), 3: ('p36',)}]
+    assert cache.fetch(batch(), ['dbSNP/MIXED']) == [{}]
+    cache.close()
+
+
+def test_versions_are_kept_apart(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = varcache.VariantCache(path, version='hg19')
+    cache.store(batch(), STAGES, [{0: ('hg19',)}, {}])
+    other = varcache.VariantCache(path, version='hg38')
+    assert other.fetch(batch(), STAGES) == [{}, {}]
+    other.store(batch(), STAGES, [{0: ('hg38',)}, {}])
+    assert cache.fetch(batch(), STAGES)[0] == {0: ('hg19',), 3: ('hg19',)}
+    assert other.fetch(batch(), STAGES)[0] == {0: ('hg38',), 3: ('hg38',)}
+    cache.close()
+    other.close()
+
+
+"""Least recently used lookups are evicted once the cache is too big
+"""
+def test_eviction(tmp_path):
+    cache = varcache.VariantCache(str(tmp_path / 'cache.db'), max_mb=1)
+    records = [['1', str(pos), '.', 'A', 'G'] for pos in range(3000)]
+    for i in range(0, 3000, 1000):
+        if (i == 2000):
+            cache.store(records[:1], STAGES[:1], [{}], hits=[0])
+        cache.store(records[i:i + 1000], STAGES[:1],
+            [dict([(k, ('x' * 300,)) for k in range(1000)])])
+
+    assert cache.evicted == 1000
+    assert cache.size() <= cache.max_bytes
+    found = cache.fetch(records, STAGES[:1])[0]
+    assert (0 in found) and (1 not in found) and (2999 in found)
+    assert len(found) == 2000
+    cache.close()
+
+
+def test_unusable_cache_is_given_up(tmp_path):
+    cache = varcache.VariantCache(str(tmp_path))
+    assert cache.failed
+    assert cache.fetch(batch(), STAGES) == [{}, {}]
+    cache.store(batch(), STAGES, [{0: ()}, {}])
+    cache.close()
+
+### EOF
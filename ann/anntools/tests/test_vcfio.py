@@ -0,0 +1,196 @@
+# tests/test_vcfio.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reading gzip/bgzip VCFs, writing BGZF output and the coordinate indexes
+# written with it
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import json
+import struct
+import random
+import pytest
+import vcfio
+import vcfindex
+
+HEADER = '##fileformat=VCFv4.0\n' + \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+"""Sorted records on three chromosomes, long enough to fill several BGZF
+   blocks and linear index windows
+"""
+def records(count=3000, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for chrom in ['1', '2', 'X']:
+        pos = 0
+        for i in range(count // 3):
+            pos = pos + rng.randint(1, 2000)
+            lines.append('\t'.join([chrom, str(pos), '.', 'A', 'G', '.',
+                'PASS', 'DP=' + str(i) + ';' + 'x' * rng.randint(0, 80)]) +
+                '\n')
+    return lines
+
+
+def write(path, lines, index=True):
+    with vcfio.openOutput(path, threads=2, index=index) as fh:
+        fh.write(HEADER)
+        fh.writeRecords(lines[:len(lines) // 2])
+        fh.writeRecords(lines[len(lines) // 2:])
+
+
+def test_bgzf_output(tmp_path):
+    lines = records()
+    path = str(tmp_path / 'out.vcf.gz')
+    write(path, lines, index=False)
+
+    data = open(path, 'rb').read()
+    assert data.endswith(vcfio.BGZF_EOF)
+    assert data.count(b'BC\x02\x00') > 3
+    assert gzip.decompress(data).decode('utf-8') == HEADER + ''.join(lines)
+    assert vcfio.isBgzf(path)
+
+
+"""gzip and BGZF input read the same as the plain file, line by line and
+   in chunks
+"""
+def test_compressed_input(tmp_path):
+    text = HEADER + ''.join(records())
+    plain = tmp_path / 'in.vcf'
+    plain.write_text(text)
+    with gzip.open(str(tmp_path / 'in.vcf.gz'), 'wt') as fh:
+        fh.write(text)
+    write(str(tmp_path / 'in.vcf.bgz'), records(), index=False)
+
+    for name in ['in.vcf', 'in.vcf.gz', 'in.vcf.bgz']:
+        path = str(tmp_path / name)
+        with vcfio.openInput(path) as fh:
+            assert fh.read() == text
+        lines = []
+        for chunk in vcfio.readChunks(path, size=5000):
+            lines.extend([str(chunk.line(i), 'utf-8')
+                for i in range(len(chunk))])
+        assert lines == text.split('\n')[:-1]
+
+
+"""Window of every record of every chromosome, by first record
+"""
+def windows(lines):
+    first = {}
+    for line in lines:
+        fields = line.split('\t')
+        key = (fields[0], (int(fields[1]) - 1) >> vcfindex.MIN_SHIFT)
+        if key not in first:
+            first[key] = line
+    return first
+
+
+def test_tabix_index(tmp_path):
+    lines = records()
+    path = str(tmp_path / 'out.vcf.gz')
+    write(path, lines)
+    data = open(path, 'rb').read()
+
+    tbi = gzip.decompress(open(vcfio.indexName(path), 'rb').read())
+    assert tbi[:4] == b'TBI\x01'
+    count, preset, col_seq, col_beg, col_end, meta, skip, length = \
+        struct.unpack('<8i', tbi[4:36])
+    assert (count, preset, col_seq, col_beg, meta) == \
+        (3, vcfindex.TBX_VCF, 1, 2, ord('#'))
+    names = tbi[36:36 + length].split(b'\0')[:-1]
+    assert names == [b'1', b'2', b'X']
+
+    offset = 36 + length
+    first = windows(lines)
+    for name in names:
+        bins, = struct.unpack('<i', tbi[offset:offset + 4])
+        offset = offset + 4
+        for b in range(bins):
+            bin, chunks = struct.unpack('<Ii', tbi[offset:offset + 8])
+            offset = offset + 8 + 16 * chunks
+        linear, = struct.unpack('<i', tbi[offset:offset + 4])
+        offset = offset + 4
+        voffsets = struct.unpack('<' + str(linear) + 'Q',
+            tbi[offset:offset + 8 * linear])
+        offset = offset + 8 * linear
+        for w, voffset in enumerate(voffsets):
+            line = first.get((str(name, 'utf-8'), w))
+            if (line is None):
+                continue
+            text = gzip.decompress(data[voffset >> 16:])
+            start = voffset & 0xffff
+            assert text[start:start + len(line)].decode('utf-8') == line
+
+
+def test_plain_output_and_linear_index(tmp_path):
+    lines = records()
+    path = str(tmp_path / 'out.vcf')
+    write(path, lines)
+
+    data = open(path, 'rb').read()
+    assert data.decode('utf-8') == HEADER + ''.join(lines)
+    index = json.load(open(vcfio.indexName(path)))
+    assert index['window'] == 1 << vcfindex.MIN_SHIFT
+    assert [c['name'] for c in index['chroms']] == ['1', '2', 'X']
+    assert sum([c['count'] for c in index['chroms']]) == len(lines)
+
+    first = windows(lines)
+    for chrom in index['chroms']:
+        for w, offset in enumerate(chrom['offsets']):
+            line = first.get((chrom['name'], w))
+            if (line is not None):
+                assert data[offset:offset + len(line)].decode('utf-8') == \
+                    line
+
+
+def test_unsorted_output_has_no_index(tmp_path):
+    lines = records(count=30)
+    path = str(tmp_path / 'out.vcf.gz')
+    lines = lines[1:2] + lines[:1] + lines[2:]
+    write(path, lines)
+    assert gzip.decompress(open(path, 'rb').read()).decode('utf-8') == \
+        HEADER + ''.join(lines)
+    assert not (tmp_path / 'out.vcf.gz.tbi').exists()
+
+
+"""Runs of headers and of records on one chromosome, with and without
+   NumPy
+"""
+@pytest.mark.parametrize('numpy', [True, False])
+def test_chunk_runs(tmp_path, monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(vcfio, 'np', None)
+    elif (vcfio.np is None):
+        pytest.skip('NumPy is not installed')
+    path = tmp_path / 'in.vcf'
+    path.write_text(HEADER + '1\t10\n1\t20\n10\t5\n#late\n10\t7\n' +
+        '  2\t1\n\n2\t3\nX')
+    runs = [chunk.split() for chunk in vcfio.readChunks(str(path))]
+    assert runs == [[(0, 2, None), (2, 4, '1'), (4, 5, '10'),
+        (5, 6, None), (6, 7, '10'), (7, 8, '2'), (8, 9, ''), (9, 10, '2'),
+        (10, 11, 'X')]]
+
+
+"""The columns of every run's records are those of its lines, stripped
+   and split, whichever chunks the lines fall in
+"""
+def test_chunk_columns(tmp_path):
+    lines = records(count=300)
+    lines[5] = ' ' + lines[5].replace('\n', ' \r\n')
+    path = tmp_path / 'in.vcf'
+    path.write_text(HEADER + ''.join(lines))
+    columns = []
+    for chunk in vcfio.readChunks(str(path), size=2000):
+        for first, stop, chrom in chunk.split():
+            if (chrom is not None):
+                cols = chunk.columns(first, stop, count=5)
+                assert [c[0] for c in cols] == [chrom] * (stop - first)
+                columns.extend(cols)
+    assert columns == [line.strip().split('\t', 5) for line in lines]
+
+### EOF
@@ -0,0 +1,123 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pre-parsed refGene transcripts for the gene structure stage
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bisect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Where a position lies in a transcript, as used by annotate.GenesStage
+NON_CODING = 'non_coding'
+CDS = 'cds'
+PROMOTER = 'promoter'
+
+# Transcripts already parsed by this process, keyed by refGene row
+_transcripts = {}
+
+
+"""One refGene row with its exon boundaries parsed
+   When the exons are in order and do not overlap (as they are in refGene),
+   the only exon that can contain a position is the last one starting at
+   or before it, which is found with a binary search; otherwise every exon
+   is tested. With NumPy, the positions of a whole batch are searched at
+   once.
+"""
+class Transcript(object):
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.starts = [int(x) for x in
+            blobText(row[9]).split(',')[:self.exonCount]]
+        self.ends = [int(x) for x in
+            blobText(row[10]).split(',')[:self.exonCount]]
+
+        self.ordered = all([(self.starts[e] <= self.starts[e + 1]) and
+            (self.ends[e] < self.starts[e + 1])
+            for e in range(len(self.starts) - 1)])
+        self.arrays = None
+        if self.ordered and (np is not None):
+            self.arrays = (np.array(self.starts, dtype=np.int64),
+                np.array(self.ends, dtype=np.int64))
+
+    """Indices of the exons containing pos
+    """
+    def exonsAt(self, pos):
+        if self.ordered:
+            e = bisect.bisect_right(self.starts, pos) - 1
+            if (e >= 0) and (pos <= self.ends[e]):
+                return [e]
+            return []
+        return [e for e in range(len(self.starts))
+            if (self.starts[e] <= pos) and (pos <= self.ends[e])]
+
+    def exonsAtEach(self, positions):
+        if (self.arrays is None) or (len(positions) < 2):
+            return [self.exonsAt(pos) for pos in positions]
+
+        starts, ends = self.arrays
+        p = np.array(positions, dtype=np.int64)
+        e = np.searchsorted(starts, p, side='right') - 1
+        hit = (e >= 0) & (ends[np.maximum(e, 0)] >= p)
+        return [[i] if h else [] for i, h in zip(e.tolist(), hit.tolist())]
+
+    """(region, exons) for every position: region is NON_CODING for
+       non-coding transcripts, CDS between cdsStart and cdsEnd, PROMOTER
+       within promoter_offset upstream of the transcript and None
+       otherwise; exons are the indices of the exons containing the
+       position
+    """
+    def locate(self, positions, promoter_offset):
+        located = []
+        for pos, exons in zip(positions, self.exonsAtEach(positions)):
+            if (self.cdsStart == self.cdsEnd):
+                region = NON_CODING
+            elif (self.cdsStart <= pos) and (pos <= self.cdsEnd):
+                region = CDS
+            elif (self.strand == '+') and \
+                (self.txStart - promoter_offset <= pos) and \
+                (pos <= self.txStart):
+                region = PROMOTER
+            elif (self.strand == '-') and (self.txEnd <= pos) and \
+                (pos <= self.txEnd + promoter_offset):
+                region = PROMOTER
+            else:
+                region = None
+            located.append((region, exons))
+        return located
+
+
+def blobText(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return str(value)
+
+
+"""Parsed transcript of a refGene row, cached per process
+   Cache hits and misses are counted into stats when it is given.
+"""
+def transcript(row, stats=None):
+    t = _transcripts.get(row)
+    if (t is None):
+        t = Transcript(row)
+        _transcripts[row] = t
+        if (stats is not None):
+            stats['cache_misses'] = stats['cache_misses'] + 1
+    elif (stats is not None):
+        stats['cache_hits'] = stats['cache_hits'] + 1
+    return t
+
+### EOF
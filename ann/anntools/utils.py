@@ -12,22 +12,34 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
 import os
+import sys
 import json
+import time
+import threading
 import pymysql
-import boto3
+import backends
 from botocore.exceptions import ClientError
 
+# Secrets Manager cache shared with the other GAS components
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, os.pardir, 'util'))
+import secret_cache
+
 """Get connection to reference database
+   With the sqlite reference backend this is the node-local replica at
+   backends.REFERENCE_DB instead of the RDS database.
 """
 def db_connect():
+    if (backends.REFERENCE_BACKEND == 'sqlite'):
+        return backends.SqliteConnection(backends.REFERENCE_DB)
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
     # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        rds_secret = secret_cache.get_secret('rds/anntools_database',
+            region_name=AWS_REGION_NAME)
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
@@ -48,6 +60,128 @@ def db_connect():
         db=database_name)
 
 
+"""Pool of reference database connections shared by all annotation stages
+   Connections are handed out most recently used first. A connection that
+   has been idle for ping_after seconds is pinged before it is reused and
+   replaced if the ping fails; connections idle for max_idle seconds are
+   closed. At most max_size connections are open at once; acquire() waits
+   for one to be released when the pool is exhausted.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, connect=None, max_size=8, max_idle=300, ping_after=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.idle = []
+        self.open = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.evicted = 0
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+
+    def evictIdle(self):
+        now = time.time()
+        keep = []
+        for conn, last_used in self.idle:
+            if ((now - last_used) > self.max_idle):
+                self.discard(conn)
+                self.evicted = self.evicted + 1
+            else:
+                keep.append((conn, last_used))
+        self.idle = keep
+
+    def discard(self, conn):
+        self.open = self.open - 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def isHealthy(self, conn, last_used):
+        if (((time.time() - last_used) < self.ping_after) or
+            not hasattr(conn, 'ping')):
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                self.evictIdle()
+                while (len(self.idle) > 0):
+                    conn, last_used = self.idle.pop()
+                    if self.isHealthy(conn, last_used):
+                        self.reused = self.reused + 1
+                        return conn
+                    self.discard(conn)
+                    self.discarded = self.discarded + 1
+
+                if (self.open < self.max_size):
+                    self.open = self.open + 1
+                    break
+                self.cond.wait()
+
+        try:
+            conn = (self.connect or db_connect)()
+        except Exception:
+            with self.cond:
+                self.open = self.open - 1
+                self.cond.notify()
+            raise
+
+        with self.cond:
+            self.created = self.created + 1
+        return conn
+
+    """Allow at least size connections open at once
+    """
+    def reserve(self, size):
+        with self.cond:
+            if (size > self.max_size):
+                self.max_size = size
+                self.cond.notify_all()
+
+    def release(self, conn):
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.evictIdle()
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            for conn, last_used in self.idle:
+                self.discard(conn)
+            self.idle = []
+
+    def stats(self):
+        with self.cond:
+            return {'created': self.created, 'reused': self.reused,
+                'discarded': self.discarded, 'evicted': self.evicted,
+                'open': self.open, 'idle': len(self.idle)}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Process-wide reference database connection pool
+   A forked child gets a pool of its own; the connections inherited from
+   the parent are left alone since the parent still owns them.
+"""
+def db_pool():
+    global _pool
+    with _pool_lock:
+        if (_pool is None) or (_pool.pid != os.getpid()):
+            _pool = ConnectionPool()
+        return _pool
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
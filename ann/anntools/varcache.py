@@ -0,0 +1,226 @@
+# varcache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Node-local persistent cache of annotation lookups, shared by jobs
+#
+# Many jobs annotate the same variants (population SNPs recur in every
+# exome). The cache keeps what every stage looked up for a variant, keyed
+# by (chrom, pos, ref, alt, reference data version, stage), so that later
+# jobs on the same node skip the reference database for it. Lookups are
+# cached rather than the INFO fragments built from them, since a stage's
+# fragment and its count log counters also depend on the record it is
+# applied to.
+#
+# The cache is a SQLite database in WAL mode that any number of annotator
+# processes may use at once. Entries are evicted least recently used
+# first once the cache grows beyond max_mb; triggers keep the size of all
+# entries in the meta table. A cache that cannot be read or
+# written is given up on for the rest of the job, which then queries the
+# reference database as if there was no cache.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import pickle
+import sqlite3
+
+# Version of the reference data; change it whenever the reference tables
+# are reloaded so that earlier lookups are no longer used
+REFERENCE_VERSION = os.environ['ANNTOOLS_REFERENCE_VERSION'] \
+    if ('ANNTOOLS_REFERENCE_VERSION' in os.environ) else 'hg19'
+
+# Layout of the cached lookups; part of every key
+CACHE_FORMAT = 1
+
+# Size of the cache before entries are evicted
+MAX_MB = int(os.environ['ANNTOOLS_VARIANT_CACHE_MB']) \
+    if ('ANNTOOLS_VARIANT_CACHE_MB' in os.environ) else 1024
+
+# Bytes taken by a cached lookup besides its result and key: row header,
+# version and both indexes
+ROW_OVERHEAD = 64
+
+# Keys per query; 4 parameters each stays below SQLite's variable limit
+CHUNK = 200
+
+SCHEMA = [
+    'create table if not exists lookups (chrom text, pos text, ref text, ' +
+        'alt text, version text, stage text, result blob, size integer, ' +
+        'used real);',
+    'create unique index if not exists lookups_key on lookups ' +
+        '(chrom, pos, ref, alt, version, stage);',
+    'create index if not exists lookups_used on lookups (used);',
+    'create table if not exists meta (name text primary key, value);',
+    "insert or ignore into meta values ('bytes', 0);",
+    'create trigger if not exists lookups_insert after insert on lookups ' +
+        "begin update meta set value = value + new.size " +
+        "where name = 'bytes'; end;",
+    'create trigger if not exists lookups_delete after delete on lookups ' +
+        "begin update meta set value = value - old.size " +
+        "where name = 'bytes'; end;"]
+
+
+"""Cache key of a record: its chromosome, position, reference and
+   alternate alleles as written in the file; inds are the indices of these
+   fields (see annotate.getFormatSpecificIndices())
+"""
+def variantKey(fields, inds):
+    return tuple([fields[i].strip() for i in inds])
+
+
+class VariantCache(object):
+
+    def __init__(self, path, inds=(0, 1, 3, 4), version=None, max_mb=None,
+        timeout=30):
+        self.path = path
+        self.inds = inds
+        self.version = (version or REFERENCE_VERSION) + '/' + \
+            str(CACHE_FORMAT)
+        self.max_bytes = (max_mb or MAX_MB) * 1024 * 1024
+        self.evicted = 0
+        self.failed = False
+        self.stats = {'secs': 0.0, 'cpu_secs': 0.0}
+        self.conn = None
+        try:
+            self.conn = sqlite3.connect(path, timeout=timeout,
+                isolation_level=None)
+            self.conn.execute('pragma journal_mode=wal;')
+            self.conn.execute('pragma synchronous=normal;')
+            self.transaction(SCHEMA)
+        except sqlite3.Error as e:
+            self.fail(e)
+
+    """Give up on the cache for the rest of the job
+    """
+    def fail(self, error):
+        print(f"Variant cache {self.path} is not used: {str(error)}")
+        self.failed = True
+        if (self.conn is not None):
+            self.conn.close()
+        self.conn = None
+
+    def transaction(self, statements):
+        self.conn.execute('begin immediate;')
+        try:
+            for sql in statements:
+                if isinstance(sql, tuple):
+                    self.conn.executemany(sql[0], sql[1])
+                else:
+                    self.conn.execute(sql)
+            self.conn.execute('commit;')
+        except Exception:
+            self.conn.execute('rollback;')
+            raise
+
+    """Cached lookups of the records of batch for the stages named in
+       stages: one dict per stage mapping record indices to results
+    """
+    def fetch(self, batch, stages):
+        found = [{} for s in stages]
+        if (self.conn is None):
+            return found
+        try:
+            self.fetchInto(found, batch, stages)
+        except sqlite3.Error as e:
+            self.fail(e)
+            return [{} for s in stages]
+        return found
+
+    def fetchInto(self, found, batch, stages):
+        column = dict([(s, k) for k, s in enumerate(stages)])
+        indices = {}
+        for i, fields in enumerate(batch):
+            indices.setdefault(variantKey(fields, self.inds), []).append(i)
+
+        keys = list(indices)
+        for c in range(0, len(keys), CHUNK):
+            chunk = keys[c:c + CHUNK]
+            args = [self.version]
+            for key in chunk:
+                args.extend(key)
+            rows = self.conn.execute('select chrom, pos, ref, alt, stage, ' +
+                'result from lookups where version = ? and ' +
+                '(chrom, pos, ref, alt) in (values ' +
+                ', '.join(['(?, ?, ?, ?)'] * len(chunk)) + ');', args)
+            for chrom, pos, ref, alt, stage, result in rows:
+                k = column.get(stage)
+                if (k is None):
+                    continue
+                value = pickle.loads(result)
+                for i in indices[(chrom, pos, ref, alt)]:
+                    found[k][i] = value
+
+    """Store the new lookups of a batch, given as one dict of record
+       indices to results per stage, and mark the records whose indices are
+       in hits as used
+    """
+    def store(self, batch, stages, fresh, hits=()):
+        if (self.conn is None):
+            return
+        try:
+            self.storeRows(batch, stages, fresh, hits)
+            self.evict()
+        except sqlite3.Error as e:
+            self.fail(e)
+
+    def storeRows(self, batch, stages, fresh, hits):
+        now = time.time()
+        rows = {}
+        for stage, results in zip(stages, fresh):
+            for i, result in results.items():
+                key = variantKey(batch[i], self.inds)
+                if (key + (stage,)) not in rows:
+                    data = pickle.dumps(result, protocol=4)
+                    size = len(data) + len(''.join(key + (stage,))) + \
+                        ROW_OVERHEAD
+                    rows[key + (stage,)] = key + (self.version, stage, data,
+                        size, now)
+        used = [(now, self.version) + variantKey(batch[i], self.inds)
+            for i in set(hits)]
+
+        self.transaction([
+            ('insert or ignore into lookups values (?, ?, ?, ?, ?, ?, ?, ' +
+                '?, ?);', list(rows.values())),
+            ('update lookups set used = ? where version = ? and chrom = ? ' +
+                'and pos = ? and ref = ? and alt = ?;', used)])
+
+    """Drop least recently used entries until the cache is back under 90%
+       of its size; the size is read again in every transaction since other
+       processes evict too
+    """
+    def evict(self):
+        if (self.size() <= self.max_bytes):
+            return
+        target = int(self.max_bytes * 0.9)
+        while True:
+            self.conn.execute('begin immediate;')
+            try:
+                if (self.size() <= target):
+                    self.conn.execute('commit;')
+                    return
+                rows = self.conn.execute('select rowid from lookups ' +
+                    'order by used limit 1000;').fetchall()
+                self.conn.executemany('delete from lookups where rowid = ?;',
+                    rows)
+                self.conn.execute('commit;')
+            except Exception:
+                self.conn.execute('rollback;')
+                raise
+            self.evicted = self.evicted + len(rows)
+            if (len(rows) == 0):
+                return
+
+    def size(self):
+        return self.conn.execute("select value from meta " +
+            "where name = 'bytes';").fetchone()[0]
+
+    def close(self):
+        if (self.conn is not None):
+            self.conn.close()
+            self.conn = None
+
+### EOF
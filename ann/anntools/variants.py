@@ -0,0 +1,181 @@
+# variants.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Variant records as passed through the annotation stages
+#
+# A record is the list of a line's columns, split once when the line is
+# read and joined once when it is written. Columns after INFO (FORMAT and
+# the samples) are never touched by a stage and are kept as one raw string.
+# The locus the stages look up is parsed once as well: the chromosome in
+# both its prefix forms, the position as an int and the interned alleles.
+# INFO is built up in an Info while the stages run and only rendered into
+# its column when the record is written.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import utils as u
+import annotate
+
+# Columns split off a line; the rest of the line stays in the last one
+COLUMNS = 8
+
+# Index of the INFO column
+INFO = 7
+
+
+"""INFO column of a record as the stages add to it
+   The text is kept as the list of fragments appended to it and joined
+   when it is needed, so that adding to a heavily annotated record does
+   not copy all of its INFO every time. Values read with get() are kept
+   until INFO changes.
+"""
+class Info(object):
+    __slots__ = ('parts', 'values')
+
+    def __init__(self, text):
+        self.parts = [text]
+        self.values = None
+
+    def size(self):
+        return sum([len(part) for part in self.parts])
+
+    def text(self):
+        if (len(self.parts) > 1):
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def set(self, text):
+        self.parts = [text]
+        self.values = None
+
+    def append(self, text):
+        self.parts.append(text)
+        self.values = None
+
+    def prepend(self, text):
+        self.parts.insert(0, text)
+        self.values = None
+
+    """Append fragment after a ';', unless INFO already ends with one
+    """
+    def add(self, fragment):
+        if self.endswith(';'):
+            self.append(fragment)
+        else:
+            self.append(';' + fragment)
+
+    def startswith(self, prefix):
+        head = ''
+        for part in self.parts:
+            head = head + part
+            if (len(head) >= len(prefix)):
+                break
+        return head.startswith(prefix)
+
+    def endswith(self, suffix):
+        tail = ''
+        for part in reversed(self.parts):
+            tail = part + tail
+            if (len(tail) >= len(suffix)):
+                break
+        return tail.endswith(suffix)
+
+    def removePrefix(self, prefix):
+        if self.startswith(prefix):
+            self.set(self.text()[len(prefix):])
+
+    """Last character of INFO; '' if it is empty
+    """
+    def last(self):
+        for part in reversed(self.parts):
+            if (part != ''):
+                return part[-1]
+        return ''
+
+    """Value of the first key containing key, as utils.parse_field() reads
+       it from INFO cleaned of quotes
+    """
+    def get(self, key):
+        if (self.values is None):
+            self.values = {}
+        if (key not in self.values):
+            self.values[key] = u.parse_field(
+                annotate.clean_mysql_chars(self.text()).strip(), key, ';', '=')
+        return self.values[key]
+
+
+"""Columns of a record with the locus attributes the stages read
+   inds are the indices of the chromosome, position, reference and
+   alternate allele columns (see annotate.getFormatSpecificIndices()).
+   The attributes are those of the columns when the record was parsed;
+   parse() again after replacing the columns. Stages add to INFO through
+   info; render() writes it back into its column.
+"""
+class Variant(list):
+    __slots__ = ('inds', 'chrom', 'chromBare', 'chromPrefixed', 'pos',
+        'ref', 'alt', 'cleanRef', 'cleanAlt', 'info')
+
+    def parse(self, inds, names=None):
+        self.inds = inds
+        if (names is None):
+            names = chromNames(self[inds[0]])
+        self.chrom, self.chromBare, self.chromPrefixed = names
+        self.pos = int(self[inds[1]])
+        self.ref = sys.intern(self[inds[2]].strip())
+        self.alt = sys.intern(self[inds[3]].strip())
+        self.cleanRef = self.ref
+        self.cleanAlt = self.alt
+        if ('"' in self.ref) or ("'" in self.ref):
+            self.cleanRef = annotate.clean_mysql_chars(self.ref).strip()
+        if ('"' in self.alt) or ("'" in self.alt):
+            self.cleanAlt = annotate.clean_mysql_chars(self.alt).strip()
+        self.info = Info(self[INFO]) if (len(self) > INFO) else None
+        return self
+
+    def render(self):
+        if (self.info is not None):
+            self[INFO] = self.info.text()
+        return self
+
+    """Whether the record starts or ends with whitespace, or ends with an
+       empty column
+    """
+    def blankEnds(self):
+        if (len(self) == INFO + 1) and (self.info is not None):
+            last = self.info.last()
+        else:
+            last = self[-1]
+        return (last == '') or last[-1].isspace() or \
+            self[0][:1].isspace()
+
+    """Locus as the stages read it, for the within-job memo
+    """
+    def locus(self):
+        return (self.chromPrefixed, self.chromBare, self.pos, self.ref,
+            self.alt)
+
+
+def parseVariant(line, inds, sep='\t'):
+    return Variant(line.split(sep, COLUMNS)).parse(inds)
+
+
+"""Record of columns already split (see vcfio.VcfChunk.columns()); names
+   are those of its chromosome (see chromNames()) when they are known
+"""
+def parseColumns(columns, inds, names=None):
+    return Variant(columns).parse(inds, names=names)
+
+
+"""A chromosome as it is written, without and with the "chr" prefix, all
+   stripped and interned
+"""
+def chromNames(chrom):
+    return (sys.intern(chrom.strip()),
+        sys.intern(annotate.chromNoPrefix(chrom)),
+        sys.intern(annotate.chromWithPrefix(chrom)))
+
+### EOF
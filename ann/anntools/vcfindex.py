@@ -0,0 +1,184 @@
+# vcfindex.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Coordinate index of an annotated VCF file, built while the file is
+# written
+#
+# For BGZF output the index is written in tabix (.tbi) format; for plain
+# output a JSON linear index (.idx) maps every 16 kb window of every
+# chromosome to the byte offset of the first record overlapping it. Both
+# let clients fetch a region with byte-range requests.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import struct
+import bisect
+
+# Linear index window, as in tabix
+MIN_SHIFT = 14
+
+# tabix: VCF preset, column numbers, meta character and pseudo-bin
+TBX_VCF = 2
+META_BIN = 37450
+
+
+"""UCSC bin of the 0-based, half-open interval [beg, end)
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    if ((beg >> 14) == (end >> 14)):
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if ((beg >> 17) == (end >> 17)):
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if ((beg >> 20) == (end >> 20)):
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if ((beg >> 23) == (end >> 23)):
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if ((beg >> 26) == (end >> 26)):
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+"""Bins and linear index of one chromosome; offsets are positions in the
+   uncompressed output
+"""
+class ChromIndex(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.bins = {}
+        self.linear = []
+        self.start = None
+        self.end = None
+        self.count = 0
+        self.last = -1
+
+
+"""Collects the records of a VCF file, in the order they are written
+   The records must be sorted by chromosome and position; once one is out
+   of order (or has no numeric position) the index is marked invalid and
+   nothing is written.
+"""
+class CoordinateIndex(object):
+
+    def __init__(self):
+        self.chroms = []
+        self.names = {}
+        self.current = None
+        self.valid = True
+        self.reason = None
+
+    def invalidate(self, reason):
+        self.valid = False
+        self.reason = reason
+
+    def add(self, fields, start, end):
+        if not self.valid:
+            return
+        try:
+            pos = int(fields[1])
+        except (IndexError, ValueError):
+            self.invalidate("a record has no position")
+            return
+
+        name = fields[0]
+        chrom = self.current
+        if (chrom is None) or (chrom.name != name):
+            if name in self.names:
+                self.invalidate(f"{name} records are not contiguous")
+                return
+            chrom = ChromIndex(name)
+            self.names[name] = chrom
+            self.chroms.append(chrom)
+            self.current = chrom
+
+        beg = pos - 1
+        if (beg < chrom.last):
+            self.invalidate(f"{name} records are not sorted by position")
+            return
+        chrom.last = beg
+        ref = fields[3].strip() if (len(fields) > 3) else ''
+        stop = beg + max(1, len(ref))
+
+        chunks = chrom.bins.setdefault(reg2bin(beg, stop), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == start):
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+        for w in range(beg >> MIN_SHIFT, ((stop - 1) >> MIN_SHIFT) + 1):
+            while (len(chrom.linear) <= w):
+                chrom.linear.append(None)
+            if (chrom.linear[w] is None):
+                chrom.linear[w] = start
+
+        if (chrom.start is None):
+            chrom.start = start
+        chrom.end = end
+        chrom.count = chrom.count + 1
+
+    """Linear index with the windows no record overlaps filled in, as
+       tabix does: leading ones with the chromosome's first record, the
+       others with the window before them
+    """
+    def linearOffsets(self, chrom):
+        offsets = list(chrom.linear)
+        for w in range(len(offsets)):
+            if (offsets[w] is None):
+                offsets[w] = chrom.start if (w == 0) else offsets[w - 1]
+        return offsets
+
+    """tabix index of a BGZF file; offset maps an uncompressed position to
+       its virtual file offset
+    """
+    def tabix(self, offset):
+        names = b''.join([c.name.encode('utf-8') + b'\0'
+            for c in self.chroms])
+        out = [b'TBI\x01', struct.pack('<8i', len(self.chroms), TBX_VCF, 1,
+            2, 0, ord('#'), 0, len(names)), names]
+
+        for chrom in self.chroms:
+            out.append(struct.pack('<i', len(chrom.bins) + 1))
+            for b in sorted(chrom.bins):
+                chunks = chrom.bins[b]
+                out.append(struct.pack('<Ii', b, len(chunks)))
+                for beg, end in chunks:
+                    out.append(struct.pack('<QQ', offset(beg), offset(end)))
+            out.append(struct.pack('<IiQQQQ', META_BIN, 2,
+                offset(chrom.start), offset(chrom.end), chrom.count, 0))
+
+            linear = self.linearOffsets(chrom)
+            out.append(struct.pack('<i', len(linear)))
+            out.append(struct.pack('<' + str(len(linear)) + 'Q',
+                *[offset(o) for o in linear]))
+
+        out.append(struct.pack('<Q', 0))
+        return b''.join(out)
+
+    """JSON linear index of a plain file
+    """
+    def plain(self):
+        return json.dumps({'window': 1 << MIN_SHIFT, 'chroms': [
+            {'name': c.name, 'start': c.start, 'end': c.end,
+            'count': c.count, 'offsets': self.linearOffsets(c)}
+            for c in self.chroms]})
+
+
+"""Maps uncompressed positions of a BGZF file to virtual file offsets,
+   given the (uncompressed, compressed) start of every block and of the
+   end of the data
+"""
+def virtualOffsets(blocks):
+    ustarts = [b[0] for b in blocks]
+    cstarts = [b[1] for b in blocks]
+
+    def offset(u):
+        k = bisect.bisect_right(ustarts, u) - 1
+        return (cstarts[k] << 16) | (u - ustarts[k])
+    return offset
+
+### EOF
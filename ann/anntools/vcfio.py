@@ -0,0 +1,424 @@
+# vcfio.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reading and writing plain, gzip and bgzip (BGZF) compressed VCF files
+#
+# Besides line by line, files can be read in large newline-aligned chunks
+# (readChunks()), memory-mapped when they are not compressed, and their
+# records split into columns a run at a time (VcfChunk.columns()).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import gzip
+import zlib
+import mmap
+import struct
+import collections
+import concurrent.futures
+import vcfindex
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Extension of the variant pileups the annotator accepts; they are
+# converted to VCF as they are read (see pileup2vcf.vcf_lines())
+PILEUP_EXTENSION = '.pileup'
+
+# Extensions of the files the annotator accepts
+EXTENSIONS = ['.vcf.gz', '.vcf.bgz', '.vcf', PILEUP_EXTENSION]
+
+# Uncompressed bytes per BGZF block; small enough that a block always
+# fits in 64 KiB once compressed
+BGZF_BLOCK_SIZE = 0xff00
+
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff060042430200' +
+    '1b0003000000000000000000')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Bytes read at once by readChunks()
+CHUNK_BYTES = 16 * 1024 * 1024
+
+NEWLINE = re.compile(b'\n')
+
+
+"""(name without extension, extension) for one of EXTENSIONS, or
+   (path, '') if the file has none of them
+"""
+def splitExtension(path):
+    for ext in EXTENSIONS:
+        if path.endswith(ext):
+            return (path[:-len(ext)], ext)
+    return (path, '')
+
+
+def isCompressed(path):
+    with open(path, 'rb') as fh:
+        return (fh.read(2) == GZIP_MAGIC)
+
+
+"""Open a VCF file for reading as text, decompressing gzip and bgzip
+   files as they are read
+"""
+def openInput(path):
+    if isCompressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Newline-aligned chunks of about size bytes of a VCF file, as VcfChunks
+   Uncompressed files are memory-mapped and every chunk is a view of the
+   mapping, so nothing is copied until a line is used. A chunk is
+   released when the next one is read: views of its lines must not be
+   kept beyond that. Compressed files are decompressed one chunk at a time.
+"""
+def readChunks(path, size=CHUNK_BYTES):
+    if isCompressed(path):
+        with gzip.open(path, 'rb') as fh:
+            rest = b''
+            while True:
+                data = fh.read(size)
+                if (len(data) == 0):
+                    break
+                data = rest + data
+                cut = data.rfind(b'\n') + 1
+                rest = data[cut:]
+                if (cut > 0):
+                    yield VcfChunk(data, 0, cut)
+            if (len(rest) > 0):
+                yield VcfChunk(rest, 0, len(rest))
+        return
+
+    with open(path, 'rb') as fh:
+        if (os.fstat(fh.fileno()).st_size == 0):
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0
+            end = len(mapped)
+            while (start < end):
+                stop = mapped.find(b'\n', min(start + size, end) - 1)
+                stop = end if (stop < 0) else stop + 1
+                chunk = VcfChunk(mapped, start, stop)
+                yield chunk
+                chunk.release()
+                start = stop
+
+
+"""Lines of bytes start to stop of source (bytes or a memory map) of a
+   VCF file
+   Line i runs from starts[i] to ends[i] of data, a view of the chunk,
+   without its newline. Like the annotator, which strips every line,
+   headers are lines starting with '#' after any leading whitespace.
+   split() cuts the lines into runs of headers and of records (the other
+   lines) on the same chromosome; with NumPy, without looking at every
+   line in Python. columns() splits the records of a run into their
+   columns.
+"""
+class VcfChunk(object):
+
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.offset = start
+        self.data = memoryview(source)[start:stop]
+        if (np is not None):
+            ends = np.flatnonzero(np.frombuffer(self.data,
+                dtype=np.uint8) == 10)
+            if (len(ends) == 0) or (ends[-1] != len(self.data) - 1):
+                ends = np.append(ends, len(self.data))
+            self.ends = ends.tolist()
+            ends[:-1] = ends[:-1] + 1
+            self.starts = [0] + ends[:-1].tolist()
+        else:
+            self.ends = [m.start() for m in NEWLINE.finditer(self.data)]
+            if (len(self.ends) == 0) or \
+                (self.ends[-1] != len(self.data) - 1):
+                self.ends.append(len(self.data))
+            self.starts = [0] + [end + 1 for end in self.ends[:-1]]
+        self.runs = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Drop the chunk's views of the file, which is unmapped once the views
+       of all its chunks are gone
+    """
+    def release(self):
+        self.data.release()
+        self.data = None
+        self.source = None
+
+    """Line i as a view of the chunk, without its newline
+    """
+    def line(self, i):
+        return self.data[self.starts[i]:self.ends[i]]
+
+    """Lines i to j - 1 as one view of the chunk, with the newlines between
+       them but not the one after the last
+    """
+    def lines(self, i, j):
+        return self.data[self.starts[i]:self.ends[j - 1]]
+
+    def text(self, i):
+        return str(self.line(i), 'utf-8')
+
+    """Cut the lines into runs of headers and of records on the same
+       chromosome: (first line, line after the last, CHROM or None for
+       headers) for every run
+    """
+    def split(self, sep='\t'):
+        self.sep = sep.encode('utf-8')
+        names = {}
+        runs = []
+        for i, name in self.runHeads():
+            chrom = names.get(name) if (name is not None) else None
+            if (chrom is None):
+                chrom = self.chrom(i)
+                if (name is not None):
+                    names[name] = chrom
+            if (len(runs) > 0) and (runs[-1][2] == chrom):
+                runs[-1][1] = i
+            else:
+                if (len(runs) > 0):
+                    runs[-1][1] = i
+                runs.append([i, i, chrom])
+        if (len(runs) > 0):
+            runs[-1][1] = len(self)
+        self.runs = [tuple(run) for run in runs]
+        return self.runs
+
+    """CHROM of line i, or None if it is a header
+    """
+    def chrom(self, i):
+        line = bytes(self.line(i)).strip()
+        if line.startswith(b'#'):
+            return None
+        return sys.intern(str(line.split(self.sep, 1)[0], 'utf-8'))
+
+    """(line, bytes before its first separator) for the lines that may
+       start a run: with NumPy, the lines whose first separator is not
+       preceded by the same bytes as in the line before. The bytes are
+       None for headers, blank lines and lines starting with whitespace.
+    """
+    def runHeads(self):
+        data = self.data
+        source = self.source
+        offset = self.offset
+        if (np is None) or (len(self.sep) != 1):
+            for i, (start, end) in enumerate(zip(self.starts, self.ends)):
+                if (start == end) or (data[start] in b'# \t\r\x0b\x0c'):
+                    yield (i, None)
+                    continue
+                cut = source.find(self.sep, offset + start, offset + end)
+                yield (i, bytes(data[start:end if (cut < 0) else
+                    cut - offset]))
+            return
+
+        raw = np.frombuffer(data, dtype=np.uint8)
+        starts = np.array(self.starts, dtype=np.int64)
+        ends = np.array(self.ends, dtype=np.int64)
+        tabs = np.flatnonzero(raw == self.sep[0])
+        cuts = np.append(tabs, len(raw))[np.searchsorted(tabs, starts)]
+        cuts = np.minimum(cuts, ends)
+        lengths = cuts - starts
+        first = raw[np.minimum(starts, max(len(raw) - 1, 0))]
+        # Headers, blank lines and lines starting with whitespace are
+        # looked at one by one
+        named = (starts < ends) & (first != 35) & (first != 32) & \
+            (first != 9) & (first != 13) & (first != 11) & (first != 12)
+        same = named[1:] & named[:-1] & (lengths[1:] == lengths[:-1])
+        # Compare the bytes before the separator with those of the line
+        # before, one position at a time
+        for k in range(int(lengths[1:][same].max()) if same.any() else 0):
+            long = same & (lengths[1:] > k)
+            same[long] = (raw[starts[1:][long] + k] ==
+                raw[starts[:-1][long] + k])
+        heads = np.ones(len(starts), dtype=bool)
+        heads[1:] = ~same
+        del raw
+        cuts = cuts.tolist()
+        named = named.tolist()
+        for i in np.flatnonzero(heads).tolist():
+            yield (i, bytes(data[self.starts[i]:cuts[i]]) if named[i]
+                else None)
+
+    """Columns of lines first to stop - 1, records of a run (see split()),
+       each stripped and split at its first count separators; the lines
+       are decoded together rather than one by one
+    """
+    def columns(self, first, stop, count=8):
+        sep = str(self.sep, 'utf-8')
+        return [line.strip().split(sep, count) for line in
+            str(self.lines(first, stop), 'utf-8').split('\n')]
+
+
+"""Open a VCF file for writing; names ending in .gz or .bgz are written
+   in BGZF format
+"""
+def openOutput(path, threads=None, index=False):
+    return VcfWriter(path, threads=threads, index=index)
+
+
+def isBgzf(path):
+    return path.endswith('.gz') or path.endswith('.bgz')
+
+
+"""Name of the coordinate index written next to path
+"""
+def indexName(path):
+    if isBgzf(path):
+        return path + '.tbi'
+    return path + '.idx'
+
+
+"""Compress data into one BGZF block: a gzip member whose header carries
+   the size of the block, so that readers can seek to block boundaries
+"""
+def bgzfBlock(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Text file writer producing BGZF output, which gzip, zcat, bgzip and
+   tabix all read
+   Text is cut into blocks of BGZF_BLOCK_SIZE bytes which are compressed
+   on a pool of threads (zlib releases the GIL while compressing) and
+   written in order. blocks records the (uncompressed, compressed) start
+   of every block, followed by the end of the data.
+"""
+class BgzfWriter(object):
+
+    def __init__(self, path, threads=None, level=6):
+        self.name = path
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.blocks = []
+        self.usize = 0
+        self.csize = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BGZF_BLOCK_SIZE):
+            self.submit(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def submit(self, data):
+        self.pending.append((self.usize,
+            self.executor.submit(bgzfBlock, data, self.level)))
+        self.usize = self.usize + len(data)
+        while (len(self.pending) > self.threads * 4):
+            self.writeBlock()
+
+    def writeBlock(self):
+        ustart, future = self.pending.popleft()
+        block = future.result()
+        self.blocks.append((ustart, self.csize))
+        self.fh.write(block)
+        self.csize = self.csize + len(block)
+
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while (len(self.pending) > 0):
+            self.writeBlock()
+        self.fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.blocks.append((self.usize, self.csize))
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        self.executor.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Writer for an annotated VCF file, plain or BGZF
+   Header lines are written with write(), records with writeRecords().
+   With index set, a vcfindex.CoordinateIndex is built from the records as
+   they are written and saved next to the file by close(), unless the
+   records turned out not to be sorted.
+"""
+class VcfWriter(object):
+
+    def __init__(self, path, threads=None, index=False):
+        self.name = path
+        self.bgzf = isBgzf(path)
+        if self.bgzf:
+            self.fh = BgzfWriter(path, threads=threads)
+        else:
+            self.fh = open(path, 'wb')
+        self.index = vcfindex.CoordinateIndex() if index else None
+        self.offset = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.fh.write(data)
+        self.offset = self.offset + len(data)
+
+    """Write records given as lines ending in a newline
+    """
+    def writeRecords(self, lines, sep='\t'):
+        if (self.index is None):
+            self.write(''.join(lines))
+            return
+
+        chunks = []
+        for line in lines:
+            data = line.encode('utf-8')
+            self.index.add(line.split(sep, 4), self.offset,
+                self.offset + len(data))
+            self.offset = self.offset + len(data)
+            chunks.append(data)
+        self.fh.write(b''.join(chunks))
+
+    def close(self):
+        self.fh.close()
+        if (self.index is None):
+            return
+
+        if not self.index.valid:
+            print(f"No index written for {self.name}: {self.index.reason}")
+        elif self.bgzf:
+            with BgzfWriter(indexName(self.name), threads=1) as fh:
+                fh.write(self.index.tabix(
+                    vcfindex.virtualOffsets(self.fh.blocks)))
+        else:
+            with open(indexName(self.name), 'w') as fh:
+                fh.write(self.index.plain())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
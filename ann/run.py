@@ -2,6 +2,7 @@ import sys
 import time
 sys.path.append('/home/ec2-user/mpcs-cc/gas/ann/anntools')
 import driver
+import vcfio
 import boto3
 import os
 from configparser import ConfigParser
@@ -38,8 +39,9 @@ class Timer(object):
 if __name__ == '__main__':
     # Check if a VCF file name is provided
     if len(sys.argv) > 1:
-        # Extract the job_id path removing '.vcf'
-        job_id = sys.argv[1][0: -4]
+        # Extract the job_id path removing '.vcf' (or '.vcf.gz', '.vcf.bgz',
+        # '.pileup')
+        job_id = vcfio.splitExtension(sys.argv[1])[0]
         id = job_id.split('/')[-2]
         fullfilename = sys.argv[7]
         filename = fullfilename.split('.')[0]
@@ -51,7 +53,8 @@ if __name__ == '__main__':
         with Timer():
             try:
             # Run the AnnTools driver
-                driver.run(sys.argv[1], 'vcf')
+                results_file = driver.run(sys.argv[1],
+                    driver.inputFormat(sys.argv[1]))
             except Exception as e:
                 print(f"Error processing VCF file: {e}")
                 sys.exit(1)
@@ -63,16 +66,28 @@ if __name__ == '__main__':
         dynamodb = boto3.resource('dynamodb')
         table = dynamodb.Table(TABLE_NAME)
             
-        results_file = f"{job_id}.annot.vcf"
         log_file = f"{job_id}.vcf.count.log"
+        stats_file = f"{job_id}.vcf.stats.json"
 
-        results_file_key = f"{CNETID}/{username}/{id}/{filename}.annot.vcf"
+        # .annot.vcf, or .annot.vcf.gz when the output is compressed
+        results_file_key = f"{CNETID}/{username}/{id}/{filename}" + \
+            results_file[len(job_id):]
         log_file_key = f"{CNETID}/{username}/{id}/{filename}.vcf.count.log"
+        # Per-stage performance stats, next to the count log
+        stats_file_key = f"{CNETID}/{username}/{id}/{filename}.vcf.stats.json"
+
+        # Coordinate index of the results (.tbi or .idx), if one was written
+        index_file = vcfio.indexName(results_file)
+        index_file_key = results_file_key + index_file[len(results_file):]
 
         try:
             # Upload file to s3
             s3.upload_file(results_file, RESULTS_BUCKET_NAME, results_file_key)
             s3.upload_file(log_file, RESULTS_BUCKET_NAME, log_file_key)
+            if os.path.exists(stats_file):
+                s3.upload_file(stats_file, RESULTS_BUCKET_NAME, stats_file_key)
+            if os.path.exists(index_file):
+                s3.upload_file(index_file, RESULTS_BUCKET_NAME, index_file_key)
         except (BotoCoreError, ClientError) as error:
                 print(f"Error uploading files to S3: {error}")
                 sys.exit(1)
@@ -126,6 +141,10 @@ if __name__ == '__main__':
         # Delete local files
         os.remove(results_file)
         os.remove(log_file)
+        if os.path.exists(stats_file):
+            os.remove(stats_file)
+        if os.path.exists(index_file):
+            os.remove(index_file)
       
                 
     else:
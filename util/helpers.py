@@ -13,6 +13,8 @@ import json
 import boto3
 from botocore.exceptions import ClientError
 
+import secret_cache
+
 # Get util configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
@@ -48,10 +50,9 @@ import psycopg2.extras
 """
 def get_user_profile(id=None, db_name=None):
   # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
   try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
+    rds_secret = secret_cache.get_secret('rds/accounts_database',
+      region_name=config['aws']['AwsRegionName'])
   except ClientError as e:
     raise ClientError
 
@@ -0,0 +1,164 @@
+# secret_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Cached access to AWS Secrets Manager, shared by the web server, the
+# annotator and the utilities
+#
+# Settings (environment):
+#   GAS_SECRETS_CACHE_TTL  - seconds a secret is used before it is refreshed
+#   GAS_SECRETS_CACHE_FILE - optional local file that keeps secrets across
+#                            restarts; only used together with
+#   GAS_SECRETS_CACHE_KEY  - Fernet key used to encrypt the cache file
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import threading
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+  from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+  Fernet = None
+
+DEFAULT_TTL = int(os.environ['GAS_SECRETS_CACHE_TTL']) \
+  if ('GAS_SECRETS_CACHE_TTL' in os.environ) else 3600
+
+# Caches already created by this process, keyed by region
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+"""Secrets Manager values cached in memory and, optionally, in an encrypted
+local file
+
+A secret is fetched at most once per TTL. When several threads need a
+secret that has expired, one of them refreshes it and the others wait for
+its result. If the refresh fails (e.g. throttling or no network) and an
+older value is known, the older value is used.
+"""
+class SecretCache(object):
+
+  def __init__(self, region_name, ttl=DEFAULT_TTL, cache_file=None,
+    cache_key=None):
+    self.region_name = region_name
+    self.ttl = ttl
+    self.cache_file = cache_file
+    self.fernet = None
+    if cache_file and cache_key:
+      if Fernet is None:
+        print("cryptography is not installed; secrets cache file disabled")
+      else:
+        self.fernet = Fernet(cache_key)
+
+    self.client = None
+    self.secrets = {}
+    self.locks = {}
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.fetches = 0
+    self.stale = 0
+    self.load()
+
+  def isFresh(self, entry):
+    return (entry is not None) and ((time.time() - entry[1]) < self.ttl)
+
+  def secretLock(self, secret_id):
+    with self.lock:
+      if secret_id not in self.locks:
+        self.locks[secret_id] = threading.Lock()
+      return self.locks[secret_id]
+
+  def fetch(self, secret_id):
+    if self.client is None:
+      self.client = boto3.client('secretsmanager',
+        region_name=self.region_name)
+    response = self.client.get_secret_value(SecretId=secret_id)
+    self.fetches = self.fetches + 1
+    return response['SecretString']
+
+  def get(self, secret_id):
+    entry = self.secrets.get(secret_id)
+    if self.isFresh(entry):
+      self.hits = self.hits + 1
+      return json.loads(entry[0])
+
+    with self.secretLock(secret_id):
+      # Another thread, or another process sharing the cache file, may
+      # have refreshed the secret while we waited
+      entry = self.secrets.get(secret_id)
+      if not self.isFresh(entry):
+        self.load()
+        entry = self.secrets.get(secret_id)
+      if self.isFresh(entry):
+        self.hits = self.hits + 1
+        return json.loads(entry[0])
+
+      try:
+        value = self.fetch(secret_id)
+      except (BotoCoreError, ClientError) as e:
+        if entry is None:
+          raise e
+        print(f"Using cached value of {secret_id}; refresh failed: {e}")
+        self.stale = self.stale + 1
+        return json.loads(entry[0])
+
+      with self.lock:
+        self.secrets[secret_id] = (value, time.time())
+      self.save()
+      return json.loads(value)
+
+  def load(self):
+    if (self.fernet is None) or not os.path.exists(self.cache_file):
+      return
+    try:
+      with open(self.cache_file, 'rb') as fh:
+        data = json.loads(self.fernet.decrypt(fh.read()))
+    except (OSError, ValueError, InvalidToken) as e:
+      print(f"Ignoring unreadable secrets cache file: {e}")
+      return
+
+    with self.lock:
+      for secret_id, (value, fetched) in data.items():
+        entry = self.secrets.get(secret_id)
+        if (entry is None) or (entry[1] < fetched):
+          self.secrets[secret_id] = (value, fetched)
+
+  def save(self):
+    if self.fernet is None:
+      return
+    with self.lock:
+      data = json.dumps(self.secrets).encode('utf-8')
+    tmpfile = f"{self.cache_file}.{os.getpid()}.tmp"
+    try:
+      fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'wb') as fh:
+        fh.write(self.fernet.encrypt(data))
+      os.replace(tmpfile, self.cache_file)
+    except OSError as e:
+      print(f"Unable to write secrets cache file: {e}")
+
+
+"""Process-wide cache for a region, configured from the environment
+"""
+def get_cache(region_name):
+  with _caches_lock:
+    if region_name not in _caches:
+      _caches[region_name] = SecretCache(region_name,
+        cache_file=os.environ.get('GAS_SECRETS_CACHE_FILE'),
+        cache_key=os.environ.get('GAS_SECRETS_CACHE_KEY'))
+    return _caches[region_name]
+
+
+"""Get a secret from AWS Secrets Manager as a dict, through the cache
+"""
+def get_secret(secret_id, region_name='us-east-1'):
+  return get_cache(region_name).get(secret_id)
+
+### EOF
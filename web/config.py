@@ -9,6 +9,7 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
+import sys
 import json
 import boto3
 import base64
@@ -17,6 +18,10 @@ from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Secrets Manager cache shared with the other GAS components
+sys.path.append(os.path.join(basedir, os.pardir, 'util'))
+import secret_cache
+
 class Config(object):
   GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
     if ('GAS_LOG_LEVEL' in os.environ) else 'INFO'
@@ -38,13 +43,13 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+  # Get various credentials from AWS Secrets Manager (cached, see
+  # util/secret_cache.py)
 
   # Get Flask application secret
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
+    flask_secret = secret_cache.get_secret('gas/web_server',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve Flask secret from ASM: {e}")
     raise e
@@ -52,8 +57,8 @@ class Config(object):
 
   # Get RDS secret and construct database URI
   try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
+    rds_secret = secret_cache.get_secret('rds/accounts_database',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve accounts database credentials from ASM: {e}")
     raise e
@@ -67,8 +72,8 @@ class Config(object):
 
   # Get the Globus Auth client ID and secret
   try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
+    globus_auth = secret_cache.get_secret('globus/auth_client',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
     raise e